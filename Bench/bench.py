@@ -0,0 +1,228 @@
+#!/usr/bin/env python3
+"""
+bench.py
+
+Runs chess_artist.py with the fake engine in fake_engine.py on the pgn
+files in PGN and on EPD/wacnew.epd. Every case is one job: analyze of a
+pgn file, analyze of the epd file, test of the epd file and createpuzzle.
+The time per position that is not spent waiting for the engine is shown
+and the output of every case is compared with its golden output in
+Bench/golden.
+
+Usage:
+    python Bench/bench.py
+    python Bench/bench.py --case analyze-sample --case test-wacnew
+    python Bench/bench.py --update
+
+Requirements:
+    python 3
+    python-chess
+"""
+
+
+import os
+import re
+import sys
+import json
+import time
+import argparse
+import tempfile
+import subprocess
+from pathlib import Path
+
+import chess.pgn
+
+
+BENCH_DIR = Path(__file__).resolve().parent
+ROOT_DIR = BENCH_DIR.parent
+GOLDEN_DIR = BENCH_DIR / 'golden'
+FAKE_ENGINE = BENCH_DIR / 'fake_engine.py'
+EPD_FILE = 'EPD/wacnew.epd'
+PUZZLE_PGN_FILE = 'PGN/sample.pgn'
+PUZZLE_MOVETIME = 400
+PUZZLE_DEPTH = 8
+DEEP_PGN_FILE = 'PGN/sample.pgn'
+DEEP_MOVETIME = 1000
+DEEP_DEPTH = 16
+DEEP_STABLE_DEPTH = 14
+
+sys.path.insert(0, str(ROOT_DIR))
+from chess_artist import BEST, BETTER, PLAN_COMMENT
+
+
+def GetPgnOptions(pgnFile):
+    """ Returns the chess_artist options of the variant of the first game """
+    with open(ROOT_DIR / pgnFile) as f:
+        headers = chess.pgn.read_headers(f)
+    if headers is None or headers.get('Variant', 'Standard').lower() != 'atomic':
+        return []
+
+    if 'FEN' in headers:
+        return ['--game960', '--engineoptions',
+                'UCI_Variant value atomic, UCI_Chess960 value true']
+    return ['--engineoptions', 'UCI_Variant value atomic']
+
+
+def GetCases(gameRange):
+    """ Returns a dict of case name and [chess_artist options, output file name, env] """
+    cases = {}
+    for pgnFile in sorted((ROOT_DIR / 'PGN').glob('*.pgn')):
+        pgnFile = 'PGN/%s' % pgnFile.name
+        cases['analyze-%s' % Path(pgnFile).stem] = [
+            ['--infile', pgnFile, '--job', 'analyze', '--eval', 'search',
+             '--movetime', '10', '--games', gameRange] + GetPgnOptions(pgnFile),
+            'out.pgn', {}]
+
+    cases['analyze-wacnew'] = [
+        ['--infile', EPD_FILE, '--job', 'analyze', '--eval', 'search', '--movetime', '10'],
+        'out.epd', {}]
+    cases['test-wacnew'] = [
+        ['--infile', EPD_FILE, '--job', 'test', '--eval', 'search', '--movetime', '10'],
+        'out.txt', {}]
+
+    # A movetime and depth that give NAGs, complexity and adaptive extensions,
+    # the engine has no latency so the movetime takes no wall time.
+    deepEnv = {'FAKE_ENGINE_DEPTH': str(DEEP_DEPTH),
+               'FAKE_ENGINE_STABLE': str(DEEP_STABLE_DEPTH)}
+    cases['analyze-sample-deep'] = [
+        ['--infile', DEEP_PGN_FILE, '--job', 'analyze', '--eval', 'search',
+         '--movetime', str(DEEP_MOVETIME), '--games', gameRange],
+        'out.pgn', deepEnv]
+    cases['analyze-sample-adaptive'] = [
+        ['--infile', DEEP_PGN_FILE, '--job', 'analyze', '--eval', 'search',
+         '--movetime', str(DEEP_MOVETIME), '--games', gameRange, '--adaptive-movetime'],
+        'out.pgn', deepEnv]
+
+    # The puzzles depend on the time of the info lines in the search, the
+    # fake engine sends no line near a time that createpuzzle checks.
+    cases['createpuzzle-sample'] = [
+        ['--infile', PUZZLE_PGN_FILE, '--job', 'createpuzzle', '--eval', 'search',
+         '--movetime', str(PUZZLE_MOVETIME)],
+        'puzzle.epd',
+        {'FAKE_ENGINE_LATENCY': 'movetime', 'FAKE_ENGINE_DEPTH': str(PUZZLE_DEPTH)}]
+
+    return cases
+
+
+def Normalize(text):
+    """
+    Returns text without the parts that change from run to run, the random
+    comment words, the path of the repo and the lines with the time.
+    """
+    words = '|'.join(re.escape(w) for w in sorted(BEST + BETTER + PLAN_COMMENT, key=len,
+                                                  reverse=True))
+    text = re.sub(words, 'COMMENT', text)
+    text = text.replace(str(ROOT_DIR) + os.sep, '').replace(os.sep, '/')
+    lines = [line for line in text.splitlines()
+             if not line.startswith('Time/pos (sec)')]
+
+    return '\n'.join(lines) + '\n'
+
+
+def GetProfile(output):
+    """ Returns the wall time and the engine time in sec of the --profile report """
+    wall, engineTime = None, 0.0
+    for line in output.splitlines():
+        if line.startswith('Profile, wall time (sec):'):
+            wall = float(line.split()[-1])
+        elif line.startswith('engine '):
+            engineTime += float(line.split()[3])
+
+    return wall, engineTime
+
+
+def RunCase(name, options, outName, env, workers):
+    """ Returns the normalized output and the timing of a case """
+    with tempfile.TemporaryDirectory() as tmpDir:
+        metricsFile = os.path.join(tmpDir, 'metrics.json')
+        options = [str(ROOT_DIR / o) if o.startswith(('PGN/', 'EPD/')) else o
+                   for o in options]
+        cmd = [sys.executable, str(ROOT_DIR / 'chess_artist.py')] + options
+        cmd += ['--outfile', os.path.join(tmpDir, 'out.%s' % outName.split('.')[-1]),
+                '--enginefile', str(FAKE_ENGINE), '--workers', str(workers),
+                '--metrics', metricsFile, '--profile', '--progress-interval', '3600']
+        t0 = time.perf_counter()
+        p = subprocess.run(cmd, cwd=tmpDir, capture_output=True, text=True,
+                           env=dict(os.environ, **env))
+        elapsed = time.perf_counter() - t0
+
+        if p.returncode != 0:
+            raise Exception('%s failed:\n%s%s' % (name, p.stdout, p.stderr))
+
+        with open(os.path.join(tmpDir, outName)) as f:
+            output = Normalize(f.read())
+        with open(metricsFile) as f:
+            metrics = json.load(f)
+
+    wall, engineTime = GetProfile(p.stdout)
+
+    return output, {'elapsed': elapsed, 'wall': wall, 'engine': engineTime,
+                    'positions': metrics['positions'], 'searches': metrics['searches']}
+
+
+def CompareGolden(name, output, isUpdate):
+    """ Returns SAME, DIFF, NEW or UPDATED of output and the golden output """
+    goldenFile = GOLDEN_DIR / ('%s.txt' % name)
+    if isUpdate:
+        GOLDEN_DIR.mkdir(exist_ok=True)
+        goldenFile.write_text(output)
+        return 'UPDATED'
+    if not goldenFile.is_file():
+        return 'NEW'
+    if goldenFile.read_text() == output:
+        return 'SAME'
+
+    diffFile = Path(tempfile.gettempdir()) / ('bench_%s.txt' % name)
+    diffFile.write_text(output)
+    print('%s differs from the golden output, see %s' % (name, diffFile))
+
+    return 'DIFF'
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=('Benchmark the jobs of chess_artist.py with a fake '
+                     'engine and compare their output with the golden output'))
+    parser.add_argument('--case', action='append', default=None,
+                        help='run this case only, can be repeated, (default=all cases)')
+    parser.add_argument('--games', default='1-2',
+                        help='games of every pgn file to analyze, (default=1-2)')
+    parser.add_argument('--workers', default=1, type=int,
+                        help='number of worker processes, (default=1)')
+    parser.add_argument('--update', action='store_true',
+                        help='save the outputs as the new golden outputs')
+    parser.add_argument('--list', action='store_true',
+                        help='show the names of the cases and exit')
+    args = parser.parse_args()
+
+    cases = GetCases(args.games)
+    if args.list:
+        print('\n'.join(cases))
+        return
+    names = args.case or list(cases)
+    for name in names:
+        if name not in cases:
+            raise SystemExit('Unknown case %s, use --list' % name)
+
+    print('%-36s %9s %9s %9s %9s %12s %8s' % (
+        'case', 'positions', 'searches', 'wall', 'engine', 'overhead/pos', 'golden'))
+    isDiff = False
+    for name in names:
+        options, outName, env = cases[name]
+        output, timing = RunCase(name, options, outName, env, args.workers)
+        status = CompareGolden(name, output, args.update)
+        isDiff = isDiff or status == 'DIFF'
+
+        # With workers the engine time is the sum of the workers.
+        positions = max(1, timing['positions'])
+        overhead = max(0.0, timing['wall'] - timing['engine']) if args.workers == 1 else timing['wall']
+        print('%-36s %9d %9d %9.3f %9.3f %9.3f ms %8s' % (
+            name, timing['positions'], timing['searches'], timing['wall'],
+            timing['engine'], 1000 * overhead / positions, status))
+
+    if isDiff:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
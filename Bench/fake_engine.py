@@ -0,0 +1,242 @@
+#!/usr/bin/env python3
+"""
+fake_engine.py
+
+A fake uci engine for the benchmarks of chess_artist.py. It answers uci,
+isready, position, go and eval with canned info lines and a configurable
+latency, so a run does not depend on the hardware or on a real engine.
+The same position and go command always give the same output.
+
+The engine is configured by environment variables:
+  FAKE_ENGINE_NAME     id name of the engine, (default=Fake Engine)
+  FAKE_ENGINE_DEPTH    number of info depth lines per search, (default=10)
+  FAKE_ENGINE_STABLE   last depth where the pv move and score change,
+                       (default=half of FAKE_ENGINE_DEPTH)
+  FAKE_ENGINE_LATENCY  sleep in ms before every info depth line, or
+                       movetime to send the lines at fixed parts of the go
+                       movetime: the first quarter of the depths at 5/32
+                       of the movetime and the rest spread over its second
+                       half. So no line is near a sixteenth or a quarter of
+                       the movetime that --job createpuzzle checks,
+                       (default=0)
+  FAKE_ENGINE_START    sleep in ms before uciok, (default=0)
+
+Requirements:
+    python 3
+    python-chess
+"""
+
+
+import os
+import sys
+import time
+import zlib
+import random
+import select
+
+import chess
+import chess.variant
+
+
+PV_LENGTH = 5
+PIECE_VALUE = {chess.PAWN: 1, chess.KNIGHT: 3, chess.BISHOP: 3,
+               chess.ROOK: 5, chess.QUEEN: 9, chess.KING: 0}
+
+
+class FakeEngine():
+    """
+    The uci loop of the fake engine. The score of a search is the material
+    balance of the side to move plus a random term, the pv move changes up
+    to the stable depth and does not change after that. The replies in
+    the pv only depend on the position and the pv move. A mate in 1 is
+    always found.
+    """
+    def __init__(self):
+        self.name = os.environ.get('FAKE_ENGINE_NAME', 'Fake Engine')
+        self.depth = max(1, int(os.environ.get('FAKE_ENGINE_DEPTH', '10')))
+        self.stableDepth = int(os.environ.get('FAKE_ENGINE_STABLE', '0')) or (self.depth + 1) // 2
+        self.latency = os.environ.get('FAKE_ENGINE_LATENCY', '0')
+        self.startDelay = float(os.environ.get('FAKE_ENGINE_START', '0'))
+        self.variant = 'chess'
+        self.chess960 = False
+        self.multiPv = 1
+        self.board = chess.Board()
+        self.buffer = b''
+
+    def Send(self, msg):
+        sys.stdout.write(msg + '\n')
+        sys.stdout.flush()
+
+    def ReadLine(self, block=True):
+        """ Returns the next input line, '' at eof or None if no line is waiting """
+        while b'\n' not in self.buffer:
+            if not block and not select.select([sys.stdin], [], [], 0)[0]:
+                return None
+            data = os.read(sys.stdin.fileno(), 4096)
+            if not data:
+                return ''
+            self.buffer += data
+        line, self.buffer = self.buffer.split(b'\n', 1)
+        return line.decode().strip()
+
+    def SetOption(self, line):
+        """ Save the options that change the board or the number of pvs """
+        splitLine = line.split()
+        if 'name' not in splitLine or 'value' not in splitLine:
+            return
+        name = ' '.join(splitLine[splitLine.index('name') + 1:splitLine.index('value')])
+        value = ' '.join(splitLine[splitLine.index('value') + 1:])
+        if name.lower() == 'multipv':
+            self.multiPv = max(1, int(value))
+        elif name.lower() == 'uci_variant':
+            self.variant = value.lower()
+        elif name.lower() == 'uci_chess960':
+            self.chess960 = value.lower() == 'true'
+
+    def SetPosition(self, line):
+        """ Set the board from position fen ... or position startpos ... """
+        splitLine = line.split()
+        moves = []
+        if 'moves' in splitLine:
+            moves = splitLine[splitLine.index('moves') + 1:]
+            splitLine = splitLine[:splitLine.index('moves')]
+        fen = ' '.join(splitLine[2:]) if splitLine[1] == 'fen' else chess.STARTING_FEN
+        boardClass = chess.variant.find_variant(self.variant)
+        self.board = boardClass(fen, chess960=self.chess960)
+        for m in moves:
+            self.board.push_uci(m)
+
+    def GetMaterial(self, board):
+        """ Returns the material balance in pawns in wpov """
+        mat = 0
+        for piece in board.piece_map().values():
+            value = PIECE_VALUE[piece.piece_type]
+            mat += value if piece.color == chess.WHITE else -value
+        return mat
+
+    def GetMateMove(self, moves):
+        """ Returns the move in moves that mates at once or None """
+        for move in moves:
+            self.board.push(move)
+            isMate = self.board.is_checkmate()
+            self.board.pop()
+            if isMate:
+                return move
+        return None
+
+    def GetPv(self, move):
+        """ Returns the pv of move, move and up to PV_LENGTH - 1 replies, in uci """
+        board = self.board.copy(stack=False)
+        rnd = random.Random(zlib.crc32(('%s %s' % (board.epd(), move.uci())).encode()))
+        pv = []
+        while len(pv) < PV_LENGTH:
+            pv.append(move.uci())
+            board.push(move)
+            moves = list(board.legal_moves)
+            if not moves or board.is_game_over():
+                break
+            move = moves[rnd.randrange(len(moves))]
+        return pv
+
+    def GetSendTime(self, splitLine, depth):
+        """ Returns the time in seconds after the go command to send the info line of depth """
+        if self.latency != 'movetime':
+            return depth * float(self.latency) / 1000
+        if 'movetime' not in splitLine:
+            return 0.0
+
+        moveTime = int(splitLine[splitLine.index('movetime') + 1]) / 1000
+        earlyDepth = max(1, self.depth // 4)
+        if depth <= earlyDepth:
+            return moveTime * 5 / 32
+        return moveTime * (0.5 + 0.5 * (depth - earlyDepth) / max(1, self.depth - earlyDepth))
+
+    def Go(self, line):
+        """ Send the info lines and the bestmove of a search """
+        splitLine = line.split()
+        moves = list(self.board.legal_moves)
+        if 'searchmoves' in splitLine:
+            searchMoves = splitLine[splitLine.index('searchmoves') + 1:]
+            moves = [m for m in moves if m.uci() in searchMoves] or moves
+        if not moves:
+            self.Send('info depth 0 score cp 0')
+            self.Send('bestmove (none)')
+            return
+
+        rnd = random.Random(zlib.crc32(
+                ('%s %s' % (self.board.epd(), [m.uci() for m in moves])).encode()))
+        material = self.GetMaterial(self.board)
+        if self.board.turn == chess.BLACK:
+            material = -material
+        mateMove = self.GetMateMove(moves)
+        t0 = time.perf_counter()
+
+        move, score = moves[0], 0
+        for depth in range(1, self.depth + 1):
+            # Stop is read between the depths.
+            sleep = t0 + self.GetSendTime(splitLine, depth) - time.perf_counter()
+            if sleep > 0:
+                time.sleep(sleep)
+            pending = self.ReadLine(block=False)
+            if pending == 'stop':
+                break
+            if pending:
+                self.buffer = pending.encode() + b'\n' + self.buffer
+
+            if mateMove is not None:
+                move, scoreText = mateMove, 'mate 1'
+            else:
+                if depth <= self.stableDepth:
+                    move = moves[rnd.randrange(len(moves))]
+                    score = 100 * material + rnd.randint(-60, 60)
+                scoreText = 'cp %d' % score
+            self.Send('info depth %d seldepth %d multipv 1 score %s nodes %d nps 1000000 '
+                      'hashfull %d time %d pv %s' % (depth, depth, scoreText, 1000 * depth,
+                                                     depth, depth, ' '.join(self.GetPv(move))))
+            others = [m for m in moves if m != move][:self.multiPv - 1]
+            for pvNum, other in enumerate(others, 2):
+                self.Send('info depth %d seldepth %d multipv %d score cp %d nodes %d '
+                          'nps 1000000 hashfull %d time %d pv %s' % (
+                              depth, depth, pvNum, score - rnd.randint(1, 90),
+                              1000 * depth, depth, depth, other.uci()))
+        self.Send('bestmove %s' % move.uci())
+
+    def Eval(self):
+        """ Send a stockfish like eval table of the material balance """
+        total = self.GetMaterial(self.board)
+        self.Send('     Term    |    White    |    Black    |    Total   ')
+        self.Send('             |   MG    EG  |   MG    EG  |   MG    EG ')
+        self.Send(' ------------+-------------+-------------+------------')
+        for term in ['Material', 'Imbalance', 'Pawns', 'Knights', 'Bishops', 'Rooks',
+                     'Queens', 'Mobility', 'King safety', 'Threats', 'Passed',
+                     'Space', 'Winnable']:
+            self.Send(' %11s |  0.10  0.20 |  0.05  0.10 |  0.05  0.10' % term)
+        self.Send('')
+        self.Send('Final evaluation: %+0.2f (white side)' % total)
+
+    def Run(self):
+        while True:
+            line = self.ReadLine()
+            if line == '' or line == 'quit':
+                break
+            if line == 'uci':
+                time.sleep(self.startDelay / 1000)
+                self.Send('id name %s' % self.name)
+                self.Send('id author chess-artist')
+                self.Send('option name MultiPV type spin default 1 min 1 max 500')
+                self.Send('option name UCI_Chess960 type check default false')
+                self.Send('uciok')
+            elif line == 'isready':
+                self.Send('readyok')
+            elif line.startswith('setoption '):
+                self.SetOption(line)
+            elif line.startswith('position '):
+                self.SetPosition(line)
+            elif line.startswith('go'):
+                self.Go(line)
+            elif line == 'eval':
+                self.Eval()
+
+
+if __name__ == '__main__':
+    FakeEngine().Run()
@@ -15,15 +15,33 @@ __credits__ = ['aochoam', 'al75an', 'alxlk', 'ddugovic', 'drai8192', 'huytd', 'k
 
 
 import os
-import subprocess
+import sys
+import io
 import argparse
 import random
 import logging
 import time
+import asyncio
+import collections
+import json
+import sqlite3
+import struct
+import hashlib
+import multiprocessing
+import multiprocessing.util
+import concurrent.futures
+import contextlib
+from multiprocessing import shared_memory
 from pathlib import Path  # python 3.4 or later
 
+try:
+    import resource  # not available on windows
+except ImportError:
+    resource = None
+
 import chess.pgn
 import chess.polyglot
+import chess.syzygy
 import chess.variant
 
 
@@ -32,17 +50,38 @@ sr = random.SystemRandom()
 BOOK_MOVE_LIMIT = 30
 BOOK_SEARCH_TIME = 200
 MAX_SCORE = 32000
+TABLEBASE_WIN_SCORE = 20000
 TEST_SEARCH_SCORE = 100000
 TEST_SEARCH_DEPTH = 1000
 EPD_FILE = 1
+EPD_CHUNK_SIZE = 64
 PGN_FILE = 2
 DRAW_SCORE = +0.15
 SLIGHT_SCORE = +0.75
 MODERATE_SCORE = +1.50
 DECISIVE_SCORE = +3.0
 COMPLEXITY_MINIMUM_TIME = 1000
+ADAPTIVE_BASE_TIME = 0.25
+ADAPTIVE_LAST_DEPTHS = 6
+ADAPTIVE_MOVE_CHANGES = 2
+ADAPTIVE_SCORE_SWING = 30
+CONVERGE_MIN_DEPTH = 10
+DECIDED_SCORE_FACTOR = 3
 DEFAULT_HASH = 32
 DEFAULT_THREADS = 1
+EVAL_CACHE_SIZE = 4096
+SEARCH_CACHE_SIZE = 16
+SHARED_SLOT_SIZE = 1024
+SHARED_BUCKET_SLOTS = 4
+ENGINE_TIMEOUT = 60
+ENGINE_STOP_TIMEOUT = 10
+TIME_BUDGET_MIN_MOVETIME = 10
+METRICS_MIN_INTERVAL = 1.0
+RESUME_INDEX_SUFFIX = '.resume'
+PROFILE_PHASES = ['engine sync', 'engine search', 'engine eval', 'uci parsing',
+                  'board', 'san', 'book', 'material', 'output']
+PGN_INDEX_HEADERS = ['White', 'Black', 'Result', 'Variant']
+SEARCH_STAT_NAMES = ['searches', 'nodes', 'time', 'hashfull']
 
 
 BEST = ['Excellent', 'Outstanding', 'Exceptional', 'Striking', 'Priceless',
@@ -61,6 +100,824 @@ def DeleteFile(fn):
         os.remove(fn)
 
 
+class AsyncUciEngine():
+    """
+    The uci protocol of an engine process as coroutines. The engine output
+    is read without blocking, so one event loop can wait on many engines.
+    Every request has a timeout in seconds, a search that does not end in
+    time is stopped. An engine that does not stop is killed.
+    """
+    def __init__(self, eng, engineOptions=None):
+        self.eng = eng
+        self.engineOptions = engineOptions
+        self.p = None
+        self.idName = None
+        self.chess960 = False
+        self.optionChess960 = False
+        self.spawnCnt = 0
+        self.queryCnt = 0
+        self.searchStats = dict.fromkeys(SEARCH_STAT_NAMES, 0)
+
+    def Send(self, msg):
+        """ Send msg to engine """
+        self.p.stdin.write(('%s\n' % msg).encode())
+        logging.debug('>> %s' % msg)
+
+    async def ReadLine(self, timeout=ENGINE_TIMEOUT):
+        """ Returns the next engine output line or None if the engine exits """
+        line = await asyncio.wait_for(self.p.stdout.readline(), timeout)
+        if not line:
+            return None
+        return line.decode(errors='replace').strip()
+
+    async def ReadUntil(self, token, timeout=ENGINE_TIMEOUT):
+        """ Returns the engine output lines before the line that starts with token """
+        lines = []
+        while True:
+            line = await self.ReadLine(timeout)
+            if line is None:
+                return lines
+            logging.debug('<< %s' % line)
+            if line.startswith(token):
+                return lines
+            lines.append(line)
+
+    def IsRunning(self):
+        """ Returns True if the engine process is alive """
+        return self.p is not None and self.p.returncode is None
+
+    async def Start(self):
+        """ Run the engine, send uci and apply the engine options """
+        self.p = await asyncio.create_subprocess_exec(
+            self.eng, stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.STDOUT)
+        self.spawnCnt += 1
+        self.chess960 = False
+        self.Send('uci')
+        for line in await self.ReadUntil('uciok'):
+            if line.startswith('id name '):
+                self.idName = ' '.join(line.split()[2:])
+        self.SetOptions()
+        await self.IsReady()
+
+    async def IsReady(self, timeout=ENGINE_TIMEOUT):
+        """ Send isready and wait for readyok, earlier output is dropped """
+        self.Send('isready')
+        await self.ReadUntil('readyok', timeout)
+
+    def SetOptions(self):
+        """ Set engine options for uci engines """
+        # If nothing is defined, means that the user relies on the default
+        if self.engineOptions is None:
+            return
+
+        for n in self.engineOptions.split(','):
+            value = n.strip()
+            self.Send('setoption name %s' % value)
+            if value.lower().replace(' ', '') == 'uci_chess960valuetrue':
+                self.optionChess960 = True
+                self.chess960 = True
+
+    def SetChess960(self, enable):
+        """ Toggle UCI_Chess960 when the variant of the game changes """
+        enable = enable or self.optionChess960
+        if enable == self.chess960:
+            return
+        self.Send('setoption name UCI_Chess960 value %s' % ('true' if enable else 'false'))
+        self.chess960 = enable
+
+    async def Query(self, chess960=False, newGame=True):
+        """
+        Make the engine ready for a new position. The engine is restarted
+        if it is not running. Pending output from an earlier query is
+        consumed by the isready sync.
+        """
+        self.queryCnt += 1
+        if not self.IsRunning():
+            await self.Start()
+        self.SetChess960(chess960)
+        if newGame:
+            self.Send('ucinewgame')
+        await self.IsReady()
+
+    async def Go(self, fen, limit, timeout=None, onInfo=None):
+        """
+        Search fen with the go limit like 'movetime 1000' and returns the
+        info lines and the bestmove. onInfo is called with every info line,
+        if it returns True the search is stopped. A search that does not
+        end within timeout seconds is also stopped. If there is no bestmove
+        ENGINE_STOP_TIMEOUT seconds after the stop, the engine is killed and
+        an exception is raised, the next query starts a new engine.
+        """
+        self.Send('position fen %s' % fen)
+        self.Send('go %s' % limit)
+
+        loop = asyncio.get_running_loop()
+        deadline = None if timeout is None else loop.time() + timeout
+
+        infoLines, bestMove, isStopped = [], None, False
+        while True:
+            try:
+                line = await self.ReadLine(
+                    ENGINE_STOP_TIMEOUT if isStopped
+                    else None if deadline is None
+                    else max(0, deadline - loop.time()))
+            except asyncio.TimeoutError:
+                if isStopped:
+                    logging.error('Search of fen %s did not stop, kill the engine.' % fen)
+                    await self.Kill()
+                    raise Exception('engine %s did not stop the search of fen %s' % (
+                            self.eng, fen))
+                logging.warning('Search of fen %s timed out, stop it.' % fen)
+                await self.Stop()
+                isStopped = True
+                continue
+
+            if line is None:
+                break
+            if line.startswith('bestmove'):
+                logging.debug('<< %s' % line)
+                splitLine = line.split()
+                bestMove = splitLine[1] if len(splitLine) > 1 else None
+                break
+            if line.startswith('info'):
+                logging.debug('<< %s' % line)
+                infoLines.append(line)
+                if onInfo is not None and not isStopped and onInfo(line):
+                    await self.Stop()
+                    isStopped = True
+
+        self.CountSearchStats(infoLines)
+
+        return infoLines, bestMove
+
+    def CountSearchStats(self, infoLines):
+        """
+        Add the nodes and time of a search from its last info lines to the
+        search stats, the hashfull is the last one reported.
+        """
+        stats = {}
+        for line in infoLines:
+            if ' string ' in line:
+                continue
+            splitLine = line.split()
+            for name in SEARCH_STAT_NAMES[1:]:
+                if name in splitLine[:-1]:
+                    value = splitLine[splitLine.index(name) + 1]
+                    if value.isdigit():
+                        stats[name] = int(value)
+
+        self.searchStats['searches'] += 1
+        self.searchStats['nodes'] += stats.get('nodes', 0)
+        self.searchStats['time'] += stats.get('time', 0)
+        if 'hashfull' in stats:
+            self.searchStats['hashfull'] = stats['hashfull']
+
+    async def Stop(self):
+        """ Stop the search, the bestmove is read by the caller """
+        self.Send('stop')
+        await self.p.stdin.drain()
+
+    async def Eval(self, fen, timeout=ENGINE_TIMEOUT):
+        """ Returns the output lines of the eval command of fen """
+        self.Send('position fen %s' % fen)
+        self.Send('eval')
+
+        # The readyok after eval marks the end of the eval output.
+        self.Send('isready')
+        return await self.ReadUntil('readyok', timeout)
+
+    async def Quit(self, timeout=ENGINE_TIMEOUT):
+        """ Quit the engine """
+        if self.IsRunning():
+            self.Send('quit')
+            try:
+                await asyncio.wait_for(self.p.wait(), timeout)
+            except asyncio.TimeoutError:
+                await self.Kill()
+        self.p = None
+
+    async def Kill(self):
+        """ Kill the engine process, the next query starts a new one """
+        self.p.kill()
+        await self.p.wait()
+        self.p = None
+
+    def GetSpawnsAvoided(self):
+        """ Returns the number of engine process launches that were saved """
+        return max(0, self.queryCnt - self.spawnCnt)
+
+
+class UciEngine():
+    """
+    A uci engine process that is started once and reused by every engine
+    query. The engine options are applied once at start, before every
+    query the engine is synced with ucinewgame and isready. The requests
+    are AsyncUciEngine coroutines run in the event loop of this engine.
+    """
+    def __init__(self, eng, engineOptions=None, profiler=None):
+        self.engine = AsyncUciEngine(eng, engineOptions)
+        self.profiler = profiler or Profiler()
+        self.loop = None
+
+    def Run(self, coro):
+        """ Returns the result of coro run in the event loop of the engine """
+        if self.loop is None:
+            self.loop = asyncio.new_event_loop()
+        return self.loop.run_until_complete(coro)
+
+    @property
+    def idName(self):
+        return self.engine.idName
+
+    @property
+    def spawnCnt(self):
+        return self.engine.spawnCnt
+
+    @property
+    def queryCnt(self):
+        return self.engine.queryCnt
+
+    @property
+    def searchStats(self):
+        return self.engine.searchStats
+
+    def Send(self, msg):
+        """ Send msg to engine """
+        self.engine.Send(msg)
+
+    def Query(self, chess960=False, newGame=True):
+        """ Returns this engine ready for a new position """
+        with self.profiler.Phase('engine sync'):
+            self.Run(self.engine.Query(chess960, newGame))
+        return self
+
+    def Go(self, fen, limit, timeout=None, onInfo=None):
+        """ Returns the info lines and bestmove of a search of fen """
+        with self.profiler.Phase('engine search'):
+            return self.Run(self.engine.Go(fen, limit, timeout, onInfo))
+
+    def Eval(self, fen):
+        """ Returns the output lines of the eval command of fen """
+        with self.profiler.Phase('engine eval'):
+            return self.Run(self.engine.Eval(fen))
+
+    def Quit(self):
+        """ Quit the engine and close the event loop """
+        if self.loop is None:
+            return
+        self.Run(self.engine.Quit())
+        self.loop.close()
+        self.loop = None
+
+    def GetSpawnsAvoided(self):
+        """ Returns the number of engine process launches that were saved """
+        return self.engine.GetSpawnsAvoided()
+
+
+class AnalysisCache():
+    """
+    Search results saved in an sqlite file, so positions that were searched
+    in a previous run are not searched again. A result is found by fen,
+    variant, engine id name, engine options and search limit. It is reused
+    if its depth is the same or more than the requested depth. A result of
+    --time-budget also has the movetime of its search, and it is only
+    reused if that is at least the requested movetime.
+    """
+    def __init__(self, fn, stats=None):
+        self.fn = fn
+        self.stats = stats if stats is not None else multiprocessing.Array('i', 2)
+        self.con = sqlite3.connect(fn, timeout=60, isolation_level=None)
+        self.con.execute('PRAGMA journal_mode=WAL')
+        self.con.execute(
+            'CREATE TABLE IF NOT EXISTS search ('
+            'fen TEXT, variant TEXT, engine TEXT, options TEXT, '
+            'searchlimit TEXT, depth INTEGER, result TEXT, '
+            'PRIMARY KEY (fen, variant, engine, options, searchlimit))')
+
+    @staticmethod
+    def GetKey(fen, variant, engine, options, searchLimit):
+        """ Returns the key of a search, the move counters of fen are not used """
+        return (' '.join(fen.split()[0:4]), variant or 'standard', engine,
+                options or '', searchLimit)
+
+    def Count(self, isHit):
+        """ Update the hit or miss counter shared with the worker processes """
+        with self.stats.get_lock():
+            self.stats[0 if isHit else 1] += 1
+
+    def Get(self, key, depth=0, moveTime=0):
+        """ Returns the saved result of key or None """
+        row = self.con.execute(
+            'SELECT depth, result FROM search WHERE fen=? AND variant=? '
+            'AND engine=? AND options=? AND searchlimit=?', key).fetchone()
+        result = None if row is None else json.loads(row[1])
+        if result is None or row[0] < depth or result.get('movetime', 0) < moveTime:
+            self.Count(False)
+            return None
+
+        self.Count(True)
+        return result
+
+    def Put(self, key, depth, result):
+        """ Save the result of key, a deeper result is not replaced """
+        self.con.execute(
+            'INSERT INTO search VALUES (?, ?, ?, ?, ?, ?, ?) '
+            'ON CONFLICT (fen, variant, engine, options, searchlimit) '
+            'DO UPDATE SET depth=excluded.depth, result=excluded.result '
+            'WHERE excluded.depth >= search.depth',
+            key + (depth, json.dumps(result)))
+
+    def GetHitCnt(self):
+        """ Returns the number of results found in the cache """
+        return self.stats[0]
+
+    def GetMissCnt(self):
+        """ Returns the number of results not found in the cache """
+        return self.stats[1]
+
+    def Close(self):
+        """ Close the cache file """
+        self.con.close()
+
+
+class SharedResultTable():
+    """
+    A fixed size table of engine results in shared memory, used by the
+    worker processes. A result is found by the zobrist hash of the
+    position and a tag like 'standard search movetime 1000'. Every bucket
+    has SHARED_BUCKET_SLOTS slots, when it is full the least recently used
+    slot is replaced. A result that is too big for a slot is not saved, it
+    is counted as a drop.
+    """
+    HEADER = struct.Struct('<QQQQQ')  # clock, buckets, hits, misses, drops
+    SLOT = struct.Struct('<QQH')  # key, last use, result length
+
+    def __init__(self, sizeMb=0, name=None, lock=None):
+        if name is None:
+            slotCnt = max(SHARED_BUCKET_SLOTS,
+                          sizeMb * 1024 * 1024 // SHARED_SLOT_SIZE)
+            bucketCnt = slotCnt // SHARED_BUCKET_SLOTS
+            self.shm = shared_memory.SharedMemory(
+                create=True,
+                size=self.HEADER.size + bucketCnt * SHARED_BUCKET_SLOTS * SHARED_SLOT_SIZE)
+            self.shm.buf[:self.shm.size] = bytes(self.shm.size)
+            self.HEADER.pack_into(self.shm.buf, 0, 1, bucketCnt, 0, 0, 0)
+            self.isOwner = True
+        else:
+            # The table is owned and unlinked by the main process.
+            self.shm = shared_memory.SharedMemory(name=name)
+            self.isOwner = False
+        self.lock = lock if lock is not None else multiprocessing.Lock()
+        self.bucketCnt = self.HEADER.unpack_from(self.shm.buf, 0)[1]
+
+    @staticmethod
+    def GetKey(board, tag):
+        """ Returns the table key of board and tag, 0 is an empty slot """
+        tagHash = int.from_bytes(
+            hashlib.blake2b(tag.encode(), digest_size=8).digest(), 'little')
+        return (chess.polyglot.zobrist_hash(board) ^ tagHash) or 1
+
+    def GetSlotOffsets(self, key):
+        """ Returns the offsets of the slots of the bucket of key """
+        start = (self.HEADER.size +
+                 (key % self.bucketCnt) * SHARED_BUCKET_SLOTS * SHARED_SLOT_SIZE)
+        return range(start, start + SHARED_BUCKET_SLOTS * SHARED_SLOT_SIZE,
+                     SHARED_SLOT_SIZE)
+
+    def Tick(self):
+        """ Returns the clock and advance it, also used as last use of a slot """
+        clock = self.HEADER.unpack_from(self.shm.buf, 0)[0]
+        struct.pack_into('<Q', self.shm.buf, 0, clock + 1)
+        return clock
+
+    def Count(self, isHit=None):
+        """ Update the hit, miss or drop counter in the header, a drop if isHit is None """
+        offset = 32 if isHit is None else 16 if isHit else 24
+        cnt = struct.unpack_from('<Q', self.shm.buf, offset)[0]
+        struct.pack_into('<Q', self.shm.buf, offset, cnt + 1)
+
+    def Get(self, board, tag):
+        """ Returns the result of board and tag or None """
+        key = self.GetKey(board, tag)
+        data = None
+        with self.lock:
+            for offset in self.GetSlotOffsets(key):
+                slotKey, _, length = self.SLOT.unpack_from(self.shm.buf, offset)
+                if slotKey == key:
+                    struct.pack_into('<Q', self.shm.buf, offset + 8, self.Tick())
+                    start = offset + self.SLOT.size
+                    data = bytes(self.shm.buf[start:start + length])
+                    break
+            self.Count(data is not None)
+
+        return None if data is None else json.loads(data)
+
+    def Put(self, board, tag, result):
+        """ Save the result of board and tag, a big result is not saved """
+        key = self.GetKey(board, tag)
+        data = json.dumps(result, separators=(',', ':')).encode()
+        if len(data) > SHARED_SLOT_SIZE - self.SLOT.size:
+            logging.debug('Result is too big for the shared table, %d bytes' % len(data))
+            with self.lock:
+                self.Count()
+            return
+
+        with self.lock:
+            # Use the slot of key, an empty slot or the least recently used.
+            slot, slotUse = None, None
+            for offset in self.GetSlotOffsets(key):
+                slotKey, lastUse, _ = self.SLOT.unpack_from(self.shm.buf, offset)
+                if slotKey == key or slotKey == 0:
+                    slot = offset
+                    break
+                if slotUse is None or lastUse < slotUse:
+                    slot, slotUse = offset, lastUse
+
+            self.SLOT.pack_into(self.shm.buf, slot, key, self.Tick(), len(data))
+            start = slot + self.SLOT.size
+            self.shm.buf[start:start + len(data)] = data
+
+    def GetHitCnt(self):
+        """ Returns the number of results found in the table """
+        return self.HEADER.unpack_from(self.shm.buf, 0)[2]
+
+    def GetMissCnt(self):
+        """ Returns the number of results not found in the table """
+        return self.HEADER.unpack_from(self.shm.buf, 0)[3]
+
+    def GetDropCnt(self):
+        """ Returns the number of results that were too big to save """
+        return self.HEADER.unpack_from(self.shm.buf, 0)[4]
+
+    def Close(self):
+        """ Close the table, the owner also frees the shared memory """
+        self.shm.close()
+        if self.isOwner:
+            self.shm.unlink()
+
+
+class TimeBudget():
+    """
+    A wall clock budget in seconds that is spread over the positions that
+    are not analyzed yet. The movetime of a position is the time left per
+    position, corrected by the ratio of the time the positions took to the
+    movetime they were given. The state is a shared array, so the worker
+    processes use the same budget.
+    """
+    DEADLINE, POSITIONS, USED, GIVEN, PARALLEL = range(5)
+
+    def __init__(self, seconds=0, positions=0, parallel=1, state=None):
+        if state is None:
+            state = multiprocessing.Array(
+                'd', [time.time() + seconds, positions, 0.0, 0.0, parallel])
+        self.state = state
+
+    def GetTimeLeft(self):
+        """ Returns the seconds left before the deadline """
+        return self.state[self.DEADLINE] - time.time()
+
+    def GetMoveTime(self):
+        """ Returns the movetime in ms of the next position """
+        with self.state.get_lock():
+            positions = max(1.0, self.state[self.POSITIONS])
+            used, given = self.state[self.USED], self.state[self.GIVEN]
+            parallel = self.state[self.PARALLEL]
+
+        # Positions also take time outside the engine search, and one
+        # position can have more than one search.
+        ratio = max(0.5, used / given) if given > 0 else 1.0
+        timeLeft = max(0.0, self.GetTimeLeft()) * parallel
+
+        return max(TIME_BUDGET_MIN_MOVETIME, int(1000 * timeLeft / positions / ratio))
+
+    def Update(self, seconds, moveTime):
+        """ A position took seconds, the engine was given moveTime ms """
+        with self.state.get_lock():
+            self.state[self.POSITIONS] -= 1
+            self.state[self.USED] += seconds
+            self.state[self.GIVEN] += moveTime / 1000
+
+    def Skip(self, positions):
+        """ Positions that were counted but will not be analyzed """
+        with self.state.get_lock():
+            self.state[self.POSITIONS] -= positions
+
+
+class Progress():
+    """
+    The number of positions and games done and the engine work, shared
+    with the worker processes. A progress line in the console and the
+    --metrics json file are updated at most once per interval seconds.
+    """
+    START, LAST, TOTAL, POSITIONS, GAMES, SEARCHES, REUSED, ENGINE_TIME, QUEUED = range(9)
+
+    def __init__(self, interval=0, metricsFile=None, total=0, state=None):
+        if state is None:
+            state = multiprocessing.Array('d', [time.time(), 0, total, 0, 0, 0, 0, 0, 0])
+        self.state = state
+        self.interval = interval
+        self.metricsFile = metricsFile
+
+    def Add(self, counts):
+        """ Add counts, a dict of counter index and value, to the counters """
+        with self.state.get_lock():
+            for index, value in counts.items():
+                self.state[index] += value
+
+    def SetQueued(self, queued):
+        """ Save the number of games waiting for a worker """
+        self.state[self.QUEUED] = queued
+
+    def IsDue(self):
+        """ Returns True if the interval has passed since the last report """
+        interval = self.interval if self.interval > 0 else METRICS_MIN_INTERVAL
+        with self.state.get_lock():
+            now = time.time()
+            if now - self.state[self.LAST] < interval:
+                return False
+            self.state[self.LAST] = now
+
+        return True
+
+    def GetMetrics(self, cache=None, sharedTable=None):
+        """ Returns the progress and throughput as a dict """
+        state = self.state[:]
+        elapsed = time.time() - state[self.START]
+        positions, total = int(state[self.POSITIONS]), int(state[self.TOTAL])
+        searches, reused = int(state[self.SEARCHES]), int(state[self.REUSED])
+        rate = positions / elapsed if elapsed > 0 else 0.0
+
+        metrics = {
+            'elapsed': round(elapsed, 1),
+            'games': int(state[self.GAMES]),
+            'positions': positions,
+            'total_positions': total or None,
+            'positions_per_second': round(rate, 3),
+            'searches': searches,
+            'mean_search_ms': round(state[self.ENGINE_TIME] / searches, 1) if searches else None,
+            'search_reuse_rate': round(reused / (searches + reused), 3) if searches + reused else None,
+            'queued_games': int(state[self.QUEUED]),
+            'eta': round((total - positions) / rate, 1) if total and rate > 0 else None}
+        for name, table in [('cache', cache), ('shared_cache', sharedTable)]:
+            if table is not None:
+                lookups = table.GetHitCnt() + table.GetMissCnt()
+                metrics[name + '_hit_rate'] = round(table.GetHitCnt() / lookups, 3) if lookups else None
+        if sharedTable is not None:
+            metrics['shared_cache_drops'] = sharedTable.GetDropCnt()
+
+        return metrics
+
+    def Report(self, cache=None, sharedTable=None, isLast=False):
+        """ Show the progress line and save the metrics file when due """
+        if not isLast and not self.IsDue():
+            return
+
+        metrics = self.GetMetrics(cache, sharedTable)
+        if self.interval > 0 or isLast:
+            print('Progress: games %d, positions %d%s, positions/sec %0.2f, eta (sec) %s' % (
+                metrics['games'], metrics['positions'],
+                '' if metrics['total_positions'] is None else '/%d' % metrics['total_positions'],
+                metrics['positions_per_second'],
+                '-' if metrics['eta'] is None else '%0.0f' % metrics['eta']))
+
+        # Replace the file, so a reader never sees a partly written file.
+        if self.metricsFile is not None:
+            tmpfn = '%s.%d.tmp' % (self.metricsFile, os.getpid())
+            with open(tmpfn, 'w') as f:
+                json.dump(metrics, f, indent=2)
+            os.replace(tmpfn, self.metricsFile)
+
+
+class Profiler():
+    """
+    The number of calls and the time of every phase in PROFILE_PHASES for
+    --profile. The time of a phase that runs inside another phase is only
+    counted in the outer phase. The counts of a worker process are added
+    to the state that is shared with the main process by Flush().
+    """
+    def __init__(self, isEnabled=False, state=None):
+        self.isEnabled = isEnabled
+        if isEnabled and state is None:
+            state = multiprocessing.Array('d', 2 * len(PROFILE_PHASES))
+        self.state = state
+        self.calls = dict.fromkeys(PROFILE_PHASES, 0)
+        self.seconds = dict.fromkeys(PROFILE_PHASES, 0.0)
+        self.isInPhase = False
+        self.t0 = time.perf_counter()
+
+    def Phase(self, name):
+        """ Returns a context manager that counts its time in phase name """
+        if not self.isEnabled or self.isInPhase:
+            return contextlib.nullcontext()
+        return self.TimePhase(name)
+
+    @contextlib.contextmanager
+    def TimePhase(self, name):
+        self.isInPhase = True
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.calls[name] += 1
+            self.seconds[name] += time.perf_counter() - t0
+            self.isInPhase = False
+
+    def Flush(self):
+        """ Add the counts of this process to the shared state """
+        if not self.isEnabled:
+            return
+        with self.state.get_lock():
+            for i, name in enumerate(PROFILE_PHASES):
+                self.state[2*i] += self.calls[name]
+                self.state[2*i + 1] += self.seconds[name]
+        self.calls = dict.fromkeys(PROFILE_PHASES, 0)
+        self.seconds = dict.fromkeys(PROFILE_PHASES, 0.0)
+
+    def Print(self, workers=1):
+        """ Show the time per phase, the cpu time and peak memory """
+        self.Flush()
+        wall = time.perf_counter() - self.t0
+        state = self.state[:]
+
+        print('Profile, wall time (sec): %0.3f' % wall)
+        print('%-14s %9s %10s %7s %9s' % ('phase', 'calls', 'sec', '%wall', 'ms/call'))
+        phaseTime = 0.0
+        for i, name in enumerate(PROFILE_PHASES):
+            calls, seconds = int(state[2*i]), state[2*i + 1]
+            phaseTime += seconds
+            print('%-14s %9d %10.3f %7.1f %9s' % (
+                name, calls, seconds, 100 * seconds / wall if wall > 0 else 0.0,
+                '%0.3f' % (1000 * seconds / calls) if calls else '-'))
+        if workers > 1:
+            print('The phase times are the sum of %d workers.' % workers)
+        else:
+            other = max(0.0, wall - phaseTime)
+            print('%-14s %9s %10.3f %7.1f' % (
+                'other', '', other, 100 * other / wall if wall > 0 else 0.0))
+
+        if resource is None:
+            print('Cpu time and peak memory are not available on this platform.')
+            return
+
+        # ru_maxrss is in bytes on macOS and in kilobytes on linux.
+        rssUnit = 1 if sys.platform == 'darwin' else 1024
+        own = resource.getrusage(resource.RUSAGE_SELF)
+        children = resource.getrusage(resource.RUSAGE_CHILDREN)
+        print('Cpu time (sec), this process: %0.3f, engines and workers: %0.3f' % (
+            own.ru_utime + own.ru_stime, children.ru_utime + children.ru_stime))
+        print('Peak memory (MB), this process: %0.1f, largest engine or worker: %0.1f' % (
+            own.ru_maxrss * rssUnit / 2**20, children.ru_maxrss * rssUnit / 2**20))
+
+
+class ResumeIndex():
+    """
+    A sidecar file of the games in the output pgn file, one line of the
+    header digest, ply count and start and end byte offsets per game. It
+    is used to find the games that are already annotated without parsing
+    the output file. The index is rebuilt from the output file if it is
+    missing, if its last game is not found at its offsets or if the output
+    file goes on after its last game, a game that was appended just before
+    a crash and not added to the index.
+    """
+    def __init__(self, outfn):
+        self.outfn = outfn
+        self.fn = outfn + RESUME_INDEX_SUFFIX
+        self.entries = []
+        self.keys = set()
+        if not Path(outfn).is_file():
+            DeleteFile(self.fn)
+            return
+
+        if Path(self.fn).is_file():
+            with open(self.fn) as f:
+                for line in f:
+                    digest, ply, start, end = line.split()
+                    self.entries.append((digest, int(ply), int(start), int(end)))
+
+        if not self.IsValid():
+            logging.info('Rebuild the resume index %s' % self.fn)
+            self.Rebuild()
+        self.keys = {(digest, ply) for digest, ply, _, _ in self.entries}
+
+    @staticmethod
+    def GetDigest(headers):
+        """ Returns the digest of the headers except the Annotator tag """
+        h = hashlib.blake2b(digest_size=16)
+        for key, value in sorted(headers.items()):
+            if key != 'Annotator':
+                h.update(f'{key}\0{value}\0'.encode())
+        return h.hexdigest()
+
+    def IsValid(self):
+        """ Returns True if the last game of the index ends the output file """
+        if not self.entries:
+            return os.path.getsize(self.outfn) == 0
+
+        digest, _, start, end = self.entries[-1]
+        if end != os.path.getsize(self.outfn):
+            return False
+        with open(self.outfn, encoding='ISO-8859-1') as h:
+            h.seek(start)
+            headers = chess.pgn.read_headers(h)
+
+        return headers is not None and self.GetDigest(headers) == digest
+
+    def Rebuild(self):
+        """ Parse the output file and write the index of its games """
+        self.entries = []
+        with open(self.outfn, encoding='ISO-8859-1') as h:
+            while True:
+                start = h.tell()
+                game = chess.pgn.read_game(h)
+                if game is None:
+                    break
+                self.entries.append((self.GetDigest(game.headers),
+                                     game.end().ply(), start, h.tell()))
+
+        with open(self.fn, 'w') as f:
+            for entry in self.entries:
+                f.write('%s %d %d %d\n' % entry)
+
+    def Contains(self, headers, ply):
+        """ Returns True if the game of headers and ply is in the index """
+        return (self.GetDigest(headers), ply) in self.keys
+
+    def Add(self, headers, ply, start, end):
+        """ Save the game of headers and ply written at start to end """
+        entry = (self.GetDigest(headers), ply, start, end)
+        self.entries.append(entry)
+        self.keys.add(entry[0:2])
+        with open(self.fn, 'a') as f:
+            f.write('%s %d %d %d\n' % entry)
+
+
+class GameWriter():
+    """
+    The text of the game that is being annotated. The moves and comments
+    are collected in memory and the game is appended to the output file
+    with one write, so an interrupted run does not leave a part of a game.
+    """
+    def __init__(self, profiler=None):
+        self.parts = []
+        self.profiler = profiler or Profiler()
+        self.phase = None
+
+    def __enter__(self):
+        self.phase = self.profiler.Phase('output')
+        self.phase.__enter__()
+        return self
+
+    def __exit__(self, *exc):
+        self.phase.__exit__(*exc)
+        return False
+
+    def write(self, text):
+        """ Add text to the game """
+        self.parts.append(text)
+
+    def getvalue(self):
+        """ Returns the text of the game """
+        return ''.join(self.parts)
+
+
+class PgnIndex():
+    """
+    The byte offset, ply count and key headers of every game in a pgn
+    file, one json line per game after a line with the size of the pgn
+    file. It is built with --job buildindex and used to go to a --games
+    range and to select games without reading the pgn file.
+    """
+    def __init__(self, fn, pgnfn):
+        self.fn = fn
+        self.entries = []
+        with open(fn) as f:
+            self.info = json.loads(f.readline())
+            for line in f:
+                self.entries.append(json.loads(line))
+        self.isValid = self.info['size'] == os.path.getsize(pgnfn)
+
+    @staticmethod
+    def Build(pgnfn, fn):
+        """ Read pgnfn once and write its index to fn, returns the number of games """
+        gameCnt = 0
+        with open(pgnfn, encoding='ISO-8859-1') as h, open(fn, 'w') as f:
+            f.write(json.dumps({'pgn': os.path.basename(pgnfn),
+                                'size': os.path.getsize(pgnfn)}) + '\n')
+            while True:
+                offset = h.tell()
+                game = chess.pgn.read_game(h)
+                if game is None:
+                    break
+                gameCnt += 1
+                headers = {key: game.headers[key] for key in PGN_INDEX_HEADERS
+                           if key in game.headers}
+                f.write(json.dumps({'offset': offset, 'ply': game.end().ply(),
+                                    'headers': headers}) + '\n')
+
+        return gameCnt
+
+
 class Analyze():
     """ An object that will read and annotate games in a pgn file """
     def __init__(self, infn, outfn, eng, **opt):
@@ -75,6 +932,7 @@ class Analyze():
         self.jobType = opt['-job']
         self.engineOptions = opt['-engineoptions']
         self.bookFile = opt['-bookfile']
+        self.bookReader = None
         self.depth = opt['-depth']
         self.puzzlefn = opt['-puzzle']
         self.wordyComment = opt['-wordy']
@@ -97,7 +955,6 @@ class Analyze():
         self.whiteMobilityCommentCnt = 0
         self.blackMobilityCommentCnt = 0
         self.writeCnt = 0
-        self.engIdName = self.GetEngineIdName()
         self.matBal = []
         self.matIsSacrificed = False
         self.blunderCnt = {'w': 0, 'b': 0}
@@ -105,21 +962,244 @@ class Analyze():
         self.variantTag = None
         self.game960 = opt['-game960']
         self.puzzleScoreMargin = opt['-puzzle-score-margin']
-        
-    def Send(self, p, msg):
-        """ Send msg to engine """
-        p.stdin.write('%s\n' % msg)
-        logging.debug('>> %s' % msg)
-        
-    def ReadEngineReply(self, p, command):
-        """ Read reply from engine """
-        for eline in iter(p.stdout.readline, ''):
-            line = eline.strip()
-            logging.debug('<< %s' % line)
-            if command == 'uci' and 'uciok' in line:
-                break
-            if command == 'isready' and 'readyok' in line:
-                break
+        self.workers = opt['-workers']
+        self.gameMoveScore = opt['-game-move-score']
+        self.multiPv = opt['-multipv']
+        self.searchMovesCnt = 0
+        self.adaptiveMoveTime = opt['-adaptive-movetime']
+        self.adaptiveCnt = 0
+        self.adaptiveExtendCnt = 0
+        self.adaptiveTimeSaved = 0.0
+        self.convergeDepths = opt['-converge-depths']
+        self.convergeTolerance = opt['-converge-tolerance']
+        self.convergeCnt = 0
+        self.convergeTimeSaved = 0.0
+        self.resumeIndex = None
+        self.gameWriter = None
+        self.jsonlFile = opt['-jsonl']
+        self.gameRecords = []
+        self.gameRange = opt['-games']
+        self.pgnIndexFile = opt['-pgn-index']
+        self.tablebase = None
+        self.tablebaseMaxPieces = 0
+        self.tablebaseCnt = 0
+        self.forcedSkipCnt = 0
+        self.decidedSkipCnt = 0
+        if opt['-syzygy'] is not None:
+            self.tablebase = chess.syzygy.Tablebase()
+            for path in opt['-syzygy'].split(os.pathsep):
+                self.tablebase.add_directory(path)
+            self.tablebaseMaxPieces = max(
+                    (len(name) - 1 for name in self.tablebase.wdl), default=0)
+        self.cacheFile = opt['-cache']
+        self.cache = None
+        if self.cacheFile is not None:
+            self.cache = AnalysisCache(self.cacheFile, opt.get('-cache-stats'))
+        self.sharedCacheMb = opt['-shared-cache-mb']
+        self.sharedTable = None
+        if opt.get('-shared-table') is not None:
+            tableName, tableLock = opt['-shared-table']
+            self.sharedTable = SharedResultTable(name=tableName, lock=tableLock)
+        self.timeBudgetSec = opt['-time-budget']
+        self.timeBudget = None
+        if opt.get('-time-budget-state') is not None:
+            self.timeBudget = TimeBudget(state=opt['-time-budget-state'])
+        self.budgetPos = None
+        self.progressInterval = opt['-progress-interval']
+        self.metricsFile = opt['-metrics']
+        self.progress = None
+        if opt.get('-progress-state') is not None:
+            self.progress = Progress(self.progressInterval, self.metricsFile,
+                                     state=opt['-progress-state'])
+        self.progressCounts = {}
+        self.profiler = Profiler(opt['-profile'], opt.get('-profile-state'))
+        self.evalCache = {}
+        self.searchCache = collections.OrderedDict()
+        self.searchCnt = 0
+        self.searchReuseCnt = 0
+        self.options = opt
+        self.engine = UciEngine(eng, self.engineOptions, self.profiler)
+
+        # With a worker pool this process does not start an engine, the
+        # id name is read from the first worker in CreateWorkerPool().
+        self.engIdName = None
+        if self.workers <= 1 or self.jobType == 'test':
+            self.engIdName = self.GetEngineIdName()
+
+    def GetEngine(self, newGame=True):
+        """ Returns the engine session ready for a new query """
+        return self.engine.Query(self.variantTag == 'chess960', newGame)
+
+    def StartTimeBudget(self, positions):
+        """ Spread the --time-budget over positions that use the engine search """
+        if self.timeBudgetSec <= 0:
+            return
+        if self.evalType != 'search' and self.jobType != 'createpuzzle':
+            return
+
+        self.timeBudget = TimeBudget(self.timeBudgetSec, positions, self.workers)
+        print('Time budget (sec): %0.1f, positions: %d' % (self.timeBudgetSec, positions))
+
+    def UseTimeBudget(self, isLast=False):
+        """
+        Save the time used by the previous position and set the movetime of
+        the next position from the time budget. The movetime is only counted
+        if the engine was used in the previous position.
+        """
+        if self.timeBudget is None:
+            return
+
+        if self.budgetPos is not None:
+            t0, queryCnt = self.budgetPos
+            self.timeBudget.Update(
+                    time.time() - t0,
+                    self.moveTime if self.engine.queryCnt > queryCnt else 0)
+            self.budgetPos = None
+
+        if not isLast:
+            self.moveTime = self.timeBudget.GetMoveTime()
+            self.budgetPos = (time.time(), self.engine.queryCnt)
+
+    def IsProgressUsed(self):
+        """ Returns True if --progress-interval or --metrics is used """
+        return self.progressInterval > 0 or self.metricsFile is not None
+
+    def StartProgress(self, positions=0):
+        """ Start counting the progress of positions to analyze """
+        if self.IsProgressUsed():
+            self.progress = Progress(self.progressInterval, self.metricsFile, positions)
+
+    def CountProgress(self, positions=0, games=0):
+        """
+        Add the positions and games done and the engine work of this
+        process since the last count to the progress, and report it.
+        """
+        if self.progress is None:
+            return
+
+        counts = {Progress.SEARCHES: self.engine.searchStats['searches'],
+                  Progress.ENGINE_TIME: self.engine.searchStats['time'],
+                  Progress.REUSED: self.searchReuseCnt}
+        delta = {index: value - self.progressCounts.get(index, 0)
+                 for index, value in counts.items()}
+        delta.update({Progress.POSITIONS: positions, Progress.GAMES: games})
+        self.progressCounts = counts
+
+        self.progress.Add(delta)
+        self.progress.Report(self.cache, self.sharedTable)
+
+    def EndProgress(self):
+        """ Count the engine work left and report the final progress """
+        if self.progress is None:
+            return
+        self.progress.SetQueued(0)
+        self.CountProgress()
+        self.progress.Report(self.cache, self.sharedTable, isLast=True)
+
+    def PrintVerbose(self, msg):
+        """ Print msg unless the console is throttled with --progress-interval """
+        if self.progressInterval <= 0:
+            print(msg)
+
+    def PrintTimeBudget(self, t0, name):
+        """ Show the time used by name since t0 and the time budget left """
+        if self.timeBudget is None:
+            return
+        print('%s time (sec): %0.1f, time budget left (sec): %0.1f' % (
+            name, time.time() - t0, self.timeBudget.GetTimeLeft()))
+
+    def GetMoveTimeTag(self):
+        """
+        Returns the movetime part of the cache and shared table tags. The
+        movetime of every position differs with --time-budget, so those
+        results are tagged with the budget, the cache also saves the
+        movetime of every result.
+        """
+        if self.timeBudget is not None:
+            return 'movetime budget'
+        return 'movetime %d' % self.moveTime
+
+    def GetAnalysisTimeText(self):
+        """ Returns the analysis time per position of the game header """
+        if self.timeBudget is not None:
+            return 'analysis time per position from a %0.1fs time budget' % self.timeBudgetSec
+        if self.adaptiveMoveTime:
+            return 'analysis %0.1fs to %0.1fs per position' % (
+                    max(1, int(self.moveTime * ADAPTIVE_BASE_TIME))/1000.0,
+                    self.moveTime/1000.0)
+        return 'analysis %0.1fs per position' % (self.moveTime/1000.0)
+
+    def GetGoLimit(self):
+        """ Returns the go command limit from the movetime and depth options """
+        if self.moveTime > 0:
+            if self.depth > 0:
+                return 'movetime %d depth %d' % (self.moveTime, self.depth)
+            return 'movetime %d' % self.moveTime
+        return 'depth %d' % self.depth
+
+    def GetGoTimeout(self):
+        """ Returns the seconds a search can take before it is stopped """
+        if self.moveTime > 0:
+            return self.moveTime / 1000 + ENGINE_TIMEOUT
+        return None
+
+    def CloseEngine(self):
+        """ Quit the engine session and show how many spawns were avoided """
+        self.engine.Quit()
+        logging.info('engine spawns: %d, queries: %d' % (
+            self.engine.spawnCnt, self.engine.queryCnt))
+        # With a worker pool the engines are in the worker processes.
+        if self.engine.spawnCnt > 0:
+            print('Engine spawns: %d, spawns avoided: %d' % (
+                self.engine.spawnCnt, self.engine.GetSpawnsAvoided()))
+        if self.searchReuseCnt:
+            print('Searches: %d, searches reused: %d' % (
+                self.searchCnt, self.searchReuseCnt))
+        if self.searchMovesCnt:
+            print('Game moves searched with searchmoves: %d' % self.searchMovesCnt)
+        if self.adaptiveCnt:
+            print('Adaptive searches: %d, extended: %d, engine time saved (sec): %0.1f' % (
+                self.adaptiveCnt, self.adaptiveExtendCnt, self.adaptiveTimeSaved))
+        if self.convergeDepths > 0:
+            print('Converged searches: %d, engine time saved (sec): %0.1f' % (
+                self.convergeCnt, self.convergeTimeSaved))
+        if self.tablebase is not None:
+            self.tablebase.close()
+            print('Searches skipped by tablebase probes: %d' % self.tablebaseCnt)
+        if self.forcedSkipCnt > 0 or self.decidedSkipCnt > 0:
+            print('Forced moves skipped: %d, decided positions skipped: %d' % (
+                self.forcedSkipCnt, self.decidedSkipCnt))
+        if self.cache is not None:
+            self.cache.Close()
+            print('Cache hits: %d, cache misses: %d' % (
+                self.cache.GetHitCnt(), self.cache.GetMissCnt()))
+        if self.bookReader is not None:
+            self.bookReader.close()
+            self.bookReader = None
+        if self.sharedTable is not None and self.sharedTable.isOwner:
+            print('Shared cache hits: %d, shared cache misses: %d, too big to save: %d' % (
+                self.sharedTable.GetHitCnt(), self.sharedTable.GetMissCnt(),
+                self.sharedTable.GetDropCnt()))
+            self.sharedTable.Close()
+            self.sharedTable = None
+        if self.profiler.isEnabled:
+            # The engines of the epd test are driven by this process.
+            self.profiler.Print(1 if self.jobType == 'test' else self.workers)
+
+    def GetSharedTag(self, tag):
+        """ Returns tag with the variant, the zobrist hash of a board does not have it """
+        return '%s %s' % (self.variantTag or 'standard', tag)
+
+    def GetSharedResult(self, fen, tag):
+        """ Returns the result of fen and tag in the shared table or None """
+        if self.sharedTable is None:
+            return None
+        return self.sharedTable.Get(self.Getboard(fen), self.GetSharedTag(tag))
+
+    def PutSharedResult(self, fen, tag, result):
+        """ Save the result of fen and tag in the shared table """
+        if self.sharedTable is not None:
+            self.sharedTable.Put(self.Getboard(fen), self.GetSharedTag(tag), result)
 
     def GameOver(self, board):
         """
@@ -144,13 +1224,14 @@ class Analyze():
 
     def UciToSanMove(self, fen, uciMove):
         """ Returns san move given fen and uci move """
-        board = self.Getboard(fen)
-
-        return board.san(chess.Move.from_uci(uciMove))
+        with self.profiler.Phase('san'):
+            board = self.Getboard(fen)
+            return board.san(chess.Move.from_uci(uciMove))
 
     def PrintEngineIdName(self):
-        """ Prints engine id name """
-        print('Analyzing engine: %s' %(self.engIdName))
+        """ Prints engine id name, it is not known yet before a worker pool starts """
+        if self.engIdName is not None:
+            print('Analyzing engine: %s' %(self.engIdName))
 
     def GetGoodNag(self, side, posScore, engScore,
                    complexityNumber, moveChanges):
@@ -284,7 +1365,7 @@ class Analyze():
     def WriteSanMove(self, side, moveNumber, sanMove):
         """ Write moves only in the output file """
         # Write the moves
-        with open(self.outfn, 'a+') as f:
+        with self.gameWriter as f:
             self.writeCnt += 1
             if side:
                 f.write('%d. %s ' %(moveNumber, sanMove))
@@ -303,7 +1384,7 @@ class Analyze():
         """
         
         # Write the move and comments
-        with open(self.outfn, 'a+') as f:
+        with self.gameWriter as f:
             self.writeCnt += 1
 
             # If side to move is white
@@ -353,10 +1434,10 @@ class Analyze():
                              sanMove, posScore, engMove,
                              engScore, complexityNumber, moveChanges,
                              pvLine, threatMove):
-        """ Write moves with score and engMove in the output file """
+        """ Write moves with score and engMove in the output file, returns the NAG """
         
         # Write the move and comments
-        with open(self.outfn, 'a+') as f:
+        with self.gameWriter as f:
             self.writeCnt += 1
 
             # If side to move is white
@@ -560,12 +1641,14 @@ class Analyze():
                     self.writeCnt = 0
                     f.write('\n')
 
+        return moveNag
+
     def WriteBookMove(self, side, moveNumber, sanMove, bookMove):
         """ Write moves with book moves in the output file """
         assert bookMove is not None
         
         # Write the move and comments
-        with open(self.outfn, 'a+') as f:
+        with self.gameWriter as f:
             self.writeCnt += 1
 
             # If side to move is white
@@ -587,7 +1670,7 @@ class Analyze():
         assert bookMove is not None
         
         # Write the move and comments
-        with open(self.outfn, 'a+') as f:
+        with self.gameWriter as f:
             self.writeCnt += 1
 
             # If side to move is white
@@ -608,10 +1691,10 @@ class Analyze():
     def WritePosScoreBookMoveEngMove(
             self, side, moveNumber, sanMove, bookMove, posScore, engMove,
             engScore, complexityNumber, moveChanges, pvLine, threatMove):
-        """ Write moves with score and book moves in the output file """
+        """ Write moves with score and book moves in the output file, returns the NAG """
         
         # Write the move and comments
-        with open(self.outfn, 'a+') as f:
+        with self.gameWriter as f:
             self.writeCnt += 1
 
             # If side to move is white
@@ -730,13 +1813,15 @@ class Analyze():
                     self.writeCnt = 0
                     f.write('\n')
 
+        return moveNag
+
     def WriteBookMoveEngMove(
             self, side, moveNumber, sanMove, bookMove, engMove, engScore, pvLine):
         """ Write moves with book moves and eng moves in the output file """
         assert bookMove is not None
         
         # Write the move and comments
-        with open(self.outfn, 'a+') as f:
+        with self.gameWriter as f:
             self.writeCnt += 1
 
             # If side to move is white
@@ -770,7 +1855,7 @@ class Analyze():
         """ Write moves with eng moves in the output file """
         
         # Write the move and comments
-        with open(self.outfn, 'a+') as f:
+        with self.gameWriter as f:
 
             # If side to move is white
             if side:
@@ -790,7 +1875,7 @@ class Analyze():
                     f.write('%d... %s ' % (moveNumber, sanMove))
 
     def WritePosFromNoMoveGame(self, side, moveNumber, engMove, engScore, depth):
-        with open(self.outfn, 'a+') as f:
+        with self.gameWriter as f:
             if side:
                 f.write(f'{moveNumber}. {engMove} {{{engScore}/{depth}}}')
             else:
@@ -799,7 +1884,10 @@ class Analyze():
     def WriteNotation(self, side, fmvn, sanMove, bookMove, posScore,
                       isGameOver, engMove, engScore, complexityNumber,
                       moveChanges, pvLine, threatMove, depth=0):
-        """ Write moves and comments to the output file """
+        """
+        Write moves and comments to the output file, returns the NAG of
+        the move if the engine move is written else None.
+        """
         if isGameOver:
             self.WriteSanMove(side, fmvn, sanMove)
             return
@@ -829,19 +1917,17 @@ class Analyze():
         # (3) Write sanMove, posScore and engMove
         isWritePosScoreEngMove = posScore is not None and bookMove is None and engMove is not None
         if isWritePosScoreEngMove:
-            self.WritePosScoreEngMove(
+            return self.WritePosScoreEngMove(
                 side, fmvn, sanMove, posScore, engMove, engScore, complexityNumber, moveChanges, pvLine, threatMove)
-            return
 
         # (4) Write sanMove, posScore, bookMove and engMove
         isWritePosScoreBookEngMove = (posScore is not None and
                                       bookMove is not None and
                                       engMove is not None)
         if isWritePosScoreBookEngMove:
-            self.WritePosScoreBookMoveEngMove(
+            return self.WritePosScoreBookMoveEngMove(
                 side, fmvn, sanMove, bookMove, posScore, engMove, engScore,
                 complexityNumber, moveChanges, pvLine, threatMove)
-            return
 
         # (5) Write sanMove, bookMove
         isWriteBook = (posScore is None and
@@ -935,23 +2021,85 @@ class Analyze():
             return self.engineName
         
         engineIdName = self.eng[0:-4]
-        
-        p = subprocess.Popen(self.eng, stdin=subprocess.PIPE,
-                             stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
-                             universal_newlines=True, bufsize=1)
-        self.Send(p, 'uci')
-        for eline in iter(p.stdout.readline, ''):
-            line = eline.strip()
-            if 'id name ' in line:
-                idName = line.split()
-                engineIdName = ' '.join(idName[2:])            
-            if 'uciok' in line:           
-                break
-        self.Send(p, 'quit')
-        p.communicate()
+
+        # The id name is saved during the uci handshake of the session.
+        self.GetEngine(newGame=False)
+        if self.engine.idName is not None:
+            engineIdName = self.engine.idName
         
         return engineIdName
     
+    @staticmethod
+    def GetEvalTermValue(value):
+        """ Returns the eval term value in pawn unit or None if not shown """
+        if set(value) <= {'-'}:
+            return None
+        return float(value)
+
+    def GetEvalTrace(self, fen):
+        """
+        Returns the eval trace of fen, a dict with the term table and the
+        final evaluation. The eval command is only sent once per fen, the
+        trace is saved in self.evalCache. This is only applicable for
+        Stockfish engine or engines that returns similar output.
+        Example lines to be parsed:
+            King safety |  3.01  3.87 |  0.08  0.39 |  2.92  3.48
+            Final evaluation: +0.25 (white side)
+        Every term is saved as [white mg, white eg, black mg, black eg,
+        total mg, total eg] in pawn unit, a value not shown is None.
+        """
+        if fen in self.evalCache:
+            logging.info('eval trace of fen %s is in cache' % fen)
+            return self.evalCache[fen]
+
+        trace = self.GetSharedResult(fen, 'eval')
+        if trace is not None:
+            self.evalCache[fen] = trace
+            return trace
+
+        trace = {'terms': {}, 'final': None}
+
+        for line in self.GetEngine().Eval(fen):
+            lowLine = line.lower()
+            if 'final evaluation' in lowLine or 'total evaluation' in lowLine:
+                value = line[lowLine.index('evaluation') + len('evaluation'):]
+                value = value.split('(')[0].replace(':', '').split()
+                try:
+                    trace['final'] = float(value[0])
+                except (IndexError, ValueError):
+                    logging.warning('There is no final evaluation in %s' % line)
+            elif '|' in line:
+                parts = line.split('|')
+                name = parts[0].strip()
+                values = ' '.join(parts[1:]).split()
+                if name == '' or len(values) != 6:
+                    continue
+                try:
+                    trace['terms'][name] = [Analyze.GetEvalTermValue(v) for v in values]
+                except ValueError:
+                    # Table header
+                    continue
+
+        if len(self.evalCache) >= EVAL_CACHE_SIZE:
+            self.evalCache.clear()
+        self.evalCache[fen] = trace
+        self.PutSharedResult(fen, 'eval', trace)
+
+        return trace
+
+    def GetEvalTerm(self, fen, termName):
+        """
+        Returns the values of eval term termName of fen or None if the
+        engine does not show the term. A term like 'Passed pawns' is
+        also found by 'Passed'.
+        """
+        terms = self.GetEvalTrace(fen)['terms']
+        for name, values in terms.items():
+            if name == termName or name.startswith(termName + ' '):
+                return values
+
+        return None
+
     def IsKingSafetyGood(self, nextFen, side):
         """ 
         Returns True if king safety of side not to move is bad. This is only
@@ -961,35 +2109,12 @@ class Analyze():
         """
         logging.info('Check king safety')
         
-        p = subprocess.Popen(self.eng, stdin=subprocess.PIPE,
-                             stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
-                             universal_newlines=True, bufsize=1)
-        
-        self.Send(p, 'uci')
-        self.ReadEngineReply(p, 'uci')      
-        self.Send(p, 'ucinewgame')
-        self.Send(p, 'position fen %s' % nextFen)
-        self.Send(p, 'eval')
-        
-        # Parse the output
-        kingSafetyCommentNext = None
-        for eline in iter(p.stdout.readline, ''):        
-            line = eline.strip()
-            
-            if 'King safety ' in line:
-                kingSafetyCommentNext = line
-                break
-            if 'final evaluation' in line.lower():
-                break
-
-        self.Send(p, 'quit')
-        p.communicate()
-        
-        if kingSafetyCommentNext is None:
+        kingSafetyNext = self.GetEvalTerm(nextFen, 'King safety')
+        if kingSafetyNext is None or kingSafetyNext[4] is None:
             return False
 
         # Net score white POV
-        whiteMgKingSafetyNext = float(kingSafetyCommentNext.split()[9])
+        whiteMgKingSafetyNext = kingSafetyNext[4]
         
         # Evaluate the king safety of side not to move based on curFen
         sideToEvaluate = not side
@@ -1014,35 +2139,11 @@ class Analyze():
             and in pawn unit. 2.92 is 2 plus pawns or almost 3 pawns.
         """
         logging.info('Checking for a good passer')
-        p = subprocess.Popen(self.eng, stdin=subprocess.PIPE,
-                             stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
-                             universal_newlines=True, bufsize=1)
-        self.Send(p, 'uci')
-        self.ReadEngineReply(p, 'uci')
-        self.Send(p, 'ucinewgame')
-        self.Send(p, 'position fen %s' % fen)
-        self.Send(p, 'eval')
-        
-        # Parse the output
-        passedPawnComment = None
-        for eline in iter(p.stdout.readline, ''):        
-            line = eline.strip()
-            logging.info(line)
-            
-            if 'Passed ' in line:
-                passedPawnComment = line
-                break
-            if 'final evaluation' in line.lower():
-                break
-
-        self.Send(p, 'quit')
-        p.communicate()
-        
-        if passedPawnComment is None:
+        passedPawn = self.GetEvalTerm(fen, 'Passed')
+        if passedPawn is None or None in passedPawn[4:]:
             return False
         
-        MgPassedValue = float(passedPawnComment.split()[9])
-        EgPassedValue = float(passedPawnComment.split()[10])
+        MgPassedValue, EgPassedValue = passedPawn[4], passedPawn[5]
         logging.info('mgpassed: %0.1f, egpassed: %0.1f' % (MgPassedValue, EgPassedValue))
         
         if side:
@@ -1065,35 +2166,12 @@ class Analyze():
         """
         MOBILITY_THRESHOLD = 0.5
         logging.info('Checking if side to move has a good mobility')
-        p = subprocess.Popen(self.eng, stdin=subprocess.PIPE,
-                             stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
-                             universal_newlines=True, bufsize=1)
-        self.Send(p, 'uci')
-        self.ReadEngineReply(p, 'uci')
-        self.Send(p, 'ucinewgame')
-        self.Send(p, 'position fen %s' % fen)
-        self.Send(p, 'eval')
-        
-        # Parse the output
-        mobilityComment = None
-        for eline in iter(p.stdout.readline, ''):        
-            line = eline.strip()
-            logging.info(line)
-            
-            if 'Mobility ' in line:
-                mobilityComment = line
-            if 'final evaluation' in line.lower():
-                break
-
-        self.Send(p, 'quit')
-        p.communicate()
-        
-        if mobilityComment is None:
+        mobility = self.GetEvalTerm(fen, 'Mobility')
+        if mobility is None or None in mobility[4:]:
             logging.warning('Mobility comment from eval command is missing.')
             return False
         
-        MgMobilityValue = float(mobilityComment.split()[9])
-        EgMobilityValue = float(mobilityComment.split()[10])
+        MgMobilityValue, EgMobilityValue = mobility[4], mobility[5]
         logging.info('side: %s, mgmob: %0.2f, egmob: %0.2f' % (
             'white' if side else 'black', MgMobilityValue, EgMobilityValue))
         logging.info(f'Good mobility threshold: {MOBILITY_THRESHOLD}')
@@ -1112,28 +2190,81 @@ class Analyze():
         logging.info('The side to move mobility has not passed the good mobility threshold.')
         return False
     
-    def GetPolyglotBookMove(self, fen):
-        """ Returns a move from polyglot book """
-        polyMove = None
-        if self.bookFile is None:
-            return polyMove
+    def GetBookReader(self):
+        """
+        Returns the polyglot book reader, the book is opened once and
+        memory mapped, so the worker processes share its pages.
+        """
+        if self.bookReader is None:
+            self.bookReader = chess.polyglot.open_reader(self.bookFile)
+        return self.bookReader
 
-        # Find the move with highest book weight
-        board = self.Getboard(fen)
+    def GetBookMove(self, board):
+        """ Returns the book move of board with highest weight in san or None """
         bestWeight = -1
-        bestMove = None        
-        with chess.polyglot.open_reader(self.bookFile) as reader:
-            for entry in reader.find_all(board):
-                if entry.weight > bestWeight:
-                    bestWeight = entry.weight
-                    bestMove = str(entry.move)
-                
-        polyMove = bestMove
-                
-        if polyMove is not None:
-            polyMove = self.UciToSanMove(fen, polyMove)
-        
-        return polyMove
+        bestMove = None
+        for entry in self.GetBookReader().find_all(board):
+            if entry.weight > bestWeight:
+                bestWeight = entry.weight
+                bestMove = entry.move
+
+        return None if bestMove is None else board.san(bestMove)
+
+    def GetGameBookMoves(self, game):
+        """
+        Probe the book once for every mainline position of game from move
+        --movestart up to move BOOK_MOVE_LIMIT or --moveend in one pass.
+        Returns a dict of book moves by fen.
+        """
+        bookMoves = {}
+        if self.bookFile is None:
+            return bookMoves
+
+        lastMove = min(BOOK_MOVE_LIMIT, self.analysisMoveEnd)
+        board = game.board()
+        for move in game.mainline_moves():
+            if board.fullmove_number > lastMove:
+                break
+            if board.fullmove_number >= self.analysisMoveStart:
+                bookMove = self.GetBookMove(board)
+                if bookMove is not None:
+                    bookMoves[board.fen()] = bookMove
+            board.push(move)
+
+        return bookMoves
+
+    def GetGamePositions(self, game):
+        """
+        Returns a dict of the number of legal moves and game over flag
+        by fen of every mainline position of game. The legal moves are
+        only generated once per position.
+        """
+        positions = {}
+        board = game.board()
+        isStandard = (self.variantTag is None or self.variantTag.lower() == 'standard'
+                      or self.variantTag == 'chess960')
+        moves = list(game.mainline_moves())
+        for ply in range(len(moves) + 1):
+            legalMoveCnt = board.legal_moves.count()
+            isGameOver = legalMoveCnt == 0 if isStandard else self.GameOver(board)
+            positions[board.fen()] = (legalMoveCnt, isGameOver)
+            if ply < len(moves):
+                board.push(moves[ply])
+
+        return positions
+
+    def IsScoreDecided(self, score):
+        """
+        Returns True if score in pawn unit is a mate score or is far
+        beyond the score where the analysis is stopped. The score of a
+        failed search, TEST_SEARCH_SCORE, is beyond a mate score and is
+        never decided.
+        """
+        if score is None or abs(score) * 100 > MAX_SCORE:
+            return False
+        limit = DECIDED_SCORE_FACTOR * max(self.maxScoreStopAnalysis,
+                                           -self.minScoreStopAnalysis)
+        return abs(score) >= min(limit, MAX_SCORE // 200)
 
     def GetEngineOptionValue(self, optionName):
         """ Returns value str of option given option name """
@@ -1160,26 +2291,6 @@ class Analyze():
 
         return None
 
-    def SetEngineOptions(self, p, engOptionValue):
-        """ Set engine options for uci engines """
-        
-        if self.variantTag == 'chess960':
-            self.Send(p, 'setoption name UCI_Chess960 value true')
-            
-        # If nothing is defined, means that the user relies on the default
-        if engOptionValue is None:
-            return
-
-        # Convert engOptionValue to list
-        if ',' in engOptionValue:
-            engOptionValueList = engOptionValue.split(',')
-            for n in engOptionValueList:
-                value = n.strip()
-                self.Send(p, 'setoption name %s' % value)
-        else:
-            value = engOptionValue.strip()
-            self.Send(p, 'setoption name %s' % value)
-
     def GetStaticEvalAfterMove(self, fen):
         """ 
         Returns static eval by running the engine, setup position fen and
@@ -1189,32 +2300,12 @@ class Analyze():
         logging.info('Get search score after making the game move.')
         score = TEST_SEARCH_SCORE
 
-        p = subprocess.Popen(self.eng, stdin=subprocess.PIPE,
-                             stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
-                             universal_newlines=True, bufsize=1)
-
-        # Send command to engine.
-        self.Send(p, 'uci')
-        self.ReadEngineReply(p, 'uci')
-        self.SetEngineOptions(p, self.engineOptions)
-        self.Send(p, 'isready')
-        self.ReadEngineReply(p, 'isready')
-        self.Send(p, 'ucinewgame')
-        self.Send(p, 'position fen %s' % fen)
-        self.Send(p, 'eval')
-
-        # Parse the output and extract the engine static eval.
-        for eline in iter(p.stdout.readline, ''):        
-            line = eline.strip()
-            if 'final evaluation:' in line.lower() or 'total evaluation:' in line.lower():
-                first = line.split('(')[0]
-                score = float(first.split()[2])
-                logging.info('fen: %s, static score: %0.2f' % (fen, score))
-                break
+        # The final evaluation is from the eval trace of fen.
+        finalEval = self.GetEvalTrace(fen)['final']
+        if finalEval is not None:
+            score = finalEval
+            logging.info('fen: %s, static score: %0.2f' % (fen, score))
                 
-        # Quit the engine
-        self.Send(p, 'quit')
-        p.communicate()
         assert score != TEST_SEARCH_SCORE, 'Error! something is wrong in static eval calculation.'
         return score
 
@@ -1224,139 +2315,487 @@ class Analyze():
         subsequent position.
         """
         logging.debug('Get threat move.')
-        bestMove = None
-        p = subprocess.Popen(self.eng, stdin=subprocess.PIPE,
-                             stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
-                             universal_newlines=True, bufsize=1)
-        self.Send(p, 'uci')
-        self.ReadEngineReply(p, 'uci')
-        self.SetEngineOptions(p, self.engineOptions)
-        self.Send(p, 'isready')
-        self.ReadEngineReply(p, 'isready')
+        threatTag = 'threat ' + self.GetMoveTimeTag()
+        bestMove = self.GetSharedResult(fen, threatTag)
+        if bestMove is not None:
+            return bestMove
 
         # Push null move
         b = self.Getboard(fen)
         b.push(chess.Move.null())
         newFen = b.fen()
         
-        self.Send(p, 'ucinewgame')
-        self.Send(p, 'isready')
-        self.ReadEngineReply(p, 'isready')
-        self.Send(p, 'position fen %s' % newFen)
-        self.Send(p, 'go movetime %d' % self.moveTime)
-
-        for eline in iter(p.stdout.readline, ''):        
-            line = eline.strip()
-            if 'bestmove ' in line:
-                bestMove = line.split()[1]
-                break
-
-        self.Send(p, 'quit')
-        p.communicate()
+        _, bestMove = self.GetEngine().Go(newFen, 'movetime %d' % self.moveTime,
+                                          self.GetGoTimeout())
 
         if bestMove is not None:
             bestMove = self.UciToSanMove(newFen, bestMove)
             logging.info(f'threat move: {bestMove}')
+            self.PutSharedResult(fen, threatTag, bestMove)
         
         return bestMove
 
-    def GetSearchScoreBeforeMove(self, fen, side):
+    def GetSearchLimit(self, multiPv=1):
+        """ Returns the search limit of SearchPosition for the cache and shared table tags """
+        searchLimit = self.GetMoveTimeTag()
+        if multiPv > 1:
+            searchLimit += ' multipv %d' % multiPv
+        if self.adaptiveMoveTime:
+            searchLimit += ' adaptive'
+        if self.convergeDepths > 0:
+            searchLimit += ' converge %d %d' % (self.convergeDepths, self.convergeTolerance)
+        return searchLimit
+
+    def GetCacheKey(self, fen, searchLimit):
+        """ Returns the key of the search of fen with searchLimit in the cache """
+        return self.cache.GetKey(fen, self.variantTag, self.engIdName,
+                                 self.engineOptions, searchLimit)
+
+    def GetCachedResult(self, cacheKey, depth=0):
         """
-        Returns bestmove, score in pawn unit wpov, complexity number,
-        move changes and pv san. 
+        Returns the cached result of cacheKey or None. With --time-budget
+        it must have been searched for at least the movetime of now.
         """
-        logging.info('Get search score before making the game move.')
-        scoreCp = TEST_SEARCH_SCORE
-        pvLine, pvLineSan = None, None
-        searchDepth = 0
-        savedMove = []
-        complexityNumber = 0
-        moveChanges = 0
-        isGetComplexityNumber = (self.jobType == 'analyze' and
-                                 self.moveTime >= COMPLEXITY_MINIMUM_TIME)
-        p = subprocess.Popen(self.eng, stdin=subprocess.PIPE,
-                             stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
-                             universal_newlines=True, bufsize=1)
-        self.Send(p, 'uci')
-        self.ReadEngineReply(p, 'uci')
-        self.SetEngineOptions(p, self.engineOptions)
-        self.Send(p, 'isready')
-        self.ReadEngineReply(p, 'isready')
-        self.Send(p, 'ucinewgame')
-        self.Send(p, 'isready')
-        self.ReadEngineReply(p, 'isready')
-        self.Send(p, 'position fen %s' % fen)
-        self.Send(p, 'go movetime %d' % self.moveTime)
-
-        for eline in iter(p.stdout.readline, ''):        
-            line = eline.strip()
-            # Save pv move per depth
-            if isGetComplexityNumber:
-                if ('info depth ' in line and ' pv ' in line and
-                        not 'upperbound' in line and
-                        not 'lowerbound' in line):
-                    logging.debug('<< %s' % line)
-                    
-                    # Get the depth
-                    splitLine = line.split()
-                    searchDepth = int(splitLine[splitLine.index('depth')+1])
+        return self.cache.Get(cacheKey, depth,
+                              self.moveTime if self.timeBudget is not None else 0)
 
-                    # Get the move and save it
-                    pvMove = splitLine[splitLine.index('pv')+1].strip()
-                    savedMove.append([searchDepth, pvMove])
+    def PutCachedResult(self, cacheKey, depth, result):
+        """ Save result in the cache, with --time-budget with the movetime of its search """
+        if self.timeBudget is not None:
+            result = dict(result, movetime=self.moveTime)
+        self.cache.Put(cacheKey, depth, result)
 
-            # Save pv line
-            if ('info depth ' in line and ' pv ' in line and
-                    not 'upperbound' in line and
-                    not 'lowerbound' in line):
-                splitLine = line.split()
-                pvIndex = splitLine.index('pv')
-                pvLine = splitLine[pvIndex+1:pvIndex+6]
-                searchDepth = int(splitLine[splitLine.index('depth') + 1])
-                    
-            if 'score cp ' in line:
-                splitStr = line.split()
-                scoreIndex = splitStr.index('score')
-                scoreCp = int(splitStr[scoreIndex + 2])
-            elif 'score mate ' in line:
-                splitStr = line.split()
-                scoreIndex = splitStr.index('score')
-                mateInN = int(splitStr[scoreIndex + 2])
+    def SearchPosition(self, fen, multiPv=1):
+        """
+        Search fen for self.moveTime and returns a dict of the bestmove, score
+        in cp from side to move POV, pv line, depth and the pv move per depth.
+        The result is saved, so the position after the game move is only
+        searched once although it is also the position before the next
+        game move. If multiPv is more than 1 the score of the first move of
+        every other pv is also returned in multiPvScore.
+        """
+        if fen in self.searchCache:
+            logging.info('Reuse the search of fen %s' % fen)
+            self.searchReuseCnt += 1
+            self.searchCache.move_to_end(fen)
+            return self.searchCache[fen]
+
+        result = self.ProbeTablebase(fen)
+        if result is not None:
+            self.SaveSearch(fen, result)
+            return result
+
+        searchLimit = self.GetSearchLimit(multiPv)
+        result = self.GetSharedResult(fen, 'search ' + searchLimit)
+        if result is not None:
+            logging.info('Use the shared search of fen %s' % fen)
+            self.SaveSearch(fen, result)
+            return result
+
+        cacheKey = None
+        if self.cache is not None:
+            cacheKey = self.GetCacheKey(fen, searchLimit)
+            result = self.GetCachedResult(cacheKey)
+            if result is not None:
+                logging.info('Use the cached search of fen %s' % fen)
+                self.PutSharedResult(fen, 'search ' + searchLimit, result)
+                self.SaveSearch(fen, result)
+                return result
+
+        if self.adaptiveMoveTime:
+            result = self.AdaptiveSearch(fen, multiPv)
+        else:
+            result = self.RunSearch(fen, self.moveTime, multiPv)
+        bestMove, searchDepth = result['bestmove'], result['depth']
 
-                scoreCp = self.MateDistanceToValue(mateInN)        
+        if bestMove is not None:
+            if cacheKey is not None:
+                self.PutCachedResult(cacheKey, searchDepth, result)
+            self.PutSharedResult(fen, 'search ' + searchLimit, result)
+        self.SaveSearch(fen, result)
 
-            if 'bestmove ' in line:
-                bestMove = line.split()[1]
-                logging.debug('<< %s' % line)
-                break
+        return result
 
-        self.Send(p, 'quit')
-        p.communicate()
+    def GetTablebaseScore(self, board):
+        """
+        Returns the tablebase score in cp of board from side to move POV,
+        or None if it is not found. A win is TABLEBASE_WIN_SCORE less the
+        plies to the next capture or pawn move, and a win or loss that is
+        a draw by the 50 move rule is a draw.
+        """
+        if board.is_checkmate():
+            return -self.MateDistanceToValue(1)
+        if board.is_stalemate() or board.is_insufficient_material():
+            return 0
 
-        # Get the first move of the pvLine, make sure the this move
-        # is the same with the bestMove, if not then set bestMove as pvLine
-        firstPvMove = pvLine[0].strip()
-        if firstPvMove != bestMove:
-            pvLine = []
-            pvLine.append(bestMove)
+        wdl = self.tablebase.get_wdl(board)
+        if wdl is None:
+            return None
+        if abs(wdl) < 2:
+            return 0
 
-        try:
-            board = self.Getboard(fen)
+        dtz = self.tablebase.get_dtz(board)
+        if dtz is None:
+            return None
+        if abs(dtz) + board.halfmove_clock > 100:
+            return 0
 
-            if len(pvLine) % 2 == 0:
-                logging.info('pvLine is even, %s' % pvLine)               
-                pvLine = pvLine[:-1]
-                logging.info('Change to odd, %s' % pvLine)
-                
-            pvLineSan = board.variation_san(
-                    [chess.Move.from_uci(m) for m in pvLine])
-            
-        except:
-            logging.warning('Warning, there is error in pvLine')
-            logging.info('pvLine: %s' % pvLine)
+        if wdl > 0:
+            return TABLEBASE_WIN_SCORE - abs(dtz)
+        return abs(dtz) - TABLEBASE_WIN_SCORE
 
-        if isGetComplexityNumber:
-            complexityNumber, moveChanges = self.GetComplexityNumber(
+    def ProbeTablebase(self, fen):
+        """
+        Returns the search result of fen from the syzygy tablebases, or None
+        if --syzygy is not used or fen is not in the tablebases. The score
+        of every legal move is in multiPvScore.
+        """
+        if self.tablebase is None:
+            return None
+        if self.variantTag is not None and self.variantTag.lower() == 'atomic':
+            return None
+
+        board = self.Getboard(fen)
+        if len(board.piece_map()) > self.tablebaseMaxPieces or board.castling_rights:
+            return None
+
+        scoreCp = self.GetTablebaseScore(board)
+        if scoreCp is None:
+            return None
+
+        bestMove, bestScore, moveScore = None, None, {}
+        for move in board.legal_moves:
+            board.push(move)
+            score = self.GetTablebaseScore(board)
+            board.pop()
+            if score is None:
+                return None
+            moveScore[move.uci()] = -score
+            if bestScore is None or -score > bestScore:
+                bestMove, bestScore = move.uci(), -score
+
+        if bestMove is None:
+            return None
+
+        logging.info('Tablebase score of fen %s: %d' % (fen, scoreCp))
+        self.tablebaseCnt += 1
+
+        return {'bestmove': bestMove, 'score': scoreCp, 'pv': [bestMove],
+                'depth': 0, 'savedMove': [], 'multiPvScore': moveScore}
+
+    def RunSearch(self, fen, moveTime, multiPv=1, newGame=True):
+        """
+        Search fen for moveTime and returns a dict of the bestmove, score in
+        cp from side to move POV, pv line, depth, [depth, pv move, score]
+        per depth and the multiPvScore.
+        """
+        bestMove, scoreCp, pvLine, searchDepth = None, None, None, 0
+        savedMove = []
+        multiPvScore = {}
+
+        engine = self.GetEngine(newGame)
+        if multiPv > 1:
+            engine.Send('setoption name MultiPV value %d' % multiPv)
+        isConverged = self.GetConvergenceCheck()
+        t0 = time.perf_counter()
+        infoLines, bestMove = engine.Go(fen, 'movetime %d' % moveTime,
+                                        self.GetGoTimeout(), isConverged)
+        self.CountConvergence(isConverged, moveTime, time.perf_counter() - t0)
+        self.searchCnt += 1
+
+        with self.profiler.Phase('uci parsing'):
+            for line in infoLines:
+                # Lines of the other pvs only give the score of their first move
+                if ' multipv ' in line:
+                    splitLine = line.split()
+                    pvNum = int(splitLine[splitLine.index('multipv') + 1])
+                    if pvNum > 1:
+                        if (' pv ' in line and not 'upperbound' in line and
+                                not 'lowerbound' in line):
+                            pvMove = splitLine[splitLine.index('pv') + 1]
+                            multiPvScore[pvMove] = self.GetInfoScore(line)
+                        continue
+
+                if ' score ' in line:
+                    scoreCp = self.GetInfoScore(line)
+
+                # Save pv line, pv move and score per depth
+                if ('info depth ' in line and ' pv ' in line and
+                        not 'upperbound' in line and
+                        not 'lowerbound' in line):
+                    splitLine = line.split()
+                    pvIndex = splitLine.index('pv')
+                    pvLine = splitLine[pvIndex+1:pvIndex+6]
+                    searchDepth = int(splitLine[splitLine.index('depth') + 1])
+                    savedMove.append([searchDepth, pvLine[0].strip(), scoreCp])
+
+        if multiPv > 1:
+            engine.Send('setoption name MultiPV value 1')
+
+        return {'bestmove': bestMove, 'score': scoreCp, 'pv': pvLine,
+                'depth': searchDepth, 'savedMove': savedMove,
+                'multiPvScore': multiPvScore}
+
+    def AdaptiveSearch(self, fen, multiPv=1):
+        """
+        Search fen for a part of self.moveTime and only use the rest of the
+        movetime if the position looks complex. The second search does not
+        clear the hash, so it continues from the first one. It still starts
+        again from depth 1, so only its pv move per depth is kept, else the
+        complexity number would count every depth twice.
+        """
+        baseTime = max(1, int(self.moveTime * ADAPTIVE_BASE_TIME))
+        result = self.RunSearch(fen, baseTime, multiPv)
+        self.adaptiveCnt += 1
+
+        if not self.IsSearchComplex(fen, result):
+            self.adaptiveTimeSaved += (self.moveTime - baseTime) / 1000
+            return result
+
+        logging.info('Extend the search of complex fen %s' % fen)
+        self.adaptiveExtendCnt += 1
+        extension = self.RunSearch(fen, self.moveTime - baseTime, multiPv,
+                                   newGame=False)
+        if extension['bestmove'] is None:
+            return result
+
+        extension['multiPvScore'] = dict(result['multiPvScore'],
+                                         **extension['multiPvScore'])
+        return extension
+
+    def IsSearchComplex(self, fen, result):
+        """
+        Returns True if the pv move changes or the score swings in the last
+        depths of the search result. Positions with one legal move, a mate
+        score or a closed center are not complex.
+        """
+        savedMove = result['savedMove'][-ADAPTIVE_LAST_DEPTHS:]
+        if result['bestmove'] is None:
+            return False
+        if result['score'] is not None and abs(result['score']) >= MAX_SCORE // 2:
+            return False
+        if self.Getboard(fen).legal_moves.count() <= 1:
+            return False
+        if self.IsCenterClosed(fen):
+            return False
+
+        # There are not enough depths to tell.
+        if len(savedMove) < 2:
+            return True
+
+        moves = [n[1] for n in savedMove]
+        moveChanges = sum(1 for a, b in zip(moves, moves[1:]) if a != b)
+        scores = [n[2] for n in savedMove if len(n) > 2 and n[2] is not None]
+        scoreSwing = max(scores) - min(scores) if scores else 0
+
+        return (moveChanges >= ADAPTIVE_MOVE_CHANGES or
+                scoreSwing >= ADAPTIVE_SCORE_SWING)
+
+    def GetConvergenceCheck(self):
+        """
+        Returns an onInfo function for the engine Go that returns True to
+        stop the search when the pv move and score have held for
+        self.convergeDepths depths within self.convergeTolerance cp. It
+        returns None if --converge-depths is not used.
+        """
+        if self.convergeDepths <= 0:
+            return None
+
+        history = []  # [depth, pv move, score]
+
+        def IsConverged(line):
+            if ('info depth ' not in line or ' pv ' not in line or
+                    ' score ' not in line or 'upperbound' in line or
+                    'lowerbound' in line):
+                return False
+            splitLine = line.split()
+            if 'multipv' in splitLine and splitLine[splitLine.index('multipv') + 1] != '1':
+                return False
+            depth = int(splitLine[splitLine.index('depth') + 1])
+            if depth < CONVERGE_MIN_DEPTH:
+                return False
+
+            # Only the last pv of a depth is used.
+            if history and history[-1][0] == depth:
+                history.pop()
+            history.append([depth, splitLine[splitLine.index('pv') + 1],
+                            self.GetInfoScore(line)])
+
+            last = history[-self.convergeDepths:]
+            if len(last) < self.convergeDepths:
+                return False
+            scores = [n[2] for n in last]
+            IsConverged.isStopped = (len({n[1] for n in last}) == 1 and
+                                     max(scores) - min(scores) <= self.convergeTolerance)
+            return IsConverged.isStopped
+
+        IsConverged.isStopped = False
+        return IsConverged
+
+    def CountConvergence(self, isConverged, moveTime, elapse):
+        """ Count a search that was stopped by isConverged and the time saved """
+        if isConverged is None or not isConverged.isStopped:
+            return
+        self.convergeCnt += 1
+        if moveTime > 0:
+            self.convergeTimeSaved += max(0.0, moveTime / 1000 - elapse)
+
+    def SaveSearch(self, fen, result):
+        """ Save the search result of fen in the recent searches """
+        if len(self.searchCache) >= SEARCH_CACHE_SIZE:
+            self.searchCache.popitem(last=False)
+        self.searchCache[fen] = result
+
+    def GetInfoScore(self, line):
+        """ Returns the score cp or mate converted to cp of an info line """
+        splitStr = line.split()
+        scoreIndex = splitStr.index('score')
+        if splitStr[scoreIndex + 1] == 'mate':
+            # Convert mate in move number to value
+            return self.MateDistanceToValue(int(splitStr[scoreIndex + 2]))
+        return int(splitStr[scoreIndex + 2])
+
+    def SearchGameMove(self, fen, uciMove):
+        """
+        Search only the game move in fen with go searchmoves and returns
+        its score in cp from side to move POV. There is no ucinewgame,
+        so the engine reuses the hash of the search of fen.
+
+        The rest of the pv after the game move is saved as the search of
+        the position after the game move, so it is not searched again as the
+        position before the next game move. This is also done in multipv
+        mode when the game move is not in the MultiPV lines. Both searches
+        are saved in the cache.
+        """
+        scoreCp, pvLine = None, None
+        savedMove = []
+
+        cacheKey, result = None, None
+        if self.cache is not None:
+            cacheKey = self.GetCacheKey(fen, 'searchmoves %s %s' % (uciMove, self.GetMoveTimeTag()))
+            result = self.GetCachedResult(cacheKey)
+
+        if result is not None:
+            logging.info('Use the cached game move search of fen %s' % fen)
+            scoreCp, pvLine, savedMove = result['score'], result['pv'], result['savedMove']
+        else:
+            infoLines, _ = self.GetEngine(newGame=False).Go(
+                    fen, 'movetime %d searchmoves %s' % (self.moveTime, uciMove),
+                    self.GetGoTimeout())
+            self.searchCnt += 1
+            self.searchMovesCnt += 1
+
+            with self.profiler.Phase('uci parsing'):
+                for line in infoLines:
+                    if (' score ' in line and not 'upperbound' in line and
+                            not 'lowerbound' in line):
+                        scoreCp = self.GetInfoScore(line)
+
+                        # Save the reply, pv and score of the next position per depth
+                        if 'info depth ' in line and ' pv ' in line:
+                            splitLine = line.split()
+                            pvIndex = splitLine.index('pv')
+                            if len(splitLine) > pvIndex + 2:
+                                pvLine = splitLine[pvIndex+2:pvIndex+7]
+                                searchDepth = int(splitLine[splitLine.index('depth') + 1])
+                                savedMove.append([searchDepth - 1, pvLine[0], -scoreCp])
+
+            if cacheKey is not None and scoreCp is not None:
+                self.PutCachedResult(cacheKey, savedMove[-1][0] + 1 if savedMove else 0,
+                                     {'score': scoreCp, 'pv': pvLine, 'savedMove': savedMove})
+
+        if savedMove:
+            board = self.Getboard(fen)
+            board.push_uci(uciMove)
+            nextFen = board.fen()
+            if nextFen not in self.searchCache:
+                searchDepth, bestMove, nextScore = savedMove[-1]
+                result = {'bestmove': bestMove, 'score': nextScore, 'pv': pvLine,
+                          'depth': searchDepth, 'savedMove': savedMove,
+                          'multiPvScore': {}}
+                if self.cache is not None:
+                    self.PutCachedResult(self.GetCacheKey(nextFen, self.GetSearchLimit()),
+                                         searchDepth, result)
+                self.SaveSearch(nextFen, result)
+
+        return scoreCp
+
+    def GetGameMoveScore(self, fen, side, sanMove):
+        """
+        Returns the score of the game move in pawn unit wpov, from the
+        search of fen the position before the game move. In multipv mode
+        the score is taken from the MultiPV lines, if the game move is not
+        in there or in searchmoves mode the game move is searched alone.
+        """
+        multiPv = self.multiPv if self.gameMoveScore == 'multipv' else 1
+        result = self.SearchPosition(fen, multiPv)
+
+        board = self.Getboard(fen)
+        gameMove = board.parse_san(sanMove)
+
+        scoreCp = None
+        if result['bestmove'] is not None and board.parse_uci(result['bestmove']) == gameMove:
+            scoreCp = result['score']
+        else:
+            for pvMove, pvScore in result.get('multiPvScore', {}).items():
+                if board.parse_uci(pvMove) == gameMove:
+                    scoreCp = pvScore
+                    break
+            if scoreCp is None:
+                scoreCp = self.SearchGameMove(fen, board.uci(gameMove))
+
+        if scoreCp is None:
+            return scoreCp
+
+        # Convert score from the point of view of white.
+        if not side:
+            scoreCp = -1 * scoreCp
+
+        # Convert the score to pawn unit in float type
+        return float(scoreCp)/100.0
+
+    def GetSearchScoreBeforeMove(self, fen, side):
+        """
+        Returns bestmove, score in pawn unit wpov, complexity number,
+        move changes and pv san. 
+        """
+        logging.info('Get search score before making the game move.')
+        pvLineSan = None
+        complexityNumber = 0
+        moveChanges = 0
+        isGetComplexityNumber = (self.jobType == 'analyze' and
+                                 self.moveTime >= COMPLEXITY_MINIMUM_TIME)
+
+        result = self.SearchPosition(fen)
+        bestMove, pvLine = result['bestmove'], result['pv']
+        searchDepth, savedMove = result['depth'], result['savedMove']
+        scoreCp = TEST_SEARCH_SCORE if result['score'] is None else result['score']
+
+        # Get the first move of the pvLine, make sure the this move
+        # is the same with the bestMove, if not then set bestMove as pvLine
+        firstPvMove = pvLine[0].strip()
+        if firstPvMove != bestMove:
+            pvLine = []
+            pvLine.append(bestMove)
+
+        try:
+            board = self.Getboard(fen)
+
+            if len(pvLine) % 2 == 0:
+                logging.info('pvLine is even, %s' % pvLine)               
+                pvLine = pvLine[:-1]
+                logging.info('Change to odd, %s' % pvLine)
+                
+            with self.profiler.Phase('san'):
+                pvLineSan = board.variation_san(
+                        [chess.Move.from_uci(m) for m in pvLine])
+            
+        except:
+            logging.warning('Warning, there is error in pvLine')
+            logging.info('pvLine: %s' % pvLine)
+
+        if isGetComplexityNumber:
+            complexityNumber, moveChanges = self.GetComplexityNumber(
                     savedMove, fen)
         bestMove = self.UciToSanMove(fen, bestMove)
         if not side:
@@ -1480,44 +2919,7 @@ class Analyze():
         """ 
         Returns search's score in wpov and in pawn unit.
         """
-        scoreCp = None
-        
-        p = subprocess.Popen(self.eng, stdin=subprocess.PIPE,
-                             stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
-                             universal_newlines=True, bufsize=1)
-        self.Send(p, 'uci')
-        self.ReadEngineReply(p, 'uci')
-        self.SetEngineOptions(p, self.engineOptions)
-        self.Send(p, 'isready')
-        self.ReadEngineReply(p, 'isready')
-        self.Send(p, 'ucinewgame')
-        self.Send(p, 'isready')
-        self.ReadEngineReply(p, 'isready')
-        self.Send(p, 'position fen %s' % fen)
-        self.Send(p, 'go movetime %d' % self.moveTime)
-
-        # Parse the output and extract the engine search score.
-        for eline in iter(p.stdout.readline, ''):        
-            line = eline.strip()                
-            if 'score cp ' in line:
-                splitStr = line.split()
-                scoreIndex = splitStr.index('score')
-                scoreCp = int(splitStr[scoreIndex + 2])
-            if 'score mate ' in line:
-                splitStr = line.split()
-                scoreIndex = splitStr.index('score')
-                mateInN = int(splitStr[scoreIndex + 2])
-
-                # Convert mate in move number to value
-                scoreCp = self.MateDistanceToValue(mateInN)        
-                
-            # Break search when we receive bestmove string from engine
-            if 'bestmove ' in line:
-                logging.info('<< %s' % line)
-                break
-
-        self.Send(p, 'quit')
-        p.communicate()
+        scoreCp = self.SearchPosition(fen)['score']
         
         if scoreCp is None:
             return scoreCp
@@ -1541,38 +2943,31 @@ class Analyze():
         scoreCp = TEST_SEARCH_SCORE
         depthSearched = TEST_SEARCH_DEPTH
 
-        p = subprocess.Popen(self.eng, stdin=subprocess.PIPE,
-                             stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
-                             universal_newlines=True, bufsize=1)
-        self.Send(p, 'uci')
-        self.ReadEngineReply(p, 'uci')
-        self.SetEngineOptions(p, self.engineOptions)
-        self.Send(p, 'isready')
-        self.ReadEngineReply(p, 'isready')
-        self.Send(p, 'ucinewgame')
-        self.Send(p, 'isready')
-        self.ReadEngineReply(p, 'isready')
-        self.Send(p, 'position fen %s' % fen)
-        
-        if self.moveTime > 0:
-            if self.depth > 0:
-                self.Send(p, 'go movetime %d depth %d' % (self.moveTime, self.depth))
-            else:
-                self.Send(p, 'go movetime %d' % self.moveTime)
-        elif self.depth > 0:
-            self.Send(p, 'go depth %d' % self.depth)
-        else:
+        if self.moveTime <= 0 and self.depth <= 0:
             logging.debug('Error, missing movetime and depth')
-            self.Send(p, 'quit')
             return
 
+        cacheKey = None
+        if self.cache is not None:
+            searchLimit = 'epd ' + self.GetMoveTimeTag() if self.moveTime > 0 else 'epd depth'
+            if self.convergeDepths > 0:
+                searchLimit += ' converge %d %d' % (self.convergeDepths, self.convergeTolerance)
+            cacheKey = self.GetCacheKey(fen, searchLimit)
+            result = self.GetCachedResult(cacheKey, self.depth)
+            if result is not None:
+                logging.info('Use the cached search of fen %s' % fen)
+                return (result['depth'], self.moveTime/1000,
+                        self.UciToSanMove(fen, result['bestmove']), result['score'])
+
+        engine = self.GetEngine()
+        isConverged = self.GetConvergenceCheck()
+        t0 = time.perf_counter()
+        infoLines, bestMove = engine.Go(fen, self.GetGoLimit(), self.GetGoTimeout(),
+                                        isConverged)
+        self.CountConvergence(isConverged, self.moveTime, time.perf_counter() - t0)
+
         # Parse the output and extract the engine search, depth and bestmove
-        for eline in iter(p.stdout.readline, ''):        
-            line = eline.strip()
-            if ('bestmove' in line or
-                    ('depth' in line and 'score' in line and 'pv' in line)):
-                logging.debug('<< %s' % line)
-                
+        for line in infoLines:
             if 'score cp ' in line:
                 splitStr = line.split()
                 scoreIndex = splitStr.index('score')
@@ -1589,14 +2984,12 @@ class Analyze():
                 depthIndex = splitStr.index('depth')
                 depthSearched = int(splitStr[depthIndex + 1])                     
 
-            # Break search when we receive bestmove
-            if 'bestmove ' in line:
-                bestMove = line.split()[1]
-                break
-                
-        # Quit the engine
-        self.Send(p, 'quit')
-        p.communicate()
+        if (cacheKey is not None and bestMove is not None and
+                depthSearched != TEST_SEARCH_DEPTH and
+                scoreCp != TEST_SEARCH_SCORE):
+            self.PutCachedResult(cacheKey, depthSearched,
+                                 {'bestmove': bestMove, 'score': scoreCp,
+                                  'depth': depthSearched})
 
         # Convert uci move to san move format.
         bestMove = self.UciToSanMove(fen, bestMove)
@@ -1615,32 +3008,10 @@ class Analyze():
         # Initialize
         scoreP = TEST_SEARCH_SCORE
 
-        # Run the engine.
-        p = subprocess.Popen(self.eng, stdin=subprocess.PIPE,
-                             stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
-                             universal_newlines=True, bufsize=1)
-        self.Send(p, 'uci')
-        self.ReadEngineReply(p, 'uci')
-        self.SetEngineOptions(p, self.engineOptions)
-        self.Send(p, 'isready')
-        self.ReadEngineReply(p, 'isready')
-        self.Send(p, 'ucinewgame')
-        self.Send(p, 'position fen %s' % fen)
-        self.Send(p, 'eval')
-
-        # Parse the output and extract the engine search score, depth and bestmove
-        for eline in iter(p.stdout.readline, ''):        
-            line = eline.strip()                  
-
-            # Break search
-            if 'final evaluation:' in line.lower() or 'total evaluation:' in line.lower():
-                first = line.split('(')[0]
-                scoreP = float(first.split()[2])
-                break
-                
-        # Quit the engine
-        p.stdin.write('quit\n')
-        p.communicate()
+        # The final evaluation is from the eval trace of fen.
+        finalEval = self.GetEvalTrace(fen)['final']
+        if finalEval is not None:
+            scoreP = finalEval
 
         # Verify values to be returned
         assert scoreP != TEST_SEARCH_SCORE, 'Error!, engine failed to return its static eval.'
@@ -1657,7 +3028,7 @@ class Analyze():
         """
         Write termination marker in the output game.
         """
-        with open(self.outfn, 'a') as f:
+        with self.gameWriter as f:
             if self.playerAndOpp is not None:
                 if ((self.color == 'white' and playerColor == 'white') or
                         (self.color == 'black' and playerColor == 'black')):
@@ -1761,424 +3132,712 @@ class Analyze():
         """
         return score if side else -score
 
-    def GameExist(self, header, baseHeader):
+    def AnnotatePgn(self):
+        """ Parse the pgn file and annotate the games """
+        # Get the games that are already in the output pgn file.
+        self.resumeIndex = ResumeIndex(self.outfn)
+
+        # Only the headers of the games that are not selected are read.
+        isSelected = None
+        if (self.player is not None or self.playerAndOpp is not None or
+                self.loss or self.draw):
+            isSelected = self.IsGameSelected
+
+        if self.timeBudgetSec > 0 or self.IsProgressUsed():
+            positions = self.CountPgnPositions(
+                    lambda game: not self.IsGameAnnotated(game), isSelected)
+            self.StartTimeBudget(positions)
+            self.StartProgress(positions)
+
+        # Annotated games from the worker processes in input order.
+        pool, pending = None, collections.deque()
+        if self.workers > 1:
+            pool = self.CreateWorkerPool(isSharedTable=True)
+
+        for gameCnt, game in self.IterPgnGames(isSelected):
+            # Show progress in console.
+            self.PrintVerbose('Annotating game %d...' % (gameCnt))
+
+            if game is None:
+                continue
+
+            # Check if this game is already annotated.
+            if self.IsGameAnnotated(game):
+                logging.info('Skip annotation, game {gameCnt} is already fully annotated.')
+                self.PrintVerbose(f'Skip annotation, game {gameCnt} is already fully annotated.')
+                continue
+
+            if pool is None:
+                start = self.GetOutputSize()
+                self.AnnotateGame(game)
+                self.resumeIndex.Add(game.headers, game.end().ply(),
+                                     start, self.GetOutputSize())
+                self.CountProgress(games=1)
+                continue
+
+            # Keep a limited number of games in flight, the output
+            # is written in input order.
+            pending.append((game, pool.submit(WorkerAnnotateGame, Analyze.GetGameText(game))))
+            while len(pending) >= 2 * self.workers:
+                self.AppendGameText(*pending.popleft())
+            if self.progress is not None:
+                self.progress.SetQueued(len(pending))
+
+        if pool is not None:
+            while pending:
+                self.AppendGameText(*pending.popleft())
+            pool.shutdown()
+
+        self.EndProgress()
+
+    def IsGameAnnotated(self, game):
+        """ Returns True if game is already in the output pgn file """
+        return self.resumeIndex.Contains(game.headers, game.end().ply())
+
+    def GetOutputSize(self):
+        """ Returns the size in bytes of the output file """
+        outfile_path = Path(self.outfn)
+        return outfile_path.stat().st_size if outfile_path.is_file() else 0
+
+    def GetPgnIndex(self):
+        """ Returns the --pgn-index of the input pgn file or None """
+        if self.pgnIndexFile is None:
+            return None
+
+        pgnIndex = PgnIndex(self.pgnIndexFile, self.infn)
+        if not pgnIndex.isValid:
+            logging.info('%s is not the index of %s' % (self.pgnIndexFile, self.infn))
+            print('Warning, %s is not the index of %s, read the games without it.' % (
+                self.pgnIndexFile, self.infn))
+            return None
+
+        return pgnIndex
+
+    def IterPgnGames(self, isSelected=None):
         """
-        Returns true if header is found in baseHeader list.
+        Yields the game number and game of the input pgn file in order,
+        only of the games in the --games range. If isSelected is given the
+        headers are read first, and the game is None without parsing its
+        moves if isSelected(headers) is False. With --pgn-index the offsets
+        and headers are from the index.
         """
-        for g in baseHeader:
-            if g == header:
-                return True
+        first, last = self.gameRange
+        pgnIndex = self.GetPgnIndex()
+        with open(self.infn, encoding='ISO-8859-1') as h:
+            if pgnIndex is not None:
+                entries = pgnIndex.entries[first - 1:last]
+                for gameNum, entry in enumerate(entries, first):
+                    if isSelected is not None and not isSelected(entry['headers']):
+                        yield gameNum, None
+                        continue
+                    h.seek(entry['offset'])
+                    yield gameNum, chess.pgn.read_game(h)
+                return
 
-        return False
+            gameNum = 0
+            while last is None or gameNum < last:
+                gameNum += 1
 
-    def SavegameHeaders(self):
-        gameHeaders = []
+                # Skip the games before the range without parsing them.
+                if gameNum < first:
+                    if not chess.pgn.skip_game(h):
+                        break
+                    continue
 
-        outfile_path = Path(self.outfn)
-        if not outfile_path.is_file():
-            return gameHeaders
+                if isSelected is None:
+                    game = chess.pgn.read_game(h)
+                    if game is None:
+                        break
+                    yield gameNum, game
+                    continue
 
-        with open(self.outfn, encoding='ISO-8859-1') as h:
-            while True:
-                game = chess.pgn.read_game(h)
-                if game is None:
+                offset = h.tell()
+                headers = chess.pgn.read_headers(h)
+                if headers is None:
                     break
+                if not isSelected(headers):
+                    yield gameNum, None
+                    continue
+
+                h.seek(offset)
+                yield gameNum, chess.pgn.read_game(h)
+
+    def CountPgnPositions(self, isGameCounted=None, isSelected=None):
+        """
+        Returns the number of mainline positions of the games in the input
+        pgn file, only of the games where isSelected(headers) and
+        isGameCounted(game) are True.
+        """
+        positions = 0
+        for _, game in self.IterPgnGames(isSelected):
+            if game is None:
+                continue
+            if isGameCounted is None or isGameCounted(game):
+                positions += game.end().ply() - game.ply()
 
-                # Copy game headers except Annotator tag.
-                header = {}
-                for key, value in game.headers.items():
-                    if key != 'Annotator':
-                        header.update({key: value})
+        return positions
 
-                # Add ActualPly header in the game. This is also used to determine
-                # if a game is already fully annotated.
-                header.update({'ActualPly' : str(game.end().ply())})
-                gameHeaders.append(header)
+    def CreateWorkerPool(self, isSharedTable=False):
+        """
+        Returns a process pool of self.workers, every worker process has
+        its own Analyze object and engine session. The shared result table
+        is only created if isSharedTable is True, for the pgn annotation.
+        """
+        workerOptions = dict(self.options)
+        workerOptions.update({'-workers': 1})
+        if self.cache is not None:
+            workerOptions['-cache-stats'] = self.cache.stats
+        if self.timeBudget is not None:
+            workerOptions['-time-budget-state'] = self.timeBudget.state
+        if self.progress is not None:
+            workerOptions['-progress-state'] = self.progress.state
+        if self.profiler.isEnabled:
+            workerOptions['-profile-state'] = self.profiler.state
+        if isSharedTable and self.sharedCacheMb > 0:
+            if self.sharedTable is None:
+                self.sharedTable = SharedResultTable(self.sharedCacheMb)
+            workerOptions['-shared-table'] = (self.sharedTable.shm.name,
+                                              self.sharedTable.lock)
+        print(f'Start {self.workers} workers ...')
+
+        pool = concurrent.futures.ProcessPoolExecutor(
+            max_workers=self.workers, initializer=InitWorker,
+            initargs=(self.infn, self.outfn, self.eng, workerOptions))
+        if self.engIdName is None:
+            self.engIdName = pool.submit(WorkerGetEngineIdName).result()
+            self.PrintEngineIdName()
+
+        return pool
 
-        return gameHeaders
-    
-    def AnnotatePgn(self):
-        """ Parse the pgn file and annotate the games """
+    @staticmethod
+    def GetGameText(game):
+        """ Returns the headers and mainline moves of game as pgn text """
+        exporter = chess.pgn.StringExporter(headers=True, variations=False,
+                                            comments=False)
+        return game.accept(exporter)
+
+    def AnnotateGameToText(self, game):
+        """ Annotate a single game and return the annotated game text """
+        self.gameWriter = GameWriter(self.profiler)
+        try:
+            self.WriteAnnotatedGame(game)
+            return self.gameWriter.getvalue()
+        finally:
+            self.gameWriter = None
+
+    def AppendOutput(self, gameText):
+        """ Append the text of a game to the output file with one write """
+        # Add 2 vertical space when writing a game as interrupted
+        # game may have no space to separate the games.
+        if Path(self.outfn).is_file():
+            gameText = '\n\n' + gameText
+
+        with self.profiler.Phase('output'), open(self.outfn, 'a') as f:
+            f.write(gameText)
+            f.flush()
+            os.fsync(f.fileno())
+
+    def AppendGameText(self, game, future):
+        """
+        Append the annotated game from a worker to the output file, future
+        is the result of the worker.
+        """
+        gameText, records = future.result()
+        start = self.GetOutputSize()
+        self.AppendOutput(gameText)
+        self.resumeIndex.Add(game.headers, game.end().ply(), start,
+                             self.GetOutputSize())
+        self.AppendRecords(records)
+        self.CountProgress(games=1)
+
+    def AppendRecords(self, records):
+        """ Append the json records of the analyzed plies of a game to --jsonl """
+        if self.jsonlFile is None or not records:
+            return
+
+        with open(self.jsonlFile, 'a') as f:
+            for record in records:
+                f.write(json.dumps(record) + '\n')
+
+    def GetSearchStatsSince(self, stats, t0):
+        """
+        Returns the engine searches, nodes, nps, hashfull and engine time
+        in ms since the search stats were stats, and the seconds since t0.
+        """
+        searchStats = self.engine.searchStats
+        nodes = searchStats['nodes'] - stats['nodes']
+        engineTime = searchStats['time'] - stats['time']
+
+        return {'searches': searchStats['searches'] - stats['searches'],
+                'nodes': nodes,
+                'nps': int(1000 * nodes / engineTime) if engineTime > 0 else None,
+                'hashfull': searchStats['hashfull'],
+                'enginetime': engineTime,
+                'elapsed': round(time.time() - t0, 3)}
+
+    def SetVariantTag(self, game):
+        """
+        Get variant name in pgn tag, try to cover as wide as possible.
+        Lichess: Chess960
+        Chess.com: Chess960
+        Winboard/Xboard: fischerandom
+        WeekInChess: chess 960
+        """
+        try:
+            variantTag = game.headers["Variant"]
+            logging.info(f'Actual game Variant tag is {variantTag}.')
+            if variantTag in ['Chess960', 'fischerandom', 'chess 960', 'chess960']:
+                self.variantTag = 'chess960'
+            else:
+                self.variantTag = variantTag
+            logging.info(f'Set variant tag to {self.variantTag}.')
+        except KeyError:
+            logging.info('There is no Variant tag in the game header.')
+        except:
+            logging.exception('Error in getting game variant tag value')
+
+    def IsGameSelected(self, headers):
+        """
+        Returns True if the game of headers passes the --player,
+        --player-and-opp, --color, --loss and --draw filters.
+        """
+        # Analyze games by player
+        if self.player is not None or self.playerAndOpp is not None:
+            playerName = self.player or self.playerAndOpp
+            wplayer = headers['White']
+            bplayer = headers['Black']
+
+            # If color is specified
+            if self.color == 'white' and playerName == bplayer:
+                return False
+            elif self.color == 'black' and playerName == wplayer:
+                return False
+
+            if playerName != wplayer and playerName != bplayer:
+                return False
+
+            if self.loss and not self.draw:
+                gameResult = headers['Result']
+                if not ((playerName == wplayer and gameResult == '0-1') or
+                        (playerName == bplayer and gameResult == '1-0')):
+                    return False
+            elif not self.loss and self.draw:
+                gameResult = headers['Result']
+                if not ((playerName == wplayer and gameResult == '1/2-1/2') or
+                        (playerName == bplayer and gameResult == '1/2-1/2')):
+                    return False
+            elif self.loss and self.draw:
+                gameResult = headers['Result']
+                if not ((playerName == wplayer and gameResult != '1-0') or
+                        (playerName == bplayer and gameResult != '0-1')):
+                    return False
+        else:
+            # Only analyze games with draw results
+            if self.draw and not self.loss:
+                gameResult = headers['Result']
+                if not (gameResult == '1/2-1/2'):
+                    return False
+
+            # Analyze games except draws
+            if not self.draw and self.loss:
+                gameResult = headers['Result']
+                if gameResult == '1/2-1/2' or gameResult == '*':
+                    return False
+
+        return True
+
+    def AnnotateGame(self, game):
+        """ Annotate a single game and append it to the output file """
+        self.AppendOutput(self.AnnotateGameToText(game))
+        self.AppendRecords(self.gameRecords)
+
+    def WriteAnnotatedGame(self, game):
+        """ Annotate a single game and write it to the game writer """
         # Get engine id name for the Annotator tag.
         engineIdName = self.engIdName
-        gameCnt = 0
+        wplayer = game.headers['White']
+        bplayer = game.headers['Black']
 
-        # Save the headers of the output pgn file.
-        outputGameHeaders = self.SavegameHeaders()
+        self.SetVariantTag(game)
 
-        with open(self.infn, encoding='ISO-8859-1') as pgnHandle:
-            while True:
-                game = chess.pgn.read_game(pgnHandle)
-                if game is None:
-                    break
-
-                gameCnt += 1
+        # Reset passed pawn comment every game. Passed pawn comment is
+        # only done once for white and once for black per game
+        self.whitePassedPawnCommentCnt = 0
+        self.blackPassedPawnCommentCnt = 0
+        self.whiteKingSafetyCommentCnt = 0
+        self.blackKingSafetyCommentCnt = 0
+        self.whiteMobilityCommentCnt = 0
+        self.blackMobilityCommentCnt = 0
 
-                # Show progress in console.
-                print('Annotating game %d...' % (gameCnt))
-
-                # Check if this game is already annotated.
-                tmpHeader = {}
-                for key, value in game.headers.items():
-                    if key != 'Annotator':
-                        tmpHeader.update({key: value})
-                tmpHeader.update({'ActualPly': str(game.end().ply())})
-
-                if self.GameExist(tmpHeader, outputGameHeaders):
-                    logging.info('Skip annotation, game {gameCnt} is already fully annotated.')
-                    print(f'Skip annotation, game {gameCnt} is already fully annotated.')
-                    continue
+        # Initialize blunder/bad move counts in every game
+        self.blunderCnt = {'w': 0, 'b': 0}
+        self.badCnt = {'w': 0, 'b': 0}
 
-                # Get variant name in pgn tag, try to cover as wide as possible.
-                # Lichess: Chess960
-                # Chess.com: Chess960
-                # Winboard/Xboard: fischerandom
-                # WeekInChess: chess 960
-                try:
-                    variantTag = game.headers["Variant"]
-                    logging.info(f'Actual game Variant tag is {variantTag}.')
-                    if variantTag in ['Chess960', 'fischerandom', 'chess 960', 'chess960']:
-                        self.variantTag = 'chess960'
-                    else:
-                        self.variantTag = variantTag
-                    logging.info(f'Set variant tag to {self.variantTag}.')
-                except KeyError:
-                    logging.info('There is no Variant tag in the game header.')
-                except:
-                    logging.exception('Error in getting game variant tag value')
-
-                # Analyze games by player
-                if self.player is not None or self.playerAndOpp is not None:
-                    playerName = self.player or self.playerAndOpp
-                    wplayer = game.headers['White']
-                    bplayer = game.headers['Black']
-
-                    # If color is specified
-                    if self.color == 'white' and playerName == bplayer:
-                        continue
-                    elif self.color == 'black' and playerName == wplayer:
-                        continue
+        # The analysis of every ply for --jsonl.
+        self.gameRecords = []
 
-                    if playerName != wplayer and playerName != bplayer:
-                        continue
+        # Used for formatting the output.
+        self.writeCnt = 0
 
-                    if self.loss and not self.draw:
-                        gameResult = game.headers['Result']
-                        if not ((playerName == wplayer and gameResult == '0-1') or
-                                (playerName == bplayer and gameResult == '1-0')):
-                            continue
-                    elif not self.loss and self.draw:
-                        gameResult = game.headers['Result']
-                        if not ((playerName == wplayer and gameResult == '1/2-1/2') or
-                                (playerName == bplayer and gameResult == '1/2-1/2')):
-                            continue
-                    elif self.loss and self.draw:
-                        gameResult = game.headers['Result']
-                        if not ((playerName == wplayer and gameResult != '1-0') or
-                                (playerName == bplayer and gameResult != '0-1')):
-                            continue
+        # Save the tag section of the game.
+        with self.gameWriter as f:
+            for key, value in game.headers.items():
+                f.write('[%s \"%s\"]\n' %(key, value))
+
+        # Write the annotator tag.
+        with self.gameWriter as f:
+            f.write('[Annotator "engine: %s, program: %s %s"]\n\n' %(
+                    engineIdName, __script_name__, __version__))
+
+        # Before the movetext are written, add a comment of whether
+        # move comments are from static or search score of the engine.
+        if self.evalType == 'static':
+            with self.gameWriter as f:
+                f.write('{Move comments are from engine static evaluation.}\n')
+        elif self.evalType == 'search':
+            with self.gameWriter as f:
+                hashValue = self.GetEngineOptionValue('Hash')
+                if hashValue is None:
+                    hashValue = str(DEFAULT_HASH)
+                threadsValue = self.GetEngineOptionValue('Threads')
+                if threadsValue is None:
+                    threadsValue = str(DEFAULT_THREADS)
+
+                # Don't write Hash in the comment if the analyzing engine
+                # is Lc0 or Leela Chess Zero
+                scoreLegend = ('move score is in pawn unit,\n'
+                               'positive is good for white and negative '
+                               'is good for black')
+                if ('lc0' in engineIdName.lower() or
+                        'leela chess zero' in engineIdName.lower()):
+                    f.write('{Threads %s, %s, %s}\n' % (
+                            threadsValue, self.GetAnalysisTimeText(),
+                            scoreLegend))
                 else:
-                    # Only analyze games with draw results
-                    if self.draw and not self.loss:
-                        gameResult = game.headers['Result']
-                        if not (gameResult == '1/2-1/2'):
-                            continue
-
-                    # Analyze games except draws
-                    if not self.draw and self.loss:
-                        gameResult = game.headers['Result']
-                        if gameResult == '1/2-1/2' or gameResult == '*':
-                            continue
-
-                # Reset passed pawn comment every game. Passed pawn comment is
-                # only done once for white and once for black per game
-                self.whitePassedPawnCommentCnt = 0
-                self.blackPassedPawnCommentCnt = 0
-                self.whiteKingSafetyCommentCnt = 0
-                self.blackKingSafetyCommentCnt = 0
-                self.whiteMobilityCommentCnt = 0
-                self.blackMobilityCommentCnt = 0
-
-                # Initialize blunder/bad move counts in every game
-                self.blunderCnt = {'w': 0, 'b': 0}
-                self.badCnt = {'w': 0, 'b': 0}
-
-                # Used for formatting the output.
-                self.writeCnt = 0
-
-                # Save the tag section of the game.
-                outfile_path = Path(self.outfn)
-
-                # Add 2 vertical space when writing a game as interrupted
-                # game may have no space to separate the games.
-                if outfile_path.is_file():
-                    with open(self.outfn, 'a') as f:
-                        f.write('\n\n')
-
-                with open(self.outfn, 'a') as f:
-                    for key, value in game.headers.items():
-                        f.write('[%s \"%s\"]\n' %(key, value))
-
-                # Write the annotator tag.
-                with open(self.outfn, 'a+') as f:
-                    f.write('[Annotator "engine: %s, program: %s %s"]\n\n' %(
-                            engineIdName, __script_name__, __version__))
-
-                # Before the movetext are written, add a comment of whether
-                # move comments are from static or search score of the engine.
-                if self.evalType == 'static':
-                    with open(self.outfn, 'a+') as f:
-                        f.write('{Move comments are from engine static evaluation.}\n')
-                elif self.evalType == 'search':
-                    with open(self.outfn, 'a+') as f:
-                        hashValue = self.GetEngineOptionValue('Hash')
-                        if hashValue is None:
-                            hashValue = str(DEFAULT_HASH)
-                        threadsValue = self.GetEngineOptionValue('Threads')
-                        if threadsValue is None:
-                            threadsValue = str(DEFAULT_THREADS)
-
-                        # Don't write Hash in the comment if the analyzing engine
-                        # is Lc0 or Leela Chess Zero
-                        scoreLegend = ('move score is in pawn unit,\n'
-                                       'positive is good for white and negative '
-                                       'is good for black')
-                        if ('lc0' in engineIdName.lower() or
-                                'leela chess zero' in engineIdName.lower()):
-                            f.write('{Threads %s, analysis %0.1fs per position, %s}\n' % (
-                                    threadsValue, self.moveTime/1000.0,
-                                    scoreLegend))
-                        else:
-                            f.write('{Hash %smb, Threads %s, analysis %0.1fs per position, %s}\n' % (
-                                    hashValue, threadsValue, self.moveTime/1000.0,
-                                    scoreLegend))
-
-                # Save result to be written later as game termination marker.
-                res = game.headers['Result']
-
-                self.matBal = Analyze.SaveMaterialBalance(game)
-                logging.info('Material balance wpov:')
-                logging.info('%s' % self.matBal)
-
-                # Loop thru the moves within this game.
-                gameNode, curFen = game, None
-                while gameNode.variations:
-                    board = gameNode.board()
-                    side = board.turn
-                    fmvn = board.fullmove_number
-                    curFen = board.fen()
-                    nextNode = gameNode.variation(0)
-                    logging.info('game_move: %s, san: %s' % (
-                            nextNode.move, nextNode.san()))
-                    nextFen = nextNode.board().fen()
-                    sanMove = nextNode.san()
-                    complexityNumber, moveChanges = 0, 0
-                    threatMove = None
-                    self.bookMove = None
-                    self.passedPawnIsGood = False
-                    self.kingSafetyIsGood = False
-                    self.mobilityIsGood = False
-                    self.matIsSacrificed = False
-
-                    # If --player is specified
-                    if self.player is not None:
-                        if side and self.player == bplayer or not side and self.player == wplayer:
-                            self.WriteNotation(side, fmvn, sanMove, self.bookMove,
-                                           None, False, None, None, 0, 0,
-                                           None, threatMove)
-                            gameNode = nextNode
-                            continue
-
-                    # Analyze specific color or side to move
-                    if self.color is not None:
-                        isEvaluatePos = False
-                        if self.playerAndOpp is None:
-                            if side and self.color == 'black' or not side and self.color == 'white':
-                                self.WriteNotation(side, fmvn, sanMove, self.bookMove,
-                                               None, False, None, None, 0, 0,
-                                               None, threatMove)
-                                gameNode = nextNode
-                                continue
-                            isEvaluatePos = True
-                        else:
-                            # Analyze position of a player by color and its opp
-                            if self.playerAndOpp == wplayer and self.color == 'white':
-                                isEvaluatePos = True
-                            elif self.playerAndOpp == bplayer and self.color == 'black':
-                                isEvaluatePos = True
-
-                        if not isEvaluatePos:
-                            self.WriteNotation(side, fmvn, sanMove, self.bookMove,
-                                               None, False, None, None, 0, 0,
-                                               None, threatMove)
-                            gameNode = nextNode
-                            continue
-
-                    print('side: %s, move_num: %d' % ('White' if side else 'Black',
-                                                      fmvn))
-
-                    # (1) Check move start
-                    if fmvn < self.analysisMoveStart:
-                        self.WriteNotation(side, fmvn, sanMove, self.bookMove,
-                                           None, False, None, None, 0, 0,
-                                           None, threatMove)
-                        gameNode = nextNode
-                        continue
+                    f.write('{Hash %smb, Threads %s, %s, %s}\n' % (
+                            hashValue, threadsValue, self.GetAnalysisTimeText(),
+                            scoreLegend))
+
+        # Save result to be written later as game termination marker.
+        res = game.headers['Result']
+
+        with self.profiler.Phase('material'):
+            self.matBal = Analyze.SaveMaterialBalance(game)
+        logging.info('Material balance wpov:')
+        logging.info('%s' % self.matBal)
+
+        # Get the book moves of the game before the analysis.
+        with self.profiler.Phase('book'):
+            bookMoves = self.GetGameBookMoves(game)
 
-                    # (1.1) Don't analyze beyond analysis move end
-                    if fmvn > self.analysisMoveEnd:
+        # Get the forced moves and game ends before the analysis.
+        positions = self.GetGamePositions(game)
+        isDecided = False
+
+        # Loop thru the moves within this game.
+        gameNode, curFen = game, None
+        gameT0 = time.time()
+        while gameNode.variations:
+            self.UseTimeBudget()
+            self.CountProgress(positions=1)
+            plyStats, plyT0 = dict(self.engine.searchStats), time.time()
+            with self.profiler.Phase('board'):
+                board = gameNode.board()
+                nextNode = gameNode.variation(0)
+                nextFen = nextNode.board().fen()
+            side = board.turn
+            fmvn = board.fullmove_number
+            curFen = board.fen()
+            with self.profiler.Phase('san'):
+                sanMove = nextNode.san()
+            logging.info('game_move: %s, san: %s' % (nextNode.move, sanMove))
+            complexityNumber, moveChanges = 0, 0
+            threatMove = None
+            self.bookMove = None
+            self.passedPawnIsGood = False
+            self.kingSafetyIsGood = False
+            self.mobilityIsGood = False
+            self.matIsSacrificed = False
+
+            # If --player is specified
+            if self.player is not None:
+                if side and self.player == bplayer or not side and self.player == wplayer:
+                    self.WriteNotation(side, fmvn, sanMove, self.bookMove,
+                                   None, False, None, None, 0, 0,
+                                   None, threatMove)
+                    gameNode = nextNode
+                    continue
+
+            # Analyze specific color or side to move
+            if self.color is not None:
+                isEvaluatePos = False
+                if self.playerAndOpp is None:
+                    if side and self.color == 'black' or not side and self.color == 'white':
                         self.WriteNotation(side, fmvn, sanMove, self.bookMove,
-                                           None, False, None, None, 0, 0,
-                                           None, threatMove)
+                                       None, False, None, None, 0, 0,
+                                       None, threatMove)
                         gameNode = nextNode
                         continue
+                    isEvaluatePos = True
+                else:
+                    # Analyze position of a player by color and its opp
+                    if self.playerAndOpp == wplayer and self.color == 'white':
+                        isEvaluatePos = True
+                    elif self.playerAndOpp == bplayer and self.color == 'black':
+                        isEvaluatePos = True
 
-                    # (1.2) Check if game is over by checkmate or stalemate.
-                    isGameOver = self.GameOver(nextNode.board())
+                if not isEvaluatePos:
+                    self.WriteNotation(side, fmvn, sanMove, self.bookMove,
+                                       None, False, None, None, 0, 0,
+                                       None, threatMove)
+                    gameNode = nextNode
+                    continue
 
-                    # (2) Probe the book file and add the book move as comment to the player move.
-                    if not isGameOver and fmvn <= BOOK_MOVE_LIMIT and self.bookFile is not None:
-                        self.bookMove = self.GetPolyglotBookMove(curFen)
+            self.PrintVerbose('side: %s, move_num: %d' % ('White' if side else 'Black',
+                                              fmvn))
 
-                    # (3) Get the posScore or the score of the player move according to the analyzing engine.
-                    # This can be static eval or search score.
-                    posScore = None
-                    if not isGameOver:
-                        if self.evalType == 'static':
-                            if chess.Board(nextFen).is_check():
-                                posScore = None
-                            else:
-                                posScore = self.GetStaticEvalAfterMove(nextFen)
-                        elif self.evalType == 'search':
-                            posScore = self.GetSearchScoreAfterMove(nextFen, side)
-
-                    # (4) Analyze the position with the engine. Save engine's best move, score, pv line and complexity.
-                    engBestMove, engBestScore, pvLine = None, None, None
-                    if posScore is None or (Analyze.relative_score(side, posScore) < self.maxScoreStopAnalysis and
-                            Analyze.relative_score(side, posScore) > self.minScoreStopAnalysis and
-                            self.jobType == 'analyze'):
-                        engBestMove, engBestScore, complexityNumber, moveChanges, pvLine, _ = self.GetSearchScoreBeforeMove(curFen, side)
-
-                    # Update info in console.
-                    if sanMove == engBestMove:
-                        print(f'Game move: {sanMove} ({engBestScore}), Engine bestmove: {engBestMove} ({engBestScore})')
+            # (1) Check move start
+            if fmvn < self.analysisMoveStart:
+                self.WriteNotation(side, fmvn, sanMove, self.bookMove,
+                                   None, False, None, None, 0, 0,
+                                   None, threatMove)
+                gameNode = nextNode
+                continue
+
+            # (1.1) Don't analyze beyond analysis move end
+            if fmvn > self.analysisMoveEnd:
+                self.WriteNotation(side, fmvn, sanMove, self.bookMove,
+                                   None, False, None, None, 0, 0,
+                                   None, threatMove)
+                gameNode = nextNode
+                continue
+
+            # (1.2) Check if game is over by checkmate or stalemate.
+            isGameOver = positions[nextFen][1]
+
+            # (2) Probe the book file and add the book move as comment to the player move.
+            if not isGameOver and fmvn <= BOOK_MOVE_LIMIT and self.bookFile is not None:
+                self.bookMove = bookMoves.get(curFen)
+
+            # (2.1) Don't use the engine if the game move is the only legal
+            # move or if a previous search has decided the game.
+            isForced = positions[curFen][0] == 1
+            if not isGameOver and (isForced or isDecided):
+                if isForced:
+                    self.forcedSkipCnt += 1
+                else:
+                    self.decidedSkipCnt += 1
+                self.WriteNotation(side, fmvn, sanMove, self.bookMove,
+                                   None, False, None, None, 0, 0,
+                                   None, threatMove)
+                gameNode = nextNode
+                continue
+
+            # (3) Get the posScore or the score of the player move according to the analyzing engine.
+            # This can be static eval or search score.
+            posScore = None
+            if not isGameOver:
+                if self.evalType == 'static':
+                    if chess.Board(nextFen).is_check():
+                        posScore = None
+                    else:
+                        posScore = self.GetStaticEvalAfterMove(nextFen)
+                elif self.evalType == 'search':
+                    if self.gameMoveScore == 'aftermove':
+                        posScore = self.GetSearchScoreAfterMove(nextFen, side)
                     else:
-                        print(f'Game move: {sanMove} ({posScore}), Engine bestmove: {engBestMove} ({engBestScore})')
-
-                    # (5.1) Calculate the threat move if game move and engine best
-                    # move is the same and the position is complex and the engine
-                    # score is not winning or lossing and not white first move
-                    if (moveChanges >= 3 and sanMove == engBestMove and
-                            not nextNode.board().is_check() and
-                            abs(engBestScore) <= 2.0 and not (fmvn == 1 and side)):
-                        threatMove = self.GetThreatMove(nextFen)
-
-                    # (5.2) Check if passed pawn of side to move is good.
-                    if any(s in engineIdName.lower() for s in ['stockfish', 'brainfish']):
-                        if side and self.whitePassedPawnCommentCnt == 0:
-                            self.passedPawnIsGood = self.IsPassedPawnGood(
-                                    curFen, side)
-                        elif not side and self.blackPassedPawnCommentCnt == 0:
-                            self.passedPawnIsGood = self.IsPassedPawnGood(
-                                    curFen, side)
-
-                    if posScore is not None:
-                        # (5.3) Calculate the king safety of the side to move
-                        if any(s in engineIdName.lower() for s in ['stockfish', 'brainfish']):
-                            if not board.is_capture(nextNode.move) and abs(posScore) <= 1.5:
-                                if side and self.whiteKingSafetyCommentCnt == 0:
-                                    self.kingSafetyIsGood = self.IsKingSafetyGood(nextFen, not side)
-                                elif not side and self.blackKingSafetyCommentCnt == 0:
-                                    self.kingSafetyIsGood = self.IsKingSafetyGood(nextFen, not side)
-
-                        # (5.4) Check if mobility of side to move is good. We analyze
-                        # the fen after the game move is made on the board, to get the
-                        # impact of the move on piece mobility.
-                        if any(s in engineIdName.lower() for s in ['stockfish', 'brainfish']):
-                            if abs(posScore) <= 3.0:
-                                if side and self.whiteMobilityCommentCnt == 0:
-                                    self.mobilityIsGood = self.IsMobilityGood(nextFen, side)
-                                elif not side and self.blackMobilityCommentCnt == 0:
-                                    self.mobilityIsGood = self.IsMobilityGood(nextFen, side)
-
-                        # Check if a move sacrifices material
-                        self.matIsSacrificed = False
-                        sacMat = Analyze.GetSacrificedMaterial(nextFen, self.matBal)
-                        if abs(sacMat) > 0 and Analyze.relative_score(side, posScore) - abs(sacMat) > 0:
-                            self.matIsSacrificed = True
-
-                    # (6) Write moves and comments.
+                        posScore = self.GetGameMoveScore(curFen, side, sanMove)
+
+            # (4) Analyze the position with the engine. Save engine's best move, score, pv line and complexity.
+            engBestMove, engBestScore, pvLine, depth = None, None, None, None
+            if posScore is None or (Analyze.relative_score(side, posScore) < self.maxScoreStopAnalysis and
+                    Analyze.relative_score(side, posScore) > self.minScoreStopAnalysis and
+                    self.jobType == 'analyze'):
+                engBestMove, engBestScore, complexityNumber, moveChanges, pvLine, depth = self.GetSearchScoreBeforeMove(curFen, side)
+            isDecided = self.evalType == 'search' and (
+                    self.IsScoreDecided(posScore) or self.IsScoreDecided(engBestScore))
+
+            # Update info in console.
+            if sanMove == engBestMove:
+                self.PrintVerbose(f'Game move: {sanMove} ({engBestScore}), Engine bestmove: {engBestMove} ({engBestScore})')
+            else:
+                self.PrintVerbose(f'Game move: {sanMove} ({posScore}), Engine bestmove: {engBestMove} ({engBestScore})')
+
+            # (5.1) Calculate the threat move if game move and engine best
+            # move is the same and the position is complex and the engine
+            # score is not winning or lossing and not white first move
+            if (moveChanges >= 3 and sanMove == engBestMove and
+                    not nextNode.board().is_check() and
+                    abs(engBestScore) <= 2.0 and not (fmvn == 1 and side)):
+                threatMove = self.GetThreatMove(nextFen)
+
+            # (5.2) Check if passed pawn of side to move is good.
+            if any(s in engineIdName.lower() for s in ['stockfish', 'brainfish']):
+                if side and self.whitePassedPawnCommentCnt == 0:
+                    self.passedPawnIsGood = self.IsPassedPawnGood(
+                            curFen, side)
+                elif not side and self.blackPassedPawnCommentCnt == 0:
+                    self.passedPawnIsGood = self.IsPassedPawnGood(
+                            curFen, side)
+
+            if posScore is not None:
+                # (5.3) Calculate the king safety of the side to move
+                if any(s in engineIdName.lower() for s in ['stockfish', 'brainfish']):
+                    if not board.is_capture(nextNode.move) and abs(posScore) <= 1.5:
+                        if side and self.whiteKingSafetyCommentCnt == 0:
+                            self.kingSafetyIsGood = self.IsKingSafetyGood(nextFen, not side)
+                        elif not side and self.blackKingSafetyCommentCnt == 0:
+                            self.kingSafetyIsGood = self.IsKingSafetyGood(nextFen, not side)
+
+                # (5.4) Check if mobility of side to move is good. We analyze
+                # the fen after the game move is made on the board, to get the
+                # impact of the move on piece mobility.
+                if any(s in engineIdName.lower() for s in ['stockfish', 'brainfish']):
+                    if abs(posScore) <= 3.0:
+                        if side and self.whiteMobilityCommentCnt == 0:
+                            self.mobilityIsGood = self.IsMobilityGood(nextFen, side)
+                        elif not side and self.blackMobilityCommentCnt == 0:
+                            self.mobilityIsGood = self.IsMobilityGood(nextFen, side)
+
+                # Check if a move sacrifices material
+                self.matIsSacrificed = False
+                with self.profiler.Phase('material'):
+                    sacMat = Analyze.GetSacrificedMaterial(nextFen, self.matBal)
+                if abs(sacMat) > 0 and Analyze.relative_score(side, posScore) - abs(sacMat) > 0:
+                    self.matIsSacrificed = True
+
+            # (6) Write moves and comments.
+            moveNag = self.WriteNotation(side, fmvn, sanMove, self.bookMove,
+                                         posScore, isGameOver,
+                                         engBestMove, engBestScore,
+                                         complexityNumber, moveChanges,
+                                         pvLine, threatMove)
+
+            # (7) Save the analysis and the engine work of this ply for --jsonl.
+            if self.jsonlFile is not None:
+                record = {'event': game.headers.get('Event'),
+                          'round': game.headers.get('Round'),
+                          'white': wplayer, 'black': bplayer,
+                          'move': fmvn, 'side': 'white' if side else 'black',
+                          'san': sanMove, 'fen': curFen, 'book': self.bookMove,
+                          'score': posScore, 'bestmove': engBestMove,
+                          'bestscore': engBestScore, 'pv': pvLine, 'depth': depth,
+                          'complexity': complexityNumber, 'movechanges': moveChanges,
+                          'nag': None if moveNag == '$0' else moveNag,
+                          'threat': threatMove}
+                record.update(self.GetSearchStatsSince(plyStats, plyT0))
+                self.gameRecords.append(record)
+            gameNode = nextNode
+
+        self.UseTimeBudget(isLast=True)
+        self.PrintTimeBudget(gameT0, 'Game')
+
+        if curFen is None:
+            logging.info('This game has no move.')
+            board = gameNode.board()
+
+            try:
+                res = gameNode.headers['Result']
+            except:
+                res = '*'
+
+            isGameOver = self.GameOver(board)
+            side = board.turn
+            fmvn = board.fullmove_number
+            sanMove = None
+            self.bookMove = None # Don't use a book just analyze.
+            posScore = None
+            if not isGameOver:
+                engBestMove, engBestScore, pvLine, threatMove = None, None, None, None
+                if self.jobType == 'analyze':
+                    engBestMove, engBestScore, complexityNumber, moveChanges, pvLine, depth = \
+                        self.GetSearchScoreBeforeMove(board.fen(), side)
                     self.WriteNotation(side, fmvn, sanMove, self.bookMove,
                                        posScore, isGameOver,
                                        engBestMove, engBestScore,
                                        complexityNumber, moveChanges,
-                                       pvLine, threatMove)
-                    gameNode = nextNode
+                                       pvLine, threatMove, depth)
+                    with self.gameWriter as w:
+                        w.write(f' {res} \n\n')
+        else:
+            # Write blunder/bad counts, and game termination marker to output file.
+            pColor = None
+            if self.player is not None:
+                pColor = 'white' if self.player == wplayer else 'black'
+            elif self.playerAndOpp is not None:
+                pColor = 'white' if self.playerAndOpp == wplayer else 'black'
+            self.WriteTerminationMarker(pColor, res)
+
+    def GetEpdAnnotation(self, epdLine):
+        """
+        Returns epd, isGameOver, bm, ce and the annotated epd line of
+        epdLine. The annotated line is None if the epd line is skipped.
+        """
+        bm = None
 
-                if curFen is None:
-                    logging.info('This game has no move.')
-                    board = gameNode.board()
-
-                    try:
-                        res = gameNode.headers['Result']
-                    except:
-                        res = '*'
-
-                    isGameOver = self.GameOver(board)
-                    side = board.turn
-                    fmvn = board.fullmove_number
-                    sanMove = None
-                    self.bookMove = None # Don't use a book just analyze.
-                    posScore = None
-                    if not isGameOver:
-                        engBestMove, engBestScore, pvLine, threatMove = None, None, None, None
-                        if self.jobType == 'analyze':
-                            engBestMove, engBestScore, complexityNumber, moveChanges, pvLine, depth = \
-                                self.GetSearchScoreBeforeMove(board.fen(), side)
-                            self.WriteNotation(side, fmvn, sanMove, self.bookMove,
-                                               posScore, isGameOver,
-                                               engBestMove, engBestScore,
-                                               complexityNumber, moveChanges,
-                                               pvLine, threatMove, depth)
-                            with open(self.outfn, 'a') as w:
-                                w.write(f' {res} \n\n')
-                else:
-                    # Write blunder/bad counts, and game termination marker to output file.
-                    pColor = None
-                    if self.player is not None:
-                        pColor = 'white' if self.player == wplayer else 'black'
-                    elif self.playerAndOpp is not None:
-                        pColor = 'white' if self.playerAndOpp == wplayer else 'black'
-                    self.WriteTerminationMarker(pColor, res)
+        self.CountProgress(positions=1)
+
+        # Get only first 4 fields [pieces side castle_flag ep_sq].
+        epdLineSplit = epdLine.split()
+        epd = ' '.join(epdLineSplit[0:4])
+        hmvc = self.GetHmvcInEpd(epdLine)
+
+        # Add hmvc and fmvn to create a FEN for the engine.
+        fen = epd + ' ' + hmvc + ' 1'
+
+        # If this position has no legal move then we skip it.
+        pos = self.Getboard(fen)
+        isGameOver = self.GameOver(pos)
+        if isGameOver:
+            if self.timeBudget is not None:
+                self.timeBudget.Skip(1)
+            return epd, isGameOver, bm, None, None
+
+        # Get engine analysis.
+        if self.evalType == 'static':
+            ce = self.GetEpdEngineStaticScore(fen)
+            annotatedLine = '%s ce %+d; c0 \"%s\"; Ae \"%s\";\n' %(epdLine, ce, 'ce is static eval of engine', self.engIdName)
+        else:
+            self.UseTimeBudget()
+            acd, acs, bm, ce = self.GetEpdEngineSearchScore(fen)
+            self.UseTimeBudget(isLast=True)
+            annotatedLine = '%s acd %d; acs %d; bm %s; ce %+d; Ae \"%s\";\n' %(epdLine, acd, acs, bm, ce, self.engIdName)
+
+        return epd, isGameOver, bm, ce, annotatedLine
 
     def AnnotateEpd(self):
         """ Annotate epd file with bm, ce, acs, acd, and Ae opcodes
             Ae - analyzing engine, a special opcode for this script.
         """
         cntEpd = 0
+        cntAnnotated = 0
+        t0 = time.perf_counter()
+        jobT0 = time.time()
         
-        # Open the epd file for reading.
+        # Open the epd file for reading and remove white space at
+        # beginning and end of lines.
         with open(self.infn, 'r') as f:
-            for lines in f:
-                cntEpd += 1
-                
-                # Remove white space at beginning and end of lines.
-                epdLine = lines.strip()
+            epdLines = [lines.strip() for lines in f]
+
+        self.StartTimeBudget(len(epdLines))
+        self.StartProgress(len(epdLines))
 
-                # Get only first 4 fields [pieces side castle_flag ep_sq].
-                epdLineSplit = epdLine.split()
-                epd = ' '.join(epdLineSplit[0:4])
-                hmvc = self.GetHmvcInEpd(epdLine)
+        # The positions can be analyzed by several workers, the results
+        # are still in epd line order.
+        pool = None
+        if self.workers > 1:
+            pool = self.CreateWorkerPool()
+            results = self.IterEpdAnnotations(pool, epdLines)
+        else:
+            results = map(self.GetEpdAnnotation, epdLines)
 
-                # Add hmvc and fmvn to create a FEN for the engine.
-                fen = epd + ' ' + hmvc + ' 1'
+        # Save to output file the epd analysis, the file is opened once.
+        with open(self.outfn, 'a') as f1:
+            for epd, isGameOver, bm, ce, annotatedLine in results:
+                cntEpd += 1
 
                 # Show progress in console.
-                print('epd %d: %s' %(cntEpd, epd))
-
-                # If this position has no legal move then we skip it.
-                pos = self.Getboard(fen)
-                isGameOver = self.GameOver(pos)
+                self.PrintVerbose('epd %d: %s' %(cntEpd, epd))
 
                 if isGameOver:
                     # Show warning in console.
@@ -2186,23 +3845,23 @@ class Analyze():
                     print('has no legal move - skipped.\n')
                     continue
 
-                # Get engine analysis.
-                if self.evalType == 'static':
-                    ce = self.GetEpdEngineStaticScore(fen)
-                elif self.evalType == 'search':
-                    acd, acs, bm, ce = self.GetEpdEngineSearchScore(fen)
-
                 # Show progress in console.
                 if self.evalType == 'search':
-                    print('bm: %s' %(bm))
-                print('ce: %+d\n' %(ce))
+                    self.PrintVerbose('bm: %s' %(bm))
+                self.PrintVerbose('ce: %+d\n' %(ce))
+
+                f1.write(annotatedLine)
+                cntAnnotated += 1
 
-                # Save to output file the epd analysis.
-                with open(self.outfn, 'a') as f1:
-                    if self.evalType == 'static':
-                        f1.write('%s ce %+d; c0 \"%s\"; Ae \"%s\";\n' %(epdLine, ce, 'ce is static eval of engine', self.engIdName))
-                    elif self.evalType == 'search':
-                        f1.write('%s acd %d; acs %d; bm %s; ce %+d; Ae \"%s\";\n' %(epdLine, acd, acs, bm, ce, self.engIdName))
+        if pool is not None:
+            pool.shutdown()
+        self.EndProgress()
+
+        elapse = time.perf_counter() - t0
+        print('Annotated positions   : %d' % cntAnnotated)
+        print('Elapse (sec)          : %0.2f' % elapse)
+        print('Positions per second  : %0.2f' % (cntAnnotated / max(elapse, 0.001)))
+        self.PrintTimeBudget(jobT0, 'Job')
 
     def GetEpdBmAm(self, epdLine):
         """ Return the bm and am in a list format in the epdLine.
@@ -2295,6 +3954,127 @@ class Analyze():
         hmvc = hmvcValue[0:-1]
         return hmvc     
 
+    def GetEpdTestPosition(self, epdLine):
+        """
+        Returns fen, isGameOver, epd bm list and epd am list of epdLine and
+        if the position is searched.
+        """
+        # Get the first 4 fields [pieces side castle_flag ep_sq],
+        # also search the hmvc opcode.
+        epdLineSplit = epdLine.split()
+        epd = ' '.join(epdLineSplit[0:4])
+        hmvc = self.GetHmvcInEpd(epdLine)
+
+        # Add hmvc to create a FEN for the engine.
+        # Use 1 for fmvn
+        fen = epd + ' ' + hmvc + ' 1'
+
+        # If this position has no legal move then we skip it.
+        pos = self.Getboard(fen)
+        isGameOver = self.GameOver(pos)
+        if isGameOver:
+            return fen, isGameOver, [], [], False
+
+        # Get the bm and/or am move in the epd line.
+        epdBm, epdAm = self.GetEpdBmAm(epdLine)
+
+        # If the epd line has no bm or am then we just skip it.
+        isSearch = len(epdBm) > 0 or len(epdAm) > 0
+
+        return fen, isGameOver, epdBm, epdAm, isSearch
+
+    def GetEpdTestResult(self, epdLine):
+        """
+        Search the position of epdLine and returns fen, isGameOver, epd bm
+        list, epd am list, engine bm, search time and process id. The engine
+        bm is None if the epd line is skipped.
+        """
+        t0 = time.perf_counter()
+        fen, isGameOver, epdBm, epdAm, isSearch = self.GetEpdTestPosition(epdLine)
+        if not isSearch:
+            return fen, isGameOver, epdBm, epdAm, None, 0.0, os.getpid()
+
+        # Get engine bestmove.
+        _, bestMove = self.GetEngine().Go(fen, self.GetGoLimit(), self.GetGoTimeout())
+        bm = self.UciToSanMove(fen, bestMove)
+
+        return (fen, isGameOver, epdBm, epdAm, bm,
+                time.perf_counter() - t0, os.getpid())
+
+    async def SearchEpdTestLines(self, engine, workerNum, epdLines, results):
+        """
+        Search the epd test positions of epdLines, a deque of index and
+        epd line shared by the engines, and set the result futures.
+        """
+        while epdLines:
+            index, epdLine = epdLines.popleft()
+            try:
+                t0 = time.perf_counter()
+                fen, isGameOver, epdBm, epdAm, isSearch = self.GetEpdTestPosition(epdLine)
+                bm, elapse = None, 0.0
+                if isSearch:
+                    await engine.Query(self.variantTag == 'chess960')
+                    _, bestMove = await engine.Go(fen, self.GetGoLimit(),
+                                                  self.GetGoTimeout())
+                    bm = self.UciToSanMove(fen, bestMove)
+                    elapse = time.perf_counter() - t0
+            except Exception as e:
+                results[index].set_exception(e)
+                raise
+            results[index].set_result(
+                    (fen, isGameOver, epdBm, epdAm, bm, elapse, workerNum))
+
+    def IterEpdTestResults(self, epdLines):
+        """
+        Yields the test results of epdLines in order. The positions are
+        searched by self.workers engines that are all driven by one
+        event loop.
+        """
+        loop = asyncio.new_event_loop()
+        pending = collections.deque(enumerate(epdLines))
+        results = [loop.create_future() for _ in epdLines]
+        engines = [AsyncUciEngine(self.eng, self.engineOptions)
+                   for _ in range(self.workers)]
+
+        # The searches of every engine are counted in the search stats
+        # of the engine of this process.
+        for engine in engines:
+            engine.searchStats = self.engine.searchStats
+        tasks = [loop.create_task(self.SearchEpdTestLines(engine, n, pending, results))
+                 for n, engine in enumerate(engines, 1)]
+        print(f'Start {self.workers} engines ...')
+
+        try:
+            for result in results:
+                with self.profiler.Phase('engine search'):
+                    testResult = loop.run_until_complete(result)
+                yield testResult
+        finally:
+            for task in tasks:
+                task.cancel()
+            loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
+            for engine in engines:
+                loop.run_until_complete(engine.Quit())
+            loop.close()
+
+    def IterEpdAnnotations(self, pool, epdLines):
+        """
+        Yields the annotations of epdLines in order from the worker pool.
+        The lines are sent in chunks and only 2 chunks per worker are in
+        flight, so a large epd file does not hold a future per line.
+        """
+        chunkSize = 1 if self.evalType == 'search' else EPD_CHUNK_SIZE
+        pending = collections.deque()
+        for i in range(0, len(epdLines), chunkSize):
+            pending.append(pool.submit(WorkerAnnotateEpd, epdLines[i:i + chunkSize]))
+            while len(pending) >= 2 * self.workers:
+                yield from pending.popleft().result()
+            if self.progress is not None:
+                self.progress.SetQueued(len(pending))
+
+        while pending:
+            yield from pending.popleft().result()
+
     def TestEngineWithEpd(self):
         """ Test engine with epd test suite, results will
             be in the output file.
@@ -2302,113 +4082,76 @@ class Analyze():
         cntEpd = 0
         cntCorrect = 0
         cntValidEpd = 0
-        
-        p = subprocess.Popen(self.eng, stdin=subprocess.PIPE,
-                             stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
-                             universal_newlines=True, bufsize=1)
-        self.Send(p, 'uci')
-        self.ReadEngineReply(p, 'uci')
-        self.SetEngineOptions(p, self.engineOptions)
-        self.Send(p, 'isready')
-        self.ReadEngineReply(p, 'isready')
-        self.Send(p, 'ucinewgame')
-        self.Send(p, 'isready')
-        self.ReadEngineReply(p, 'isready')
+
+        # Search time per worker, pid or engine number: [positions, seconds]
+        workerTime = {}
+
+        if self.moveTime <= 0 and self.depth <= 0:
+            raise Exception('depth or movetime must have values that are more than zero.')
         
         t0 = time.perf_counter()
         
-        # Open the epd file for reading.
+        # Open the epd file for reading and remove white space at
+        # beginning and end of lines.
         with open(self.infn, 'r') as f:
-            for lines in f:
-                cntEpd += 1
-                
-                # Remove white space at beginning and end of lines.
-                epdLine = lines.strip()
+            epdLines = [lines.strip() for lines in f]
 
-                # Get the first 4 fields [pieces side castle_flag ep_sq],
-                # also search the hmvc opcode.
-                epdLineSplit = epdLine.split()
-                epd = ' '.join(epdLineSplit[0:4])
-                hmvc = self.GetHmvcInEpd(epdLine)
+        self.StartProgress(len(epdLines))
 
-                # Add hmvc to create a FEN for the engine.
-                # Use 1 for fmvn
-                fen = epd + ' ' + hmvc + ' 1'
+        # The results are in epd line order even if the positions are
+        # searched by several engines.
+        if self.workers > 1:
+            results = self.IterEpdTestResults(epdLines)
+        else:
+            results = map(self.GetEpdTestResult, epdLines)
 
-                # Show progress in console.
-                print('EPD %d: %s' %(cntEpd, epdLine))
-                print('FEN %d: %s' %(cntEpd, fen))
+        for epdLine, result in zip(epdLines, results):
+            cntEpd += 1
+            fen, isGameOver, epdBm, epdAm, bm, elapse, pid = result
+            epd = ' '.join(epdLine.split()[0:4])
 
-                # If this position has no legal move then we skip it.
-                pos = self.Getboard(fen)
-                isGameOver = self.GameOver(pos)
-                if isGameOver:
-                    # Show warning in console.
-                    print('Warning! epd \"%s\"' %(epd))
-                    print('has no legal move - skipped.\n')
-                    continue
+            self.CountProgress(positions=1)
 
-                # Get the bm and/or am move in the epd line.
-                epdBm, epdAm = self.GetEpdBmAm(epdLine)  
-                
-                # If the epd line has no bm or am then we just skip it.
-                if len(epdBm) <= 0 and len(epdAm) <= 0:
-                    # Show warning in console.
-                    print('Warning! epd \"%s\"' %(epd))
-                    print('has no bm and am opcodes - skipped.\n')
-                    continue
+            # Show progress in console.
+            self.PrintVerbose('EPD %d: %s' %(cntEpd, epdLine))
+            self.PrintVerbose('FEN %d: %s' %(cntEpd, fen))
 
-                # Get engine bestmove.
-                self.Send(p, 'ucinewgame')
-                self.Send(p, 'position fen %s' % fen)
-                
-                # Set time or depth limit                
-                if self.moveTime > 0:
-                    if self.depth > 0:
-                        self.Send(p, 'go movetime %d depth %d' % (self.moveTime, self.depth))
-                    else:
-                        self.Send(p, 'go movetime %d' % self.moveTime)
-                elif self.depth > 0:
-                    self.Send(p, 'go depth %d' % self.depth)
-                else:
-                    self.Send(p, 'quit')
-                    p.communicate()
-                    raise Exception('depth or movetime must have values that are more than zero.')
-                    return
-                
-                for eline in iter(p.stdout.readline, ''):        
-                    line = eline.strip()
-                    
-                    # Selects which engine output will be saved in log file.
-                    if ('bestmove' in line or
-                            ('depth' in line and 'score' in line and 'pv' in line)):
-                        logging.debug('<< %s' % line)                    
+            if isGameOver:
+                # Show warning in console.
+                print('Warning! epd \"%s\"' %(epd))
+                print('has no legal move - skipped.\n')
+                continue
 
-                    if 'bestmove ' in line:                        
-                        bm = self.UciToSanMove(fen, line.split()[1])
-                        break
-                
-                # The percentage correct is based on valid epd only
-                cntValidEpd += 1
+            if len(epdBm) <= 0 and len(epdAm) <= 0:
+                # Show warning in console.
+                print('Warning! epd \"%s\"' %(epd))
+                print('has no bm and am opcodes - skipped.\n')
+                continue
 
-                # Show progress in console.
-                print('engine bm: %s' %(bm))
-                
-                logging.info(f'engine bm: {bm}')
-
-                # If engine bm is in the epdBm list then increment cntCorrect.
-                # If not, check if engine bm is not in epdAm list, if so
-                # increment the cntCorrect.
-                isCorrect = self.IsCorrectEngineBm(bm, epdBm, epdAm)
-                if isCorrect:
-                    cntCorrect += 1
-                logging.info('correct: %s' % ('Yes' if isCorrect else 'No'))
-                logging.info('num correct: %d / %d' % (cntCorrect, cntValidEpd))
-                print('correct: %s' % ('Yes' if isCorrect else 'No'))
-                print('num correct: %d / %d' % (cntCorrect, cntValidEpd))
-                
-        self.Send(p, 'quit')
-        p.communicate()
+            workerTime.setdefault(pid, [0, 0.0])
+            workerTime[pid][0] += 1
+            workerTime[pid][1] += elapse
+            
+            # The percentage correct is based on valid epd only
+            cntValidEpd += 1
+
+            # Show progress in console.
+            self.PrintVerbose('engine bm: %s' %(bm))
+            
+            logging.info(f'engine bm: {bm}')
+
+            # If engine bm is in the epdBm list then increment cntCorrect.
+            # If not, check if engine bm is not in epdAm list, if so
+            # increment the cntCorrect.
+            isCorrect = self.IsCorrectEngineBm(bm, epdBm, epdAm)
+            if isCorrect:
+                cntCorrect += 1
+            logging.info('correct: %s' % ('Yes' if isCorrect else 'No'))
+            logging.info('num correct: %d / %d' % (cntCorrect, cntValidEpd))
+            self.PrintVerbose('correct: %s' % ('Yes' if isCorrect else 'No'))
+            self.PrintVerbose('num correct: %d / %d' % (cntCorrect, cntValidEpd))
+
+        self.EndProgress()
 
         # Print test summary.
         pctCorrect = 0.0
@@ -2426,6 +4169,13 @@ class Analyze():
         
         print('Elapse (sec)          : %0.2f' % (time.perf_counter() - t0))
 
+        # Show the sum of the search times of every worker, it is not
+        # the wall time of the worker.
+        if self.workers > 1:
+            for i, (positions, seconds) in enumerate(workerTime.values(), 1):
+                print('%-22s: %0.2f, positions: %d' % (
+                    'Worker %d search (sec)' % i, seconds, positions))
+
         # Write to output file, that was specified in -outfile option.
         with open(self.outfn, 'a') as f:
             f.write(':: EPD %s TEST RESULTS ::\n' %(self.infn))
@@ -2436,6 +4186,123 @@ class Analyze():
             f.write('Total correct         : %d\n' %(cntCorrect))
             f.write('Correct percentage    : %0.2f\n\n' %(pctCorrect))
             
+    def CreateGamePuzzles(self, game):
+        """
+        Analyze the positions of a game and returns a list of epd lines of
+        the positions that are saved as puzzles.
+        """
+        WIN_CP_SCORE_THRESHOLD = 5000
+
+        puzzles = []
+        self.SetVariantTag(game)
+
+        posNum = 0
+        gameT0 = time.time()
+
+        gameNode = game        
+        while gameNode.variations:
+            self.UseTimeBudget()
+            self.CountProgress(positions=1)
+            posNum += 1
+
+            logging.info(f'pos number: {posNum}')
+            self.PrintVerbose(f'pos number: {posNum}')
+
+            interestingPos = True
+            with self.profiler.Phase('board'):
+                board = gameNode.board()
+            fmvn = board.fullmove_number
+
+            nextNode = gameNode.variation(0)
+            with self.profiler.Phase('san'):
+                gameMove = nextNode.san()
+
+            if fmvn < self.analysisMoveStart:
+                gameNode = nextNode
+                continue
+
+            fen = board.fen()
+            self.PrintVerbose('analyzing fen %s ...' % fen)
+
+            bestScore, pvMove, pvScore = -MAX_SCORE, None, -MAX_SCORE
+
+            def OnInfo(line):
+                """ Save pv move and scores, returns True to stop the search """
+                nonlocal bestScore, pvMove, pvScore, interestingPos
+                isStop = False
+
+                if ('info depth ' in line and ' pv ' in line and
+                        not 'upperbound' in line and not 'lowerbound' in line and
+                        'score' in line):
+                    splitLine = line.split()
+
+                    depth = int(line.split('depth ')[1].split()[0])
+
+                    # Save pv move and score at quarter of movetime
+                    elapse = (time.perf_counter() - start_time) * 1000
+                    if elapse < self.moveTime//4:
+                        pvMove = splitLine[splitLine.index('pv')+1].strip()
+
+                        if 'score cp ' in line:
+                            splitStr = line.split()
+                            scoreIndex = splitStr.index('score')
+                            pvScore = int(splitStr[scoreIndex + 2])
+                        elif 'score mate ' in line:
+                            splitStr = line.split()
+                            scoreIndex = splitStr.index('score')
+                            mateInN = int(splitStr[scoreIndex + 2])            
+                            pvScore = self.MateDistanceToValue(mateInN)
+
+                        # Don't save winning or losing positions
+                        if ((elapse >= self.moveTime // 16 or depth >= 8)
+                                and interestingPos
+                                and abs(pvScore) > WIN_CP_SCORE_THRESHOLD):
+                            isStop = True
+                            interestingPos = False
+                    else:
+                        if 'score cp ' in line:
+                            splitStr = line.split()
+                            scoreIndex = splitStr.index('score')
+                            bestScore = int(splitStr[scoreIndex + 2])
+                        elif 'score mate ' in line:
+                            splitStr = line.split()
+                            scoreIndex = splitStr.index('score')
+                            mateInN = int(splitStr[scoreIndex + 2])            
+                            bestScore = self.MateDistanceToValue(mateInN)
+
+                return isStop
+
+            start_time = time.perf_counter()
+            _, bestMove = self.GetEngine().Go(fen, 'movetime %s' % self.moveTime,
+                                              self.GetGoTimeout(), OnInfo)
+
+            # Read next game if pos is not interesting or lossing or winning
+            if not interestingPos:
+                if self.timeBudget is not None:
+                    self.timeBudget.Skip(game.end().ply() - gameNode.ply() - 1)
+                break
+
+            logging.info('bestPv: %s, pvScore: %d' % (pvMove, pvScore))
+            logging.info('bestmove: %s, bestScore: %d' % (bestMove, bestScore))
+
+            # Compare pv move in the first half of the search and bestmove
+            if bestMove != pvMove and bestScore >= pvScore + self.puzzleScoreMargin:
+                self.PrintVerbose('save fen in %s' % self.puzzlefn)
+                epdLine = f'{board.epd()} bm {board.san(chess.Move.from_uci(bestMove))};'
+                epdLine += f' Ubm {bestMove}; sm {gameMove}; Ae "{self.engIdName}";'
+                if self.variantTag is not None:
+                    epdLine += f' variant "{self.variantTag.lower()}";'
+                    if self.variantTag != 'chess960' and self.game960:
+                        epdLine += ' Variant1 "chess960";'
+                puzzles.append(epdLine)
+
+            gameNode = nextNode
+
+        self.UseTimeBudget(isLast=True)
+        self.PrintTimeBudget(gameT0, 'Game')
+
+        return puzzles
+
     def CreatePuzzle(self):
         """
         Generate chess position puzzle or test positions from a given pgn file.
@@ -2445,150 +4312,89 @@ class Analyze():
         the search. If pvmove and bestmove are not the same and score of
         bestmove is higher than score at pvmove then save this as a test
         position.
-        """
-        gameNum = 0
 
-        WIN_CP_SCORE_THRESHOLD = 5000
-        
-        p = subprocess.Popen(self.eng, stdin=subprocess.PIPE,
-                 stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
-                 universal_newlines=True, bufsize=1)
-        self.Send(p, 'uci')
-        self.ReadEngineReply(p, 'uci')
-        self.SetEngineOptions(p, self.engineOptions)
-        self.Send(p, 'isready')
-        self.ReadEngineReply(p, 'isready')
-        self.Send(p, 'ucinewgame')
-        self.Send(p, 'isready')
-        self.ReadEngineReply(p, 'isready')
+        With --workers the games are analyzed by the worker pool and the
+        puzzles are written by this process in game order.
+        """
+        if self.timeBudgetSec > 0 or self.IsProgressUsed():
+            positions = self.CountPgnPositions()
+            self.StartTimeBudget(positions)
+            self.StartProgress(positions)
+
+        pool, pending = None, collections.deque()
+        if self.workers > 1:
+            pool = self.CreateWorkerPool()
                     
         print('Creating test positions ...')
-        with open(self.infn, encoding='ISO-8859-1') as h:
-            game = chess.pgn.read_game(h)
-            while game:
-                gameNum += 1
+        with open(self.puzzlefn, 'a') as f:
+            for gameNum, game in self.IterPgnGames():
+                logging.info(f'game number: {gameNum}')
+                self.PrintVerbose(f'game number: {gameNum}')
 
-                try:
-                    variantTag = game.headers["Variant"]
-                    logging.info(f'Actual game Variant tag is {variantTag}.')
-                    if variantTag in ['Chess960', 'fischerandom', 'chess 960', 'chess960']:
-                        self.variantTag = 'chess960'
-                    else:
-                        self.variantTag = variantTag
-                    logging.info(f'Set variant tag to {self.variantTag}.')
-                except KeyError:
-                    logging.info('There is no Variant tag in the game header.')
-                except:
-                    logging.exception('Error in getting game variant tag value')
+                if pool is None:
+                    self.WritePuzzles(f, self.CreateGamePuzzles(game))
+                else:
+                    pending.append(pool.submit(WorkerCreatePuzzles, Analyze.GetGameText(game)))
+                    while len(pending) >= 2 * self.workers:
+                        self.WritePuzzles(f, pending.popleft().result())
+                    if self.progress is not None:
+                        self.progress.SetQueued(len(pending))
 
-                logging.info(f'game number: {gameNum}')
-                print(f'game number: {gameNum}')
+            while pending:
+                self.WritePuzzles(f, pending.popleft().result())
 
-                posNum = 0
-                    
-                gameNode = game        
-                while gameNode.variations:
-                    posNum += 1
+        if pool is not None:
+            pool.shutdown()
+        self.EndProgress()
 
-                    logging.info(f'pos number: {posNum}')
-                    print(f'pos number: {posNum}')
+    def WritePuzzles(self, f, puzzles):
+        """ Write the puzzles of a game to the puzzle file """
+        for epdLine in puzzles:
+            f.write(f'{epdLine}\n')
+        f.flush()
+        self.CountProgress(games=1)
 
-                    interestingPos = True
-                    board = gameNode.board()
-                    fmvn = board.fullmove_number
-                    
-                    nextNode = gameNode.variation(0)
-                    gameMove = nextNode.san()
-                    
-                    if fmvn < self.analysisMoveStart:
-                        gameNode = nextNode
-                        continue
 
-                    fen = board.fen()
-                    print('analyzing fen %s ...' % fen)
-                    
-                    bestMove, bestScore, pvMove, pvScore = None, -MAX_SCORE, None, -MAX_SCORE
-                            
-                    self.Send(p, 'ucinewgame')                 
-                    self.Send(p, 'position fen %s' % fen)
-                    
-                    start_time = time.perf_counter()
-                    self.Send(p, 'go movetime %s' % self.moveTime)
-                    
-                    for eline in iter(p.stdout.readline, ''):       
-                        line = eline.strip()
-                        
-                        if ('info depth ' in line and ' pv ' in line and
-                                not 'upperbound' in line and not 'lowerbound' in line and
-                                'score' in line):
-                            logging.debug('<< %s' % line)
-                            
-                            splitLine = line.split()
+# The Analyze object of a worker process, see Analyze.CreateWorkerPool().
+workerAnalyzer = None
 
-                            depth = int(line.split('depth ')[1].split()[0])
-        
-                            # Save pv move and score at quarter of movetime
-                            elapse = (time.perf_counter() - start_time) * 1000
-                            if elapse < self.moveTime//4:
-                                pvMove = splitLine[splitLine.index('pv')+1].strip()
-                                
-                                if 'score cp ' in line:
-                                    splitStr = line.split()
-                                    scoreIndex = splitStr.index('score')
-                                    pvScore = int(splitStr[scoreIndex + 2])
-                                elif 'score mate ' in line:
-                                    splitStr = line.split()
-                                    scoreIndex = splitStr.index('score')
-                                    mateInN = int(splitStr[scoreIndex + 2])            
-                                    pvScore = self.MateDistanceToValue(mateInN)
-
-                                # Don't save winning or losing positions
-                                if ((elapse >= self.moveTime // 16 or depth >= 8)
-                                        and interestingPos
-                                        and abs(pvScore) > WIN_CP_SCORE_THRESHOLD):
-                                    self.Send(p, 'stop')
-                                    interestingPos = False
-                            else:
-                                if 'score cp ' in line:
-                                    splitStr = line.split()
-                                    scoreIndex = splitStr.index('score')
-                                    bestScore = int(splitStr[scoreIndex + 2])
-                                elif 'score mate ' in line:
-                                    splitStr = line.split()
-                                    scoreIndex = splitStr.index('score')
-                                    mateInN = int(splitStr[scoreIndex + 2])            
-                                    bestScore = self.MateDistanceToValue(mateInN)
-            
-                        if 'bestmove ' in line:
-                            bestMove = line.split()[1]
-                            logging.debug('<< %s' % line)
-                            break
 
-                    # Read next game if pos is not interesting or lossing or winning
-                    if not interestingPos:
-                        break
-                    
-                    logging.info('bestPv: %s, pvScore: %d' % (pvMove, pvScore))
-                    logging.info('bestmove: %s, bestScore: %d' % (bestMove, bestScore))
-                    
-                    # Compare pv move in the first half of the search and bestmove
-                    if bestMove != pvMove and bestScore >= pvScore + self.puzzleScoreMargin:
-                        print('save fen in puzzle.epd')
-                        epdLine = f'{board.epd()} bm {board.san(chess.Move.from_uci(bestMove))};'
-                        epdLine += f' Ubm {bestMove}; sm {gameMove}; Ae "{self.engIdName}";'
-                        if self.variantTag is not None:
-                            epdLine += f' variant "{self.variantTag.lower()}";'
-                            if self.variantTag != 'chess960' and self.game960:
-                                epdLine += ' Variant1 "chess960";'
-                        with open(self.puzzlefn, 'a') as f:
-                            f.write(f'{epdLine}\n')
-                    
-                    gameNode = nextNode
-                    
-                game = chess.pgn.read_game(h)
-        
-        self.Send(p, 'quit')
-        p.communicate()   
+def InitWorker(infn, outfn, eng, opt):
+    """ Create the Analyze object and its engine in a worker process """
+    global workerAnalyzer
+    workerAnalyzer = Analyze(infn, outfn, eng, **opt)
+
+    # Quit the engine when the worker process exits.
+    multiprocessing.util.Finalize(workerAnalyzer, workerAnalyzer.engine.Quit,
+                                  exitpriority=10)
+
+
+def WorkerGetEngineIdName():
+    """ Returns the engine id name of a worker process """
+    return workerAnalyzer.engIdName
+
+
+def WorkerAnnotateGame(gameText):
+    """ Annotate a game in a worker process, returns the annotated game """
+    game = chess.pgn.read_game(io.StringIO(gameText))
+    gameText = workerAnalyzer.AnnotateGameToText(game)
+    workerAnalyzer.profiler.Flush()
+    return gameText, workerAnalyzer.gameRecords
+
+
+def WorkerAnnotateEpd(epdLines):
+    """ Annotate a chunk of epd lines in a worker process """
+    epdAnnotations = [workerAnalyzer.GetEpdAnnotation(epdLine) for epdLine in epdLines]
+    workerAnalyzer.profiler.Flush()
+    return epdAnnotations
+
+
+def WorkerCreatePuzzles(gameText):
+    """ Create the puzzles of a game in a worker process """
+    game = chess.pgn.read_game(io.StringIO(gameText))
+    puzzles = workerAnalyzer.CreateGamePuzzles(game)
+    workerAnalyzer.profiler.Flush()
+    return puzzles
 
 
 def main():
@@ -2604,8 +4410,8 @@ def main():
                         help='output filename', 
                         required=True)
     parser.add_argument('-e', '--enginefile', 
-                        help='input engine filename', 
-                        required=True)
+                        help='input engine filename, not used by --job buildindex',
+                        required=False)
     parser.add_argument('--enginename', 
                         help=('input uci engine id name, if not specified '
                               'engine id name will be used.'), required=False)
@@ -2618,8 +4424,9 @@ def main():
                         required=False)
     parser.add_argument(
         '--eval', help=('eval can be static or search. static '
-                        'uses static evaluation of Stockfish'),
-        choices=['static','search'], required=True)
+                        'uses static evaluation of Stockfish, not used by '
+                        '--job buildindex'),
+        choices=['static','search'], required=False)
     parser.add_argument("--movetime",
                         help=('input analysis time per position in ms, '
                               '(default=1000)'),
@@ -2648,8 +4455,9 @@ def main():
                               '--infile games.pgn --job createpuzzle, '
                               'To analyze pgn: --infile games.pgn --job analyze, '
                               'To annotate epd: --infile positions.epd --job analyze, '
-                              'To test engine with epd: --infile test.epd --job test'),
-                        choices=['analyze', 'test', 'createpuzzle'], required=True)
+                              'To test engine with epd: --infile test.epd --job test, '
+                              'To index pgn: --infile games.pgn --outfile games.idx --job buildindex'),
+                        choices=['analyze', 'test', 'createpuzzle', 'buildindex'], required=True)
     parser.add_argument('--wordycomment', action='store_true',
                         help=('There are more words in the move comments such as '
                               'better is, planning, excellent is, Cool is and others.'))
@@ -2698,8 +4506,120 @@ def main():
                         default=3.0, type=float, required=False)
     parser.add_argument('--game960', action='store_true',
                         help='A flag to enable chess960 of a variant game which will be used for python-chess.')
+    parser.add_argument("--workers",
+                        help=('number of engines to run in parallel, every engine '
+                              'runs in its own worker process, (default=1)'),
+                        default=1, type=int, required=False)
+    parser.add_argument("--game-move-score",
+                        help=('how the score of the game move is found when '
+                              '--eval search is used, (default=aftermove). '
+                              'aftermove searches the position after the game '
+                              'move, searchmoves and multipv search the position '
+                              'before the game move and score the game move on '
+                              'the same hash as the best move, multipv takes it '
+                              'from the MultiPV lines if it is there.'),
+                        choices=['aftermove', 'searchmoves', 'multipv'],
+                        default='aftermove', required=False)
+    parser.add_argument("--cache",
+                        help=('input sqlite filename to save the engine search '
+                              'results, positions that are already in it are '
+                              'not searched again, (default=None). Example: '
+                              '--cache analysis.db'),
+                        default=None, required=False)
+    parser.add_argument("--shared-cache-mb",
+                        help=('size in MB of the table in shared memory where '
+                              'the --workers processes save and find the search '
+                              'results, static evals and threat moves, 0 to '
+                              'disable it, (default=64)'),
+                        default=64, type=int, required=False)
+    parser.add_argument("--time-budget",
+                        help=('input the time in seconds that the analyze or '
+                              'createpuzzle job can take, (default=0 or no '
+                              'budget). The movetime of every position is set '
+                              'from the time left and the positions left, '
+                              '--movetime is then not used.'),
+                        default=0, type=float, required=False)
+    parser.add_argument('--adaptive-movetime', action='store_true',
+                        help=('Search every position for a quarter of the '
+                              'movetime first, the rest of the movetime is only '
+                              'used if the best move or score changes in the '
+                              'last depths.'))
+    parser.add_argument("--converge-depths",
+                        help=('stop a search when the pv move and score have '
+                              'not changed for this number of depths, the '
+                              '--movetime is then the longest time of a search, '
+                              '(default=0 or not used)'),
+                        default=0, type=int, required=False)
+    parser.add_argument("--converge-tolerance",
+                        help=('score change in centipawn that is still '
+                              'counted as the same score by --converge-depths, '
+                              '(default=10)'),
+                        default=10, type=int, required=False)
+    parser.add_argument("--jsonl",
+                        help=('output file of the analysis of every analyzed '
+                              'ply as json lines, with the engine nodes, nps, '
+                              'hashfull and time, (default=None)'),
+                        default=None, required=False)
+    parser.add_argument("--progress-interval",
+                        help=('show a progress line every this number of seconds '
+                              'instead of the analysis of every position, '
+                              '(default=0 or show every position)'),
+                        default=0, type=float, required=False)
+    parser.add_argument("--metrics",
+                        help=('output json file of the progress, positions per '
+                              'second, mean search time, cache hit rates and '
+                              'eta, it is rewritten at most once per second or '
+                              'per --progress-interval, (default=None)'),
+                        default=None, required=False)
+    parser.add_argument("--profile",
+                        help=('show the time spent in engine sync, search and '
+                              'eval, uci parsing, board, san, book, material '
+                              'and output, and the cpu time and peak memory '
+                              'of this process and its engines at the end'),
+                        action='store_true')
+    parser.add_argument("--games",
+                        help=('analyze or create puzzles from the games in '
+                              'this range of game numbers only, like 1000-1999 '
+                              'or 1000- until the last game, (default=None)'),
+                        default=None, required=False)
+    parser.add_argument("--pgn-index",
+                        help=('input index of the pgn file from --job buildindex, '
+                              'it is used to go to the --games range and to '
+                              'select games by player and result, (default=None)'),
+                        default=None, required=False)
+    parser.add_argument("--syzygy",
+                        help=('input syzygy tablebase folder, positions in the '
+                              'tablebases are not searched by the engine. Use '
+                              'the path separator like ; in windows for more '
+                              'folders, (default=None)'),
+                        default=None, required=False)
+    parser.add_argument("--multipv",
+                        help=('number of pv lines used by --game-move-score '
+                              'multipv, (default=4)'),
+                        default=4, type=int, required=False)
 
     args = parser.parse_args()
+
+    if args.job == 'buildindex':
+        gameCnt = PgnIndex.Build(args.infile, args.outfile)
+        print('Games in index %s: %d' % (args.outfile, gameCnt))
+        print('Done!!\n')
+        return
+
+    missingArgs = [name for name, value in [('-e/--enginefile', args.enginefile),
+                                            ('--eval', args.eval)] if value is None]
+    if missingArgs:
+        parser.error('the following arguments are required: %s' % ', '.join(missingArgs))
+
+    gameRange = (1, None)
+    if args.games is not None:
+        first, sep, last = args.games.partition('-')
+        try:
+            gameRange = (int(first), int(last) if last else (None if sep else int(first)))
+        except ValueError:
+            parser.error('argument --games: invalid range %s' % args.games)
+        if gameRange[0] < 1 or (gameRange[1] is not None and gameRange[1] < gameRange[0]):
+            parser.error('argument --games: invalid range %s' % args.games)
     
     inputFile = args.infile
     outputFile = args.outfile
@@ -2731,7 +4651,23 @@ def main():
                '-draw': args.draw,
                '-enginename': args.enginename,
                '-game960': args.game960,
-               '-puzzle-score-margin': args.puzzle_score_margin
+               '-puzzle-score-margin': args.puzzle_score_margin,
+               '-workers': max(1, args.workers),
+               '-game-move-score': args.game_move_score,
+               '-multipv': max(2, args.multipv),
+               '-cache': args.cache,
+               '-shared-cache-mb': max(0, args.shared_cache_mb),
+               '-time-budget': args.time_budget,
+               '-adaptive-movetime': args.adaptive_movetime,
+               '-converge-depths': max(0, args.converge_depths),
+               '-converge-tolerance': max(0, args.converge_tolerance),
+               '-syzygy': args.syzygy,
+               '-games': gameRange,
+               '-pgn-index': args.pgn_index,
+               '-jsonl': args.jsonl,
+               '-progress-interval': max(0.0, args.progress_interval),
+               '-metrics': args.metrics,
+               '-profile': args.profile
                }
     
     if args.log:
@@ -2745,25 +4681,29 @@ def main():
     g.PrintEngineIdName()
 
     # Process input file depending on the infile format
-    if inputFile.lower().endswith('.epd'):
-        if jobType == 'test':
-            logging.info('Test engine with epd suite')
-            g.TestEngineWithEpd()
-        else:
-            logging.info('Annotate epd')
-            g.AnnotateEpd()            
-    elif inputFile.lower().endswith('.pgn'):
-        if jobType == 'analyze':
-            logging.info('Annotate game')
-            g.AnnotatePgn()
-        elif jobType == 'createpuzzle':
-            g.CreatePuzzle()
-        else:
-            logging.info('There is error in command line.')
-            print('There is error in command line.')
+    try:
+        if inputFile.lower().endswith('.epd'):
+            if jobType == 'test':
+                logging.info('Test engine with epd suite')
+                g.TestEngineWithEpd()
+            else:
+                logging.info('Annotate epd')
+                g.AnnotateEpd()            
+        elif inputFile.lower().endswith('.pgn'):
+            if jobType == 'analyze':
+                logging.info('Annotate game')
+                g.AnnotatePgn()
+            elif jobType == 'createpuzzle':
+                g.CreatePuzzle()
+            else:
+                logging.info('There is error in command line.')
+                print('There is error in command line.')
+    finally:
+        g.CloseEngine()
 
     print('Done!!\n')
 
 
 if __name__ == "__main__":
+    multiprocessing.freeze_support()
     main()
@@ -0,0 +1,248 @@
+"""
+Tests of chess_artist.py, the engine is Bench/fake_engine.py.
+
+Run:
+    python -m pytest tests
+"""
+
+
+import os
+import sys
+import json
+import asyncio
+import shutil
+import tempfile
+import unittest
+import subprocess
+from pathlib import Path
+from unittest import mock
+
+import chess
+
+
+ROOT_DIR = Path(__file__).resolve().parent.parent
+FAKE_ENGINE = ROOT_DIR / 'Bench' / 'fake_engine.py'
+SAMPLE_PGN = ROOT_DIR / 'PGN' / 'sample.pgn'
+FISCHER_PGN = ROOT_DIR / 'PGN' / 'fischerr19.pgn'
+
+sys.path.insert(0, str(ROOT_DIR))
+from chess_artist import (Analyze, AsyncUciEngine, SharedResultTable, MAX_SCORE,
+                          TEST_SEARCH_SCORE, RESUME_INDEX_SUFFIX, SHARED_SLOT_SIZE)
+
+
+def GetAnalyzer(**attributes):
+    """ Returns an Analyze object without engine with the given attributes """
+    analyzer = Analyze.__new__(Analyze)
+    analyzer.__dict__.update(attributes)
+    return analyzer
+
+
+class ChessArtistRun():
+    """ Runs chess_artist.py with the fake engine in a temporary folder """
+    def setUp(self):
+        self.tmpDir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpDir, ignore_errors=True)
+
+    def Run(self, *options, infile=SAMPLE_PGN, outfile='out.pgn', job='analyze'):
+        """ Returns the metrics of a run of chess_artist.py """
+        metricsFile = os.path.join(self.tmpDir, 'metrics.json')
+        cmd = [sys.executable, str(ROOT_DIR / 'chess_artist.py'),
+               '--infile', str(infile), '--outfile', os.path.join(self.tmpDir, outfile),
+               '--enginefile', str(FAKE_ENGINE), '--job', job, '--eval', 'search',
+               '--movetime', '10', '--metrics', metricsFile] + list(options)
+        p = subprocess.run(cmd, cwd=self.tmpDir, capture_output=True, text=True)
+        self.assertEqual(p.returncode, 0, p.stdout + p.stderr)
+        with open(metricsFile) as f:
+            return json.load(f)
+
+
+class TestGoodNag(unittest.TestCase):
+    def testVeryGoodMove(self):
+        analyzer = GetAnalyzer(moveTime=1000)
+        self.assertEqual(analyzer.GetGoodNag(True, 0.1, 0.1, 60, 4), '$3')
+
+    def testGoodMove(self):
+        analyzer = GetAnalyzer(moveTime=1000)
+        self.assertEqual(analyzer.GetGoodNag(False, -0.1, -0.1, 35, 3), '$1')
+
+    def testWinningOrInferiorPosition(self):
+        analyzer = GetAnalyzer(moveTime=1000)
+        self.assertEqual(analyzer.GetGoodNag(True, 5.0, 5.0, 60, 4), '$0')
+        self.assertEqual(analyzer.GetGoodNag(True, -1.0, -1.0, 60, 4), '$0')
+
+
+class TestAdaptiveSearch(unittest.TestCase):
+    def testExtensionKeepsComplexity(self):
+        # The pv move changes at depth 11, an extension has the same lines.
+        savedMove = [[d, 'e2e4' if d < 11 else 'd2d4', 20] for d in range(1, 13)]
+        search = {'bestmove': 'd2d4', 'score': 20, 'pv': ['d2d4'], 'depth': 12,
+                  'savedMove': savedMove, 'multiPvScore': {}}
+        analyzer = GetAnalyzer(moveTime=1000, adaptiveCnt=0, adaptiveExtendCnt=0,
+                               adaptiveTimeSaved=0.0)
+        analyzer.RunSearch = lambda fen, moveTime, multiPv, newGame=True: json.loads(
+                json.dumps(search))
+        analyzer.IsSearchComplex = lambda fen, result: True
+
+        result = analyzer.AdaptiveSearch(chess.STARTING_FEN)
+        self.assertEqual(analyzer.adaptiveExtendCnt, 1)
+        self.assertEqual(analyzer.GetComplexityNumber(result['savedMove'], chess.STARTING_FEN),
+                         analyzer.GetComplexityNumber(savedMove, chess.STARTING_FEN))
+
+
+class TestScoreDecided(unittest.TestCase):
+    def setUp(self):
+        self.analyzer = GetAnalyzer(maxScoreStopAnalysis=10.0,
+                                    minScoreStopAnalysis=-10.0)
+
+    def testDecidedScore(self):
+        self.assertTrue(self.analyzer.IsScoreDecided(30.0))
+        self.assertTrue(self.analyzer.IsScoreDecided(-(MAX_SCORE - 1) / 100))
+        self.assertFalse(self.analyzer.IsScoreDecided(2.5))
+        self.assertFalse(self.analyzer.IsScoreDecided(None))
+
+    def testFailedSearchIsNotDecided(self):
+        self.assertFalse(self.analyzer.IsScoreDecided(TEST_SEARCH_SCORE / 100))
+        self.assertFalse(self.analyzer.IsScoreDecided(-TEST_SEARCH_SCORE / 100))
+
+
+HUNG_ENGINE = """
+import sys
+for line in sys.stdin:
+    line = line.strip()
+    if line == 'uci':
+        print('id name Hung Engine\\nuciok', flush=True)
+    elif line == 'isready':
+        print('readyok', flush=True)
+    elif line == 'quit':
+        break
+"""
+
+
+class TestEngineStop(unittest.TestCase):
+    def testHungEngineIsKilled(self):
+        """ An engine that ignores go and stop is killed after the stop timeout """
+        with tempfile.TemporaryDirectory() as tmpDir:
+            engineFile = os.path.join(tmpDir, 'hung_engine.py')
+            with open(engineFile, 'w') as f:
+                f.write('#!%s\n%s' % (sys.executable, HUNG_ENGINE))
+            os.chmod(engineFile, 0o755)
+            engine = AsyncUciEngine(engineFile)
+
+            async def Search():
+                await engine.Query()
+                return await engine.Go(chess.STARTING_FEN, 'infinite', timeout=0.1)
+
+            with mock.patch('chess_artist.ENGINE_STOP_TIMEOUT', 0.2):
+                with self.assertRaises(Exception):
+                    asyncio.run(Search())
+            self.assertFalse(engine.IsRunning())
+
+
+class TestSharedResultTable(unittest.TestCase):
+    def setUp(self):
+        self.table = SharedResultTable(1)
+
+    def tearDown(self):
+        self.table.Close()
+
+    def testVariantIsInTheTag(self):
+        fen = 'rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq - 0 1'
+        standard = GetAnalyzer(sharedTable=self.table, variantTag=None)
+        chess960 = GetAnalyzer(sharedTable=self.table, variantTag='chess960')
+        standard.PutSharedResult(fen, 'search movetime 10', {'bestmove': 'e2e4'})
+
+        self.assertEqual(standard.GetSharedResult(fen, 'search movetime 10'),
+                         {'bestmove': 'e2e4'})
+        self.assertIsNone(chess960.GetSharedResult(fen, 'search movetime 10'))
+
+    def testBigResultIsCounted(self):
+        board = chess.Board()
+        self.table.Put(board, 'search', {'pv': ['e2e4'] * SHARED_SLOT_SIZE})
+        self.assertIsNone(self.table.Get(board, 'search'))
+        self.assertEqual(self.table.GetDropCnt(), 1)
+
+
+class TestResumeIndex(ChessArtistRun, unittest.TestCase):
+    def GetGameCount(self):
+        with open(os.path.join(self.tmpDir, 'out.pgn')) as f:
+            return f.read().count('[Event ')
+
+    def testGameAppendedBeforeCrash(self):
+        self.Run('--games', '1-3', infile=FISCHER_PGN)
+        self.assertEqual(self.GetGameCount(), 3)
+
+        # A crash after the append of game 3 and before its index entry.
+        indexFile = os.path.join(self.tmpDir, 'out.pgn' + RESUME_INDEX_SUFFIX)
+        with open(indexFile) as f:
+            lines = f.readlines()
+        self.assertEqual(len(lines), 3)
+        with open(indexFile, 'w') as f:
+            f.writelines(lines[:2])
+
+        self.Run('--games', '1-3', infile=FISCHER_PGN)
+        self.assertEqual(self.GetGameCount(), 3)
+        with open(indexFile) as f:
+            self.assertEqual(f.readlines(), lines)
+
+
+class TestGameMoveScore(ChessArtistRun, unittest.TestCase):
+    def testSearchmovesSearchCount(self):
+        afterMove = self.Run('--game-move-score', 'aftermove', outfile='after.pgn')
+        searchMoves = self.Run('--game-move-score', 'searchmoves', outfile='searchmoves.pgn')
+
+        # One search per analyzed ply, the search of the game move is
+        # reused as the search of the next position.
+        self.assertEqual(searchMoves['positions'], afterMove['positions'])
+        self.assertLessEqual(searchMoves['searches'], afterMove['searches'])
+
+    def testMultipvSearchCount(self):
+        afterMove = self.Run('--game-move-score', 'aftermove', outfile='after.pgn')
+        multiPv = self.Run('--game-move-score', 'multipv', '--multipv', '4',
+                           outfile='multipv.pgn')
+
+        # The searchmoves search of a game move that is not in the MultiPV
+        # lines is also reused as the search of the next position.
+        self.assertEqual(multiPv['positions'], afterMove['positions'])
+        self.assertLessEqual(multiPv['searches'], afterMove['searches'])
+
+
+class TestAnalysisCache(ChessArtistRun, unittest.TestCase):
+    def RunTwice(self, *options, firstOptions=None):
+        """ Returns the metrics of a second run with the cache of the first run """
+        cacheFile = os.path.join(self.tmpDir, 'analysis.db')
+        self.Run('--cache', cacheFile, *(options if firstOptions is None else firstOptions),
+                 outfile='first.pgn')
+        return self.Run('--cache', cacheFile, *options, outfile='second.pgn')
+
+    def GetHeader(self, outfile='second.pgn'):
+        with open(os.path.join(self.tmpDir, outfile)) as f:
+            return [line for line in f if 'per position' in line][0]
+
+    def testSearchmoves(self):
+        metrics = self.RunTwice('--game-move-score', 'searchmoves')
+        self.assertEqual(metrics['cache_hit_rate'], 1.0)
+        self.assertEqual(metrics['searches'], 0)
+
+    def testAdaptiveMoveTime(self):
+        metrics = self.RunTwice('--adaptive-movetime', '--movetime', '4000')
+        self.assertEqual(metrics['cache_hit_rate'], 1.0)
+        self.assertEqual(metrics['searches'], 0)
+        self.assertIn('analysis 1.0s to 4.0s per position', self.GetHeader())
+
+    def testTimeBudget(self):
+        # The searches of a smaller budget are shorter, they are searched again.
+        metrics = self.RunTwice('--time-budget', '60', firstOptions=['--time-budget', '10'])
+        self.assertEqual(metrics['cache_hit_rate'], 0.0)
+        self.assertGreater(metrics['searches'], 0)
+        self.assertIn('from a 60.0s time budget', self.GetHeader())
+
+    def testSmallerTimeBudget(self):
+        metrics = self.RunTwice('--time-budget', '10', firstOptions=['--time-budget', '60'])
+        self.assertEqual(metrics['cache_hit_rate'], 1.0)
+        self.assertEqual(metrics['searches'], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()